@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Fake `podman` executable used by the benchmarks.
+
+Keeps image storage in a JSON file and emulates pull cost with configurable latency and bandwidth:
+    FAKE_PODMAN_STATE      directory with storage state (required)
+    FAKE_PODMAN_LATENCY    seconds per registry round trip (default: 0.05)
+    FAKE_PODMAN_IMAGE_MB   size of every image in MB (default: 200)
+    FAKE_PODMAN_MBPS       registry bandwidth in MB/s (default: 500)
+    FAKE_PODMAN_SOCKET     socket of `podman system service` (default: <state>/podman.sock)
+Pulling an image whose digest is already in storage costs one round trip only.
+
+Every image has two layers: a base layer shared by all images (half of the image size) and its own layer.
+`save --format docker-archive -o <path> <name>` writes a docker-archive with (incompressible) layer content,
+`load` reads one from stdin. Like real podman, load only accepts an empty layer file (placeholder, see
+utils/relay.py) for a layer whose diff ID is already in storage.
+
+`podman system service` serves the subset of libpod REST API used by utils/podman_api.py on the socket
+and `podman system dial-stdio` connects stdin/stdout to it, like the real commands.
+
+Run with `skopeo` as first argument it acts as skopeo: `copy docker://... containers-storage:<name>` pulls
+into the same storage and names the image, `inspect --format ... containers-storage:<name>` prints its layers.
+"""
+import fcntl
+import hashlib
+import json
+import io
+import os
+import random
+import socket
+import socketserver
+import sys
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+STATE_DIR = os.environ["FAKE_PODMAN_STATE"]
+LATENCY = float(os.environ.get("FAKE_PODMAN_LATENCY", "0.05"))
+IMAGE_MB = float(os.environ.get("FAKE_PODMAN_IMAGE_MB", "200"))
+MBPS = float(os.environ.get("FAKE_PODMAN_MBPS", "500"))
+SOCKET = os.environ.get("FAKE_PODMAN_SOCKET") or os.path.join(STATE_DIR, "podman.sock")
+BASE_LAYER = "sha256:" + hashlib.sha256(b"fake-podman-base-layer").hexdigest()
+BLOCK_SIZE = 1024 * 1024
+
+
+def load():
+    try:
+        with open(os.path.join(STATE_DIR, "images.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def save(images):
+    with open(os.path.join(STATE_DIR, "images.json"), "w") as f:
+        json.dump(images, f)
+
+
+def find(images, reference):
+    for image in images:
+        if reference in image["Names"] or image["Id"].startswith(reference) or \
+                any(reference.endswith(digest) for digest in image["RepoDigests"]):
+            return image
+    return None
+
+
+def pull(images, reference):
+    time.sleep(LATENCY)
+    digest = reference.split("@")[-1] if "@" in reference else "sha256:" + hashlib.sha256(reference.encode()).hexdigest()
+    existing = next((image for image in images if digest in [item.split("@")[-1] for item in image["RepoDigests"]]), None)
+    if existing is None:
+        time.sleep(IMAGE_MB / MBPS)
+        existing = {"Id": hashlib.sha256(digest.encode()).hexdigest(), "Names": [], "Digest": digest,
+                    "RepoDigests": [f"{reference.split('@')[0].split(':')[0]}@{digest}"], "Size": int(IMAGE_MB * 1024 ** 2)}
+        images.append(existing)
+    if reference not in existing["Names"]:
+        existing["Names"].append(reference)
+    return existing
+
+
+def pull_merged(lock, images, reference):
+    """Pulls image, lock is not held while "downloading", concurrent pulls overlap like real ones"""
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    pulled = pull(images, reference)
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    merged = load()
+    for image in images:
+        current = next((item for item in merged if item["Id"] == image["Id"]), None)
+        if current is None:
+            merged.append(image)
+        else:
+            current["Names"] = sorted(set(current["Names"]) | set(image["Names"]))
+    save(merged)
+    return pulled
+
+
+def locked():
+    lock = open(os.path.join(STATE_DIR, "lock"), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    """Subset of libpod REST API: ping, image list/inspect/pull/tag/remove"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, message_format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path.split("/libpod", 1)[-1]
+        if path == "/_ping":
+            return self._send(200, "OK")
+        parts = [unquote(part) for part in path.split("/") if part]
+        with locked() as lock:
+            images = load()
+            if method == "GET" and parts == ["images", "json"]:
+                return self._send(200, images)
+            if method == "POST" and parts == ["images", "pull"]:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self._chunk({"stream": f"Trying to pull {query['reference']}...\n"})
+                image = pull_merged(lock, images, query["reference"])
+                self._chunk({"stream": "Writing manifest to image destination\n"})
+                self._chunk({"images": [image["Id"]], "id": image["Id"]})
+                self.wfile.write(b"0\r\n\r\n")
+                return
+            image = find(images, parts[1]) if len(parts) > 1 else None
+            if image is None:
+                return self._send(404, {"message": f"{parts[1] if len(parts) > 1 else path}: image not known"})
+            if method == "GET" and parts[2:] == ["json"]:
+                return self._send(200, image)
+            if method == "POST" and parts[2:] == ["tag"]:
+                image["Names"].append(f"{query['repo']}:{query.get('tag', 'latest')}")
+                save(images)
+                return self._send(201, None)
+            if method == "DELETE" and len(parts) == 2:
+                save([item for item in images if item is not image])
+                return self._send(200, [{"Id": image["Id"]}])
+        self._send(404, {"message": f"unsupported fake podman API call: {method} {url.path}"})
+
+    def _chunk(self, event):
+        data = (json.dumps(event) + "\n").encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send(self, status, body):
+        data = b"" if body is None else (body if isinstance(body, str) else json.dumps(body)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _ApiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects (host, port) client address
+        request, _address = super().get_request()
+        return request, ("local", 0)
+
+
+def serve():
+    if os.path.exists(SOCKET):
+        os.unlink(SOCKET)
+    with _ApiServer(SOCKET, _ApiHandler) as server:
+        server.serve_forever()
+
+
+def dial_stdio():
+    """Connects stdin/stdout to the service socket"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(SOCKET)
+
+    def pump_stdin():
+        for data in iter(lambda: os.read(0, 1024 * 1024), b""):
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+
+    threading.Thread(target=pump_stdin, daemon=True).start()
+    for data in iter(lambda: sock.recv(1024 * 1024), b""):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+    return 0
+
+
+def get_layers(image):
+    """Every fake image is a single layer"""
+    return [{"Digest": "sha256:" + hashlib.sha256(image["Id"].encode()).hexdigest(), "Size": image["Size"]}]
+
+
+def get_diff_ids(image):
+    """Diff IDs of image layers, loaded images keep those of the archive"""
+    return image.get("Layers") or [BASE_LAYER, "sha256:" + hashlib.sha256(image["Id"].encode()).hexdigest()]
+
+
+class _LayerReader:
+    """Layer content, one random block repeated so that the layer doesn't compress"""
+
+    def __init__(self, diff_id, size):
+        generator = random.Random(diff_id)
+        self.block = generator.getrandbits(8 * BLOCK_SIZE).to_bytes(BLOCK_SIZE, "little")
+        self.remaining = size
+        self.offset = 0
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        start = self.offset % BLOCK_SIZE
+        data = (self.block * (size // BLOCK_SIZE + 2))[start:start + size]
+        self.offset += size
+        self.remaining -= size
+        return data
+
+
+def save_archive(image, name, path):
+    """Writes image as docker-archive: layers first, manifest.json last, like podman save"""
+    diff_ids = get_diff_ids(image)
+    sizes = [image["Size"] // 2, image["Size"] - image["Size"] // 2]
+    config = json.dumps({"rootfs": {"type": "layers", "diff_ids": diff_ids}}).encode()
+    layers = [f"{diff_id.split(':')[-1]}.tar" for diff_id in diff_ids]
+    manifest = json.dumps([{"Config": f"{image['Id']}.json", "RepoTags": [name], "Layers": layers}]).encode()
+    with tarfile.open(path, "w") as tar:
+        for layer, diff_id, size in zip(layers, diff_ids, sizes):
+            member = tarfile.TarInfo(layer)
+            member.size = size
+            tar.addfile(member, _LayerReader(diff_id, size))
+        for member_name, data in ((f"{image['Id']}.json", config), ("manifest.json", manifest)):
+            member = tarfile.TarInfo(member_name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+
+
+def load_archive(images, stream):
+    """
+    Loads docker-archive read from stream into storage
+    :return: Loaded image, raises ValueError for a placeholder of a layer which is not in storage
+    """
+    sizes, files = {}, {}
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            content = tar.extractfile(member)
+            if member.name.endswith(".json"):
+                files[member.name] = content.read()
+            else:
+                sizes[member.name] = sum(len(chunk) for chunk in iter(lambda: content.read(BLOCK_SIZE), b""))
+    manifest = json.loads(files["manifest.json"])[0]
+    diff_ids = json.loads(files[manifest["Config"]])["rootfs"]["diff_ids"]
+    stored = {diff_id for image in images for diff_id in get_diff_ids(image)}
+    for layer, diff_id in zip(manifest["Layers"], diff_ids):
+        if not sizes.get(layer) and diff_id not in stored:
+            raise ValueError(f"layer {diff_id} of {layer} is empty and not in storage")
+    image_id = manifest["Config"].split(".")[0]
+    image = find(images, image_id)
+    if image is None:
+        image = {"Id": image_id, "Names": [], "Digest": "", "RepoDigests": [], "Layers": diff_ids,
+                 "Size": sum(sizes.values())}
+        images.append(image)
+    for name in manifest["RepoTags"]:
+        if name not in image["Names"]:
+            image["Names"].append(name)
+    return image
+
+
+def skopeo(lock, images, args):
+    references = [arg for arg in args[1:] if not arg.startswith("-")]
+    if args[0] == "copy" and len(references) == 2:
+        source, destination = references[0].split("://", 1)[-1], references[1].split(":", 1)[-1]
+        existing = {image["Id"] for image in images}
+        pulled = pull_merged(lock, images, source)
+        layer = get_layers(pulled)[0]["Digest"].split(":")[-1][:12]
+        print(f"Copying blob {layer} " + ("skipped: already exists" if pulled["Id"] in existing else "done"))
+        print("Writing manifest to image destination")
+        merged = load()
+        image = next(item for item in merged if item["Id"] == pulled["Id"])
+        if destination not in image["Names"]:
+            image["Names"].append(destination)
+        save(merged)
+    elif args[0] == "inspect" and references:
+        image = find(images, references[-1].split(":", 1)[-1])
+        if image is None:
+            print(f"Error: {references[-1]}: image not known", file=sys.stderr)
+            return 1
+        print(json.dumps(get_layers(image)))
+    else:
+        print(f"Error: unsupported fake skopeo command: {' '.join(args)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(args):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    if args[:2] == ["system", "service"]:
+        serve()
+        return 0
+    if args[:2] == ["system", "dial-stdio"]:
+        return dial_stdio()
+    with locked() as lock:
+        images = load()
+        command = args[0] if args else ""
+        if command == "skopeo":
+            return skopeo(lock, images, args[1:])
+        if command == "pull":
+            print(pull_merged(lock, images, args[1])["Id"])
+        elif command == "tag":
+            image = find(images, args[1])
+            if image is None:
+                print(f"Error: {args[1]}: image not known", file=sys.stderr)
+                return 125
+            for name in args[2:]:
+                if name not in image["Names"]:
+                    image["Names"].append(name)
+            save(images)
+        elif command == "rmi":
+            references = [arg for arg in args[1:] if not arg.startswith("-")]
+            images = [image for image in images if not any(find([image], reference) for reference in references)]
+            save(images)
+        elif command == "images":
+            if "--format" in args and "json" in args:
+                print(json.dumps(images))
+            elif "-q" in args:
+                print("\n".join(image["Id"][:12] for image in images))
+            else:
+                print("REPOSITORY TAG IMAGE ID CREATED SIZE")
+                for image in images:
+                    for name in image["Names"]:
+                        repository, _, tag = name.rpartition(":")
+                        print(f"{repository} {tag} {image['Id'][:12]} now {image['Size']}")
+        elif command == "save" and "-o" in args:
+            image = find(images, args[-1])
+            if image is None:
+                print(f"Error: {args[-1]}: image not known", file=sys.stderr)
+                return 125
+            save_archive(image, args[-1], args[args.index("-o") + 1])
+        elif command == "load":
+            try:
+                image = load_archive(images, sys.stdin.buffer)
+            except (KeyError, ValueError, tarfile.TarError) as err:
+                print(f"Error: payload does not match any of the supported image formats: {err}", file=sys.stderr)
+                return 125
+            save(images)
+            print(f"Loaded image: {image['Names'][0] if image['Names'] else image['Id']}")
+        elif args[:2] == ["image", "inspect"]:
+            references = [arg for index, arg in enumerate(args[2:], 2)
+                          if not arg.startswith("-") and args[index - 1] != "--format"]
+            for reference in references:
+                image = find(images, reference)
+                if image is None:
+                    print(f"Error: {reference}: image not known", file=sys.stderr)
+                    return 125
+                if "--format" in args and "RootFS.Layers" in args[args.index("--format") + 1]:
+                    print("\n".join(get_diff_ids(image)))
+                else:
+                    print(json.dumps([dict(image, RootFS={"Layers": get_diff_ids(image)})]))
+        elif command == "machine":
+            pass
+        else:
+            print(f"Error: unsupported fake podman command: {' '.join(args)}", file=sys.stderr)
+            return 125
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark of the entry points.
+
+Every case runs in a fresh interpreter from a working directory with config.json made from
+config.json.example. Median wall time is reported next to the wall time of a bare interpreter, a run with
+`python -X importtime` tells how long importing modules of this repo took and which backends got loaded.
+A case fails when it loads a backend it must not: --help, argument errors and importing the local
+deployment never need the SSH (paramiko) or HTTP (requests) stack. --budget_ms also fails cases whose
+startup over the bare interpreter is slower than the budget.
+    python benchmarks/import_time.py --output base.json
+    python benchmarks/import_time.py --compare base.json --budget_ms 50
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run_benchmarks import REPO_DIR, git_revision
+
+# Top-level packages of the SSH, HTTP and asyncio stacks
+BACKENDS = ("paramiko", "cryptography", "requests", "urllib3", "http", "asyncio")
+
+CASES = {
+    "install-help": {"script": ["install_cli.py", "--help"], "forbidden": BACKENDS},
+    "install-invalid": {"script": ["install_cli.py", "--mta_version", "7.3.0", "--build", "1", "--upstream", "true"],
+                        "forbidden": BACKENDS},
+    "prepare-help": {"script": ["prepare_remote_host.py", "--help"], "forbidden": BACKENDS},
+    "import-local": {"module": "local_deployment", "forbidden": ("paramiko", "cryptography", "requests", "urllib3")},
+    # SSH backend is loaded when the first host is connected, not by the import
+    "import-remote": {"module": "remote_deployment", "forbidden": ("paramiko", "cryptography", "requests", "urllib3")},
+}
+
+
+def get_command(repo, case):
+    if "script" in case:
+        return [sys.executable, os.path.join(repo, case["script"][0]), *case["script"][1:]]
+    return [sys.executable, "-c", f"import sys; sys.path.insert(0, {repo!r}); import {case['module']}"]
+
+
+def time_command(command, work_dir):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def read_imports(command, work_dir, repo):
+    """
+    Runs command with -X importtime
+    :return: Tuple of seconds spent importing modules of repo (cumulative, top-level only) and set of
+             top-level packages loaded
+    """
+    result = subprocess.run([command[0], "-X", "importtime", *command[1:]], cwd=work_dir, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, encoding="utf-8")
+    local_modules = {name[:-3] for name in os.listdir(repo) if name.endswith(".py")} | {"utils", "config"}
+    packages, repo_us = set(), 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self_us, cumulative, field = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        package = field.strip().split(".")[0]
+        packages.add(package)
+        # Modules imported directly by the entry point are indented by one space only
+        if len(field) - len(field.lstrip()) == 1 and package in local_modules:
+            repo_us += int(cumulative)
+    return repo_us / 1e6, packages
+
+
+def run_case(repo, work_dir, case, repeat, baseline):
+    command = get_command(repo, case)
+    walls = [time_command(command, work_dir) for _ in range(repeat)]
+    imports, packages = read_imports(command, work_dir, repo)
+    wall = statistics.median(walls)
+    return {"wall": wall, "startup": max(0.0, wall - baseline), "imports": imports,
+            "backends": sorted(package for package in BACKENDS if package in packages),
+            "forbidden": sorted(package for package in case["forbidden"] if package in packages)}
+
+
+def print_results(results, budget):
+    print(f"\nCommit {results['revision']['commit'][:12]}{' (dirty)' if results['revision']['dirty'] else ''}: "
+          f"{results['revision']['subject']}")
+    print(f"Bare interpreter: {results['baseline'] * 1000:.0f} ms")
+    print(f"{'Case':<16} {'Wall (ms)':>10} {'Startup':>8} {'Imports':>8}  Backends loaded")
+    for name, case in results["cases"].items():
+        marks = []
+        if case["forbidden"]:
+            marks.append(f"must not load {', '.join(case['forbidden'])}")
+        if budget and case["startup"] * 1000 > budget:
+            marks.append(f"over budget of {budget:.0f} ms")
+        print(f"{name:<16} {case['wall'] * 1000:>10.0f} {case['startup'] * 1000:>8.0f} {case['imports'] * 1000:>8.0f}  "
+              f"{', '.join(case['backends']) or '-'}" + (f"  FAILED: {'; '.join(marks)}" if marks else ""))
+
+
+def print_comparison(base, new):
+    print(f"\nComparing {base['revision']['commit'][:12]} -> {new['revision']['commit'][:12]}")
+    for name, case in new["cases"].items():
+        if name in base["cases"]:
+            old = base["cases"][name]
+            print(f"{name:<16} startup {old['startup'] * 1000:.0f} -> {case['startup'] * 1000:.0f} ms, "
+                  f"imports {old['imports'] * 1000:.0f} -> {case['imports'] * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures startup time of install_cli.py and prepare_remote_host.py.")
+    parser.add_argument("--cases", default=",".join(CASES),
+                        help=f"Comma separated cases to run (default: all): {', '.join(CASES)}")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs of every case, median is reported (default: 10)")
+    parser.add_argument("--repo", default=REPO_DIR, help="Checkout whose entry points are measured (default: this one)")
+    parser.add_argument("--budget_ms", type=float,
+                        help="Fail cases whose startup over the bare interpreter takes longer (default: no budget)")
+    parser.add_argument("--output", help="File where results are saved as JSON")
+    parser.add_argument("--compare", help="Results JSON of a previous run to compare with")
+    options = parser.parse_args()
+
+    names = [name.strip() for name in options.cases.split(",") if name.strip()]
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(unknown)}")
+
+    work_dir = tempfile.mkdtemp(prefix="mta-import-bench-")
+    try:
+        shutil.copy(os.path.join(options.repo, "config.json.example"), os.path.join(work_dir, "config.json"))
+        baseline = statistics.median(time_command([sys.executable, "-c", "pass"], work_dir)
+                                     for _ in range(options.repeat))
+        results = {"revision": git_revision(options.repo), "timestamp": datetime.datetime.now().isoformat(),
+                   "python": platform.python_version(), "baseline": baseline,
+                   "cases": {name: run_case(options.repo, work_dir, CASES[name], options.repeat, baseline)
+                             for name in names}}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results, options.budget_ms)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if options.compare:
+        with open(options.compare) as f:
+            print_comparison(json.load(f), results)
+    if any(case["forbidden"] or (options.budget_ms and case["startup"] * 1000 > options.budget_ms)
+           for case in results["cases"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
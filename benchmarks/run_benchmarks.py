@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks of install_cli.py.
+
+Every scenario runs install_cli.py as a subprocess against local stand-ins (see standins.py): dependency
+zips and GitHub releases API are served over HTTP, remote hosts are in-process SSH servers and podman is
+replaced by fake_podman.py with configurable latency and image size. Each run gets a fresh working
+directory, HOME, artifact cache and podman storage, so results are comparable across commits.
+
+Wall time, bytes transferred, round trips to remote hosts and per-phase durations (from the trace written
+with --trace_file) are reported. Results can be saved as JSON and compared:
+    python benchmarks/run_benchmarks.py --output base.json
+    git checkout my-branch
+    python benchmarks/run_benchmarks.py --output new.json --compare base.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standins import HttpStandIn, SshStandIn, PLATFORMS, make_dependency_zip, make_podman_bin
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VERSION = "7.3.0"
+IMAGE_KINDS = ["cli", "java-external-provider", "dotnet-external-provider", "generic-external-provider"]
+# Spans which carry number of bytes moved in their "bytes" attribute
+BYTES_SPANS = ("download", "transfer", "relay")
+
+SCENARIOS = {
+    "local-upstream": {"hosts": 0, "args": ["--upstream", "true"]},
+    "local-bundle": {"hosts": 0, "args": ["{bundle}"]},
+    "local-multi-image": {"hosts": 0, "args": ["{bundle}", "--pull_workers", "{pull_workers}"], "images": "many"},
+    "remote-upstream": {"hosts": 1, "args": ["--upstream", "true", "{remote}"]},
+    "remote-bundle": {"hosts": 1, "args": ["{bundle}", "{remote}"]},
+    "multi-host": {"hosts": 3, "args": ["{bundle}", "--hosts", "{hosts}", "--host_workers", "{hosts_count}",
+                                        "--pull_workers", "{pull_workers}"], "images": "many"},
+    "multi-host-mixed": {"hosts": 3, "args": ["--upstream", "true", "--hosts", "{mixed_hosts}",
+                                              "--host_workers", "{hosts_count}"]},
+    # Images are pulled once on the controller and relayed, hosts share the base layer of all images
+    "multi-host-relay": {"hosts": 3, "args": ["{bundle}", "--hosts", "{hosts}", "--host_workers", "{hosts_count}",
+                                              "--relay_images"]},
+    # Targets are deployed once before the measured run, which finds them up to date
+    "local-noop": {"hosts": 0, "args": ["{bundle}"], "warm": True},
+    "multi-host-noop": {"hosts": 3, "args": ["{bundle}", "--hosts", "{hosts}", "--host_workers", "{hosts_count}"],
+                        "images": "many", "warm": True},
+}
+
+
+def make_image_list(path, count):
+    """Writes images list in the format produced by get-image-build-details.py"""
+    images = []
+    for index in range(count):
+        kind = IMAGE_KINDS[index % len(IMAGE_KINDS)]
+        suffix = f"-{index // len(IMAGE_KINDS)}" if index >= len(IMAGE_KINDS) else ""
+        digest = f"{index + 1:064x}"
+        images.append(f"registry.redhat.io/mta/mta-{kind}{suffix}-rhel9@sha256:{digest}")
+    with open(path, "w") as f:
+        f.write("Image list generated by benchmark\n")
+        json.dump({"related_images_pullspecs": images}, f)
+    return path
+
+
+def git_revision(repo):
+    def git(*args):
+        result = subprocess.run(["git", "-C", repo, *args], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                encoding="utf-8")
+        return result.stdout.strip()
+    return {"commit": git("rev-parse", "HEAD"), "subject": git("log", "-1", "--format=%s"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+class Workbench:
+    """Shared stand-ins and fixtures of one benchmark session"""
+
+    def __init__(self, root, options):
+        self.root = root
+        self.options = options
+        self.podman_bin = make_podman_bin(os.path.join(root, "bin"))
+        self.podman_env = {"FAKE_PODMAN_LATENCY": str(options.latency), "FAKE_PODMAN_IMAGE_MB": str(options.image_mb),
+                           "FAKE_PODMAN_MBPS": str(options.registry_mbps)}
+        files_dir = os.path.join(root, "files")
+        os.makedirs(files_dir)
+        zip_path = make_dependency_zip(os.path.join(root, "dependencies.zip"), options.zip_files, options.zip_file_kb * 1024)
+        for os_name, machine in PLATFORMS:
+            for name in (f"kantra.{os_name}.{machine}.zip", f"mta-{VERSION}-cli-{os_name}-{machine}.zip"):
+                os.link(zip_path, os.path.join(files_dir, name))
+        self.zip_path = zip_path
+        self.image_lists = {"few": make_image_list(os.path.join(root, "images-few.txt"), len(IMAGE_KINDS)),
+                            "many": make_image_list(os.path.join(root, "images-many.txt"), options.images)}
+        self.key_file = os.path.join(root, "id_rsa")
+        key = paramiko.RSAKey.generate(2048)
+        key.write_private_key_file(self.key_file)
+        self.client_key = paramiko.RSAKey.from_private_key_file(self.key_file)
+        self.http = HttpStandIn(files_dir).start()
+        self.ssh_servers = []
+
+    def ssh_hosts(self, count, run_dir):
+        """Starts SSH stand-ins with fresh homes for one run"""
+        servers = []
+        for index in range(count):
+            server = SshStandIn(os.path.join(run_dir, f"remote-{index}"), self.client_key, self.podman_bin,
+                                self.podman_env).start()
+            servers.append(server)
+        self.ssh_servers.extend(servers)
+        return servers
+
+    def close(self):
+        self.http.stop()
+        for server in self.ssh_servers:
+            server.stop()
+
+
+def start_podman_service(podman_bin, env):
+    """Starts `podman system service` of fake podman storage and waits for its socket"""
+    socket_path = os.path.join(env["FAKE_PODMAN_STATE"], "podman.sock")
+    service = subprocess.Popen([os.path.join(podman_bin, "podman"), "system", "service"], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(socket_path) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return service
+
+
+def run_scenario(bench, name, scenario, run_index):
+    """
+    Runs install_cli.py once in fresh environment
+    :return: Dict with wall time, exit status, bytes, round trips and per-phase durations
+    """
+    options = bench.options
+    run_dir = os.path.join(bench.root, "runs", f"{name}-{run_index}")
+    home = os.path.join(run_dir, "home")
+    os.makedirs(home)
+    with open(os.path.join(run_dir, "config.json"), "w") as f:
+        json.dump({"misc_downstream_path": run_dir, "temp_dir": "", "extract_binary": "", "get_images_output": "",
+                   "bundle": "", "no_brew": "", "ssh_user": "bench", "ssh_key": bench.key_file,
+                   "github_api_url": bench.http.url, "download_segments": options.download_segments}, f)
+    servers = bench.ssh_hosts(scenario["hosts"], run_dir)
+    image_list = bench.image_lists[scenario.get("images", "few")]
+    placeholders = {
+        "{bundle}": ["--mta_version", VERSION, "--build", "1", "--image_output_file", image_list,
+                     "--dependency_file", bench.zip_path],
+        "{remote}": ["--ip_address", servers[0].address if servers else "", "--os", "linux", "--platform", "amd64"],
+        "{hosts}": [",".join(f"{server.address}=linux/amd64" for server in servers)],
+        "{mixed_hosts}": [",".join(f"{server.address}={'/'.join(PLATFORMS[index % len(PLATFORMS)])}"
+                                   for index, server in enumerate(servers))],
+        "{hosts_count}": [str(len(servers))],
+        "{pull_workers}": [str(options.pull_workers)],
+    }
+    args = [value for arg in scenario["args"] for value in placeholders.get(arg, [arg])]
+    trace_file = os.path.join(run_dir, "trace.json")
+    backend = ["--podman_backend", "api"] if options.podman_backend == "api" else []
+    command = [sys.executable, os.path.join(options.repo, "install_cli.py"), *args, *backend, *options.extra_args,
+               "--trace_file", trace_file, "--trace_format", "json"]
+    env = dict(os.environ, HOME=home, PATH=f"{bench.podman_bin}:{os.environ.get('PATH', '')}",
+               FAKE_PODMAN_STATE=os.path.join(home, ".podman-state"), **bench.podman_env)
+    env["CONTAINER_HOST"] = f"unix://{os.path.join(env['FAKE_PODMAN_STATE'], 'podman.sock')}"
+    services = []
+    if options.podman_backend == "api":
+        services = [start_podman_service(bench.podman_bin, service_env)
+                    for service_env in [env] + [server.env for server in servers]]
+
+    if scenario.get("warm"):
+        warmup = subprocess.run(command[:-4], cwd=run_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                encoding="utf-8")
+        if warmup.returncode != 0:
+            logging.error(f"Warm-up of scenario {name} failed with exit code {warmup.returncode}:\n"
+                          f"{warmup.stdout[-2000:]}")
+    http_bytes = bench.http.bytes_sent
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=run_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            encoding="utf-8")
+    wall = time.perf_counter() - start
+    for server in servers:
+        server.stop()
+    for service in services:
+        service.terminate()
+        service.wait()
+    with open(os.path.join(run_dir, "output.log"), "w") as f:
+        f.write(result.stdout)
+    if result.returncode != 0:
+        logging.error(f"Scenario {name} failed with exit code {result.returncode}, output: "
+                      f"{os.path.join(run_dir, 'output.log')}\n{result.stdout[-2000:]}")
+
+    spans = []
+    if os.path.exists(trace_file):
+        with open(trace_file) as f:
+            spans = json.load(f)["spans"]
+    phases = {}
+    for item in spans:
+        if item["name"] != "command":
+            phases[item["name"]] = phases.get(item["name"], 0.0) + item["duration"]
+    return {"wall": wall, "exit_status": result.returncode,
+            "bytes": sum(item.get("bytes", 0) for item in spans if item["name"] in BYTES_SPANS),
+            "http_bytes": bench.http.bytes_sent - http_bytes,
+            "round_trips": sum(item.get("round_trips", 0) for item in spans
+                               if item["name"] in ("host_plan", "host_deployment")),
+            "commands": sum(1 for item in spans if item["name"] == "command"),
+            "phases": phases}
+
+
+def summarize(runs):
+    """Median of every metric over repeated runs"""
+    phases = sorted({phase for run in runs for phase in run["phases"]})
+    return {"wall": statistics.median(run["wall"] for run in runs),
+            "bytes": statistics.median(run["bytes"] for run in runs),
+            "http_bytes": statistics.median(run["http_bytes"] for run in runs),
+            "round_trips": statistics.median(run["round_trips"] for run in runs),
+            "commands": statistics.median(run["commands"] for run in runs),
+            "failed": sum(1 for run in runs if run["exit_status"] != 0),
+            "phases": {phase: statistics.median(run["phases"].get(phase, 0.0) for run in runs) for phase in phases}}
+
+
+def print_results(results):
+    print(f"\nCommit {results['revision']['commit'][:12]}{' (dirty)' if results['revision']['dirty'] else ''}: "
+          f"{results['revision']['subject']}")
+    print(f"{'Scenario':<20} {'Wall (s)':>9} {'MB moved':>9} {'MB HTTP':>8} {'Trips':>6} {'Cmds':>5}  Failed")
+    for name, scenario in results["scenarios"].items():
+        summary = scenario["summary"]
+        print(f"{name:<20} {summary['wall']:>9.2f} {summary['bytes'] / 1024 ** 2:>9.1f} "
+              f"{summary['http_bytes'] / 1024 ** 2:>8.1f} {summary['round_trips']:>6.0f} {summary['commands']:>5.0f}  "
+              f"{summary['failed']}/{len(scenario['runs'])}")
+    for name, scenario in results["scenarios"].items():
+        phases = ", ".join(f"{phase} {duration:.2f}s" for phase, duration
+                           in sorted(scenario["summary"]["phases"].items(), key=lambda item: -item[1]))
+        print(f"  {name}: {phases}")
+
+
+def print_comparison(base, new):
+    """Prints relative change of wall time and phases of scenarios present in both results"""
+    print(f"\nComparing {base['revision']['commit'][:12]} -> {new['revision']['commit'][:12]}")
+    if base["settings"] != new["settings"]:
+        print("Warning: results were produced with different settings")
+    for name, scenario in new["scenarios"].items():
+        if name not in base["scenarios"]:
+            continue
+        old_summary, new_summary = base["scenarios"][name]["summary"], scenario["summary"]
+        print(f"{name:<20} wall {_change(old_summary['wall'], new_summary['wall'])}, "
+              f"MB moved {_change(old_summary['bytes'] / 1024 ** 2, new_summary['bytes'] / 1024 ** 2)}, "
+              f"round trips {old_summary['round_trips']:.0f} -> {new_summary['round_trips']:.0f}")
+        for phase in sorted(set(old_summary["phases"]) | set(new_summary["phases"])):
+            print(f"    {phase:<24} {_change(old_summary['phases'].get(phase, 0.0), new_summary['phases'].get(phase, 0.0))}")
+
+
+def _change(old, new):
+    if not old:
+        return f"{old:.2f} -> {new:.2f}"
+    return f"{old:.2f} -> {new:.2f} ({(new - old) / old * 100:+.1f}%)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs end-to-end benchmarks of install_cli.py against local stand-ins.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma separated scenarios to run (default: all): {', '.join(SCENARIOS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every scenario, median is reported (default: 3)")
+    parser.add_argument("--repo", default=REPO_DIR, help="Checkout whose install_cli.py is benchmarked (default: this one)")
+    parser.add_argument("--images", type=int, default=12, help="Number of images in multi-image scenarios (default: 12)")
+    parser.add_argument("--pull_workers", type=int, default=4, help="--pull_workers used by multi-image scenarios (default: 4)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake registry round trip latency in seconds (default: 0.05)")
+    parser.add_argument("--image_mb", type=float, default=200, help="Size of every fake image in MB (default: 200)")
+    parser.add_argument("--registry_mbps", type=float, default=500, help="Fake registry bandwidth in MB/s (default: 500)")
+    parser.add_argument("--zip_files", type=int, default=200, help="Number of files in dependency zip (default: 200)")
+    parser.add_argument("--zip_file_kb", type=int, default=64, help="Size of every file in dependency zip in KB (default: 64)")
+    parser.add_argument("--download_segments", type=int, default=1, help="download_segments set in config.json (default: 1)")
+    parser.add_argument("--podman_backend", choices=["cli", "api"], default="cli",
+                        help="--podman_backend of install_cli.py, api starts fake podman service for every host (default: cli)")
+    parser.add_argument("--extra_args", default="", help="Extra arguments passed to every install_cli.py run")
+    parser.add_argument("--output", help="File where results are saved as JSON")
+    parser.add_argument("--compare", help="Results JSON of a previous run to compare with")
+    parser.add_argument("--keep", action="store_true", help="Keep working directory with logs and traces of all runs")
+    options = parser.parse_args()
+    options.extra_args = options.extra_args.split()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    # Stand-in SSH servers log every connection and reset by clients closing them
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    names = [name.strip() for name in options.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    root = tempfile.mkdtemp(prefix="mta-bench-")
+    bench = Workbench(root, options)
+    settings = {key: value for key, value in vars(options).items()
+                if key not in ("scenarios", "repeat", "repo", "output", "compare", "keep")}
+    results = {"revision": git_revision(options.repo), "timestamp": datetime.datetime.now().isoformat(),
+               "python": platform.python_version(), "settings": settings, "scenarios": {}}
+    try:
+        for name in names:
+            runs = []
+            for run_index in range(options.repeat):
+                logging.info(f"Running scenario {name} ({run_index + 1}/{options.repeat})")
+                runs.append(run_scenario(bench, name, SCENARIOS[name], run_index))
+            results["scenarios"][name] = {"runs": runs, "summary": summarize(runs)}
+    finally:
+        bench.close()
+        if options.keep:
+            logging.info(f"Logs and traces kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_results(results)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if options.compare:
+        with open(options.compare) as f:
+            print_comparison(json.load(f), results)
+    if any(scenario["summary"]["failed"] for scenario in results["scenarios"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
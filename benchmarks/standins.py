@@ -0,0 +1,349 @@
+"""
+Local stand-ins for the services deployments talk to, used by the benchmarks.
+
+- HttpStandIn: threaded HTTP server serving synthetic dependency zips (with byte ranges) and a fake
+  GitHub releases API listing them as assets of a pre-release.
+- SshStandIn: in-process paramiko SSH server executing commands with bash in a per-host home directory
+  and serving SFTP from the local filesystem. Its ~/.bash_profile puts the fake podman first in PATH.
+- make_podman_bin: directory with a `podman` executable backed by fake_podman.py.
+"""
+import json
+import logging
+import os
+import random
+import shlex
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import paramiko
+
+FAKE_PODMAN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_podman.py")
+PLATFORMS = [("linux", "amd64"), ("linux", "arm64"), ("darwin", "amd64"), ("darwin", "arm64"),
+             ("windows", "amd64")]
+
+
+def make_podman_bin(path):
+    """
+    Creates directory with `podman` and `skopeo` executables running fake_podman.py
+    :param path: Directory to be created
+    :return: Path of the directory
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, prefix in (("podman", ""), ("skopeo", "skopeo ")):
+        executable = os.path.join(path, name)
+        with open(executable, "w") as f:
+            f.write(f'#!/bin/sh\nexec {shlex.quote(sys.executable)} {shlex.quote(FAKE_PODMAN)} {prefix}"$@"\n')
+        os.chmod(executable, 0o755)
+    return path
+
+
+def make_dependency_zip(path, files=200, file_size=64 * 1024, seed=0):
+    """
+    Writes synthetic dependency zip with incompressible content, same seed gives the same zip
+    :param path: Path of the zip
+    :param files: Number of files in the zip
+    :param file_size: Size of every file in bytes
+    :param seed: Random seed
+    """
+    generator = random.Random(seed)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for index in range(files):
+            # random.randbytes needs Python 3.9, getrandbits(0) fails before 3.9
+            data = generator.getrandbits(8 * file_size).to_bytes(file_size, "little") if file_size else b""
+            zip_ref.writestr(f"kantra/lib/file-{index:04d}.bin", data)
+        zip_ref.writestr("kantra/kantra", b"#!/bin/sh\necho kantra\n")
+    return path
+
+
+class HttpStandIn:
+    """HTTP server for dependency zips and GitHub releases API"""
+
+    def __init__(self, root, host="127.0.0.1"):
+        self.root = root
+        self.server = ThreadingHTTPServer((host, 0), _HttpHandler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def releases(self):
+        assets = [{"name": name, "browser_download_url": f"{self.url}/files/{name}"}
+                  for name in sorted(os.listdir(self.root))]
+        return [{"tag_name": "v0.0.0-bench", "prerelease": True, "assets": assets}]
+
+    def count(self, sent):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+
+
+class _HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, message_format, *args):
+        logging.debug("HTTP stand-in: " + message_format, *args)
+
+    def do_HEAD(self):
+        self._handle(head=True)
+
+    def do_GET(self):
+        self._handle(head=False)
+
+    def _handle(self, head):
+        standin = self.server.standin
+        if self.path.startswith("/repos/") and self.path.endswith("/releases"):
+            return self._send(200, json.dumps(standin.releases()).encode(), head)
+        path = os.path.join(standin.root, os.path.basename(self.path))
+        if not self.path.startswith("/files/") or not os.path.isfile(path):
+            return self._send(404, b"not found", head)
+        size = os.path.getsize(path)
+        start, end, status = 0, size, 200
+        requested = self.headers.get("Range", "")
+        if requested.startswith("bytes="):
+            first, _, last = requested[len("bytes="):].partition("-")
+            start, end, status = int(first), int(last) + 1 if last else size, 206
+            if start >= size:
+                return self._send(416, b"", head)
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{int(os.path.getmtime(path))}-{size}"')
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        self.end_headers()
+        if head:
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(1024 * 1024, remaining))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        standin.count(end - start)
+
+    def _send(self, status, body, head):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+        self.server.standin.count(len(body))
+
+
+class SshStandIn:
+    """
+    SSH server accepting one client key, every host gets its own home directory and podman storage
+    """
+
+    def __init__(self, home, client_key, podman_bin, podman_env=None, host="127.0.0.1"):
+        self.home = home
+        self.client_key = client_key
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.env = dict(os.environ, HOME=home, FAKE_PODMAN_STATE=os.path.join(home, ".podman-state"),
+                        **(podman_env or {}))
+        self.env["PATH"] = f"{podman_bin}:{self.env.get('PATH', '')}"
+        os.makedirs(home, exist_ok=True)
+        # Login shells (bash -lc) reset PATH from /etc/profile, the profile restores it
+        with open(os.path.join(home, ".bash_profile"), "w") as f:
+            f.write(f"export PATH={shlex.quote(podman_bin)}:$PATH\n"
+                    f"export FAKE_PODMAN_STATE={shlex.quote(self.env['FAKE_PODMAN_STATE'])}\n")
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(16)
+        self.address = f"{host}:{self.sock.getsockname()[1]}"
+        self.commands = 0
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _addr = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _LocalSFTPServer)
+            transport.start_server(server=_SshServer(self))
+
+
+class _SshServer(paramiko.ServerInterface):
+
+    def __init__(self, standin):
+        self.standin = standin
+
+    def check_auth_publickey(self, username, key):
+        if key == self.standin.client_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.standin.commands += 1
+        threading.Thread(target=_execute, args=(channel, command.decode(), self.standin), daemon=True).start()
+        return True
+
+
+def _execute(channel, command, standin):
+    """Runs command, pumping channel input into it and its output back to the channel"""
+    process = subprocess.Popen(["bash", "-c", command], cwd=standin.home, env=standin.env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def pump_stdin():
+        try:
+            while True:
+                data = channel.recv(1024 * 1024)
+                if not data:
+                    break
+                process.stdin.write(data)
+                # Interactive commands (podman system dial-stdio) wait for every request
+                process.stdin.flush()
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    def pump(stream, send):
+        for data in iter(lambda: stream.read1(1024 * 1024), b""):
+            send(data)
+
+    threads = [threading.Thread(target=pump_stdin, daemon=True),
+               threading.Thread(target=pump, args=(process.stdout, channel.sendall)),
+               threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr))]
+    for thread in threads:
+        thread.start()
+    for thread in threads[1:]:
+        thread.join()
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+
+class _LocalSFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+
+class _LocalSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server backed by the local filesystem, paths are used as they are"""
+
+    def _fail(self, err):
+        return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def canonicalize(self, path):
+        return os.path.normpath(path if os.path.isabs(path) else os.path.join(os.getcwd(), path))
+
+    def list_folder(self, path):
+        try:
+            result = []
+            for name in os.listdir(path):
+                attributes = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attributes.filename = name
+                result.append(attributes)
+            return result
+        except OSError as err:
+            return self._fail(err)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as err:
+            return self._fail(err)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as err:
+            return self._fail(err)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, getattr(attr, "st_mode", None) or 0o644)
+        except OSError as err:
+            return self._fail(err)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as err:
+            return self._fail(err)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as err:
+            return self._fail(err)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as err:
+            return self._fail(err)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as err:
+            return self._fail(err)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_mode is not None:
+                os.chmod(path, stat.S_IMODE(attr.st_mode))
+        except OSError as err:
+            return self._fail(err)
+        return paramiko.SFTP_OK
@@ -8,10 +8,34 @@ BUNDLE = None
 NO_BREW = None
 SSH_USER = None
 SSH_KEY = None
+CACHE_DIR = None
+CACHE_MAX_SIZE_GB = 10
+DOWNLOAD_SEGMENTS = 1
+GITHUB_API_URL = "https://api.github.com"
+COMMAND_TIMEOUT = None
+SCHEDULER_LIMITS = {}
+BUILD_INDEX_DIR = None
+BUILD_INDEX_TTL_HOURS = 24
+MIRROR_DIR = None
+MIRROR_MAX_SIZE_GB = 50
+MIRROR_LISTEN = "127.0.0.1:5000"
+MIRROR_ADDRESS = None
+MIRROR_INSECURE_UPSTREAMS = []
+PODMAN_SOCKET = None
+TRANSFER_STREAMS = 4
+BANDWIDTH_LIMIT_MBPS = None
+DEPLOY_DEADLINE = None
+STEP_TIMEOUTS = {}
+RETRIES = {}
+HEDGE_AFTER = None
+PULL_ALTERNATES = {}
 
 def set_config(config):
     """Loads config from JSON file and assigns constants"""
-    global VERSION, BUILD, MISC_DOWNSTREAM_PATH, EXTRACT_BINARY, GET_IMAGES_OUTPUT, BUNDLE, NO_BREW, SSH_USER, SSH_KEY
+    global VERSION, BUILD, MISC_DOWNSTREAM_PATH, EXTRACT_BINARY, GET_IMAGES_OUTPUT, BUNDLE, NO_BREW, SSH_USER, SSH_KEY, CACHE_DIR, CACHE_MAX_SIZE_GB, \
+        DOWNLOAD_SEGMENTS, GITHUB_API_URL, COMMAND_TIMEOUT, SCHEDULER_LIMITS, BUILD_INDEX_DIR, BUILD_INDEX_TTL_HOURS, \
+        MIRROR_DIR, MIRROR_MAX_SIZE_GB, MIRROR_LISTEN, MIRROR_ADDRESS, MIRROR_INSECURE_UPSTREAMS, PODMAN_SOCKET, \
+        TRANSFER_STREAMS, BANDWIDTH_LIMIT_MBPS, DEPLOY_DEADLINE, STEP_TIMEOUTS, RETRIES, HEDGE_AFTER, PULL_ALTERNATES
 
     MISC_DOWNSTREAM_PATH = config["misc_downstream_path"]
     EXTRACT_BINARY = config["extract_binary"]
@@ -20,6 +44,27 @@ def set_config(config):
     NO_BREW = config["no_brew"]
     SSH_USER = config["ssh_user"]
     SSH_KEY = config["ssh_key"]
+    CACHE_DIR = config.get("cache_dir", CACHE_DIR)
+    CACHE_MAX_SIZE_GB = config.get("cache_max_size_gb", CACHE_MAX_SIZE_GB)
+    DOWNLOAD_SEGMENTS = config.get("download_segments", DOWNLOAD_SEGMENTS)
+    GITHUB_API_URL = config.get("github_api_url", GITHUB_API_URL)
+    COMMAND_TIMEOUT = config.get("command_timeout", COMMAND_TIMEOUT)
+    SCHEDULER_LIMITS = config.get("scheduler_limits", SCHEDULER_LIMITS)
+    BUILD_INDEX_DIR = config.get("build_index_dir", BUILD_INDEX_DIR)
+    BUILD_INDEX_TTL_HOURS = config.get("build_index_ttl_hours", BUILD_INDEX_TTL_HOURS)
+    MIRROR_DIR = config.get("mirror_dir", MIRROR_DIR)
+    MIRROR_MAX_SIZE_GB = config.get("mirror_max_size_gb", MIRROR_MAX_SIZE_GB)
+    MIRROR_LISTEN = config.get("mirror_listen", MIRROR_LISTEN)
+    MIRROR_ADDRESS = config.get("mirror_address", MIRROR_ADDRESS)
+    MIRROR_INSECURE_UPSTREAMS = config.get("mirror_insecure_upstreams", MIRROR_INSECURE_UPSTREAMS)
+    PODMAN_SOCKET = config.get("podman_socket", PODMAN_SOCKET)
+    TRANSFER_STREAMS = config.get("transfer_streams", TRANSFER_STREAMS)
+    BANDWIDTH_LIMIT_MBPS = config.get("bandwidth_limit_mbps", BANDWIDTH_LIMIT_MBPS)
+    DEPLOY_DEADLINE = config.get("deploy_deadline", DEPLOY_DEADLINE)
+    STEP_TIMEOUTS = config.get("step_timeouts", STEP_TIMEOUTS)
+    RETRIES = config.get("retries", RETRIES)
+    HEDGE_AFTER = config.get("hedge_after", HEDGE_AFTER)
+    PULL_ALTERNATES = config.get("pull_alternates", PULL_ALTERNATES)
 
 def validate_config():
     """Ensures that required configuration variables are set."""
@@ -0,0 +1,384 @@
+#!/usr/bin/python
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from config import set_config
+from install_cli import deploy, get_parser
+from multi_host_deployment import parse_hosts
+from utils.build_index import get_build_index, get_build_key
+from utils.const import repositories
+from utils.mirror import start_mirror
+from utils.podman import set_podman_backend, set_pull_backend
+from utils.remote import ConnectionPool, set_connection_pool
+from utils.throttle import set_bandwidth_limit
+
+CONFIG_FILE = "config.json"
+# install_cli.py options which apply to the whole service, set by its own arguments
+SERVICE_OPTIONS = ("trace_file", "trace_format", "podman_backend", "pull_backend", "registry_mirror")
+UPSTREAM_REGISTRY = "quay.io"
+BUNDLE_REGISTRY = "brew.registry.redhat.io"
+# Finished jobs kept for status queries, latencies of the same number of last jobs are used for metrics
+MAX_FINISHED_JOBS = 1000
+# Seconds between checks for expired idle connections
+MAINTENANCE_INTERVAL = 30
+
+
+def load_config():
+    """Loads config from JSON-file."""
+    with open(CONFIG_FILE, "r") as f:
+        configuration = json.load(f)
+    set_config(configuration)
+
+
+def parse_job_args(body):
+    """
+    Parses deploy job arguments with the install_cli.py parser
+    :param body: Dict of install_cli.py options without leading dashes ({"mta_version": "7.3.0", "hosts": "..."},
+                 flags are set by true) or {"args": [...]} with command line arguments
+    :return: argparse.Namespace. Raises ValueError if the arguments are invalid
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Job must be a JSON object")
+    if "args" in body:
+        argv = [str(arg) for arg in body["args"]]
+    else:
+        argv = []
+        for key, value in body.items():
+            if value is True:
+                argv.append(f"--{key}")
+            elif value not in (None, False):
+                argv += [f"--{key}", str(value)]
+    parser = get_parser()
+
+    def error(message):
+        raise ValueError(message)
+
+    parser.error = error
+    args = parser.parse_args(argv)
+    defaults = parser.parse_args([])
+    service_options = [option for option in SERVICE_OPTIONS if getattr(args, option) != getattr(defaults, option)]
+    if service_options:
+        raise ValueError(f"Options {', '.join(service_options)} are set by the service, not by jobs")
+    return args
+
+
+def get_job_hosts(args):
+    """Returns addresses of hosts deployed by the job, "local" for local deployment"""
+    if args.hosts or args.inventory:
+        return [host["ip_address"] for host in parse_hosts(args.hosts, args.inventory, args.os, args.platform)]
+    return [args.ip_address or "local"]
+
+
+def get_job_registry(args):
+    """Returns registry the job pulls images from"""
+    if args.upstream or not (args.mta_version and args.build):
+        return UPSTREAM_REGISTRY
+    return repositories.get(args.build, BUNDLE_REGISTRY)
+
+
+class Job:
+    """Deploy job"""
+
+    def __init__(self, args):
+        self.id = uuid.uuid4().hex[:12]
+        self.args = args
+        self.hosts = get_job_hosts(args)
+        self.registry = get_job_registry(args)
+        self.status = "queued"
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        # Set by DELETE /jobs/<id>, kills running steps of the deployment
+        self.cancel = threading.Event()
+
+    def to_dict(self):
+        return {"id": self.id, "status": self.status, "error": self.error, "hosts": self.hosts,
+                "registry": self.registry, "version": self.args.mta_version, "build": self.args.build,
+                "upstream": bool(self.args.upstream), "submitted": self.submitted, "started": self.started,
+                "finished": self.finished,
+                "wait_seconds": (self.started or time.time()) - self.submitted,
+                "run_seconds": ((self.finished or time.time()) - self.started) if self.started else None}
+
+
+def percentiles(values):
+    """Returns p50, p95 and max of values, None if there are none"""
+    if not values:
+        return None
+    values = sorted(values)
+    return {"p50": values[int(round(0.5 * (len(values) - 1)))], "p95": values[int(round(0.95 * (len(values) - 1)))],
+            "max": values[-1], "count": len(values)}
+
+
+class JobQueue:
+    """
+    Queue of deploy jobs. A queued job starts as soon as it fits the limits: total number of running jobs,
+    running jobs per host and per registry. Jobs which don't fit don't block the jobs queued after them.
+    """
+
+    def __init__(self, max_jobs=4, per_host=1, per_registry=2, pool=None):
+        self.max_jobs = max_jobs
+        self.per_host = per_host
+        self.per_registry = per_registry
+        self.pool = pool
+        self.jobs = {}
+        self.queued = []
+        self.running = []
+        self.finished = []
+        self.counts = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0}
+        self.started = time.time()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, job):
+        with self._condition:
+            self.jobs[job.id] = job
+            self.queued.append(job)
+            self.counts["submitted"] += 1
+            self._condition.notify_all()
+        logging.info(f"Job {job.id} queued: hosts {', '.join(job.hosts)}, registry {job.registry}")
+        return job
+
+    def get(self, job_id):
+        with self._condition:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self._condition:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Cancels job: queued job is dropped, running one is stopped at its next step
+        :return: Job or None if it is unknown
+        """
+        with self._condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.done.is_set():
+                return job
+            job.cancel.set()
+            if job in self.queued:
+                self.queued.remove(job)
+                job.status, job.finished = "cancelled", time.time()
+                self._finish(job)
+                job.done.set()
+        logging.info(f"Job {job.id} cancelled")
+        return job
+
+    def _fits(self, job):
+        if len(self.running) >= self.max_jobs:
+            return False
+        if sum(1 for running in self.running if running.registry == job.registry) >= self.per_registry:
+            return False
+        return all(sum(1 for running in self.running if host in running.hosts) < self.per_host for host in job.hosts)
+
+    def _dispatch(self):
+        last_maintenance = time.monotonic()
+        while True:
+            with self._condition:
+                job = next((job for job in self.queued if self._fits(job)), None)
+                if job is None:
+                    self._condition.wait(MAINTENANCE_INTERVAL)
+                else:
+                    self.queued.remove(job)
+                    self.running.append(job)
+                    job.status = "running"
+                    job.started = time.time()
+            if job:
+                threading.Thread(target=self._run, args=(job,), daemon=True).start()
+            if self.pool and time.monotonic() - last_maintenance >= MAINTENANCE_INTERVAL:
+                self.pool.close_idle()
+                last_maintenance = time.monotonic()
+
+    def _run(self, job):
+        logging.info(f"Job {job.id} started after {job.started - job.submitted:.1f}s in queue")
+        try:
+            if job.args.refresh_build_index and job.args.mta_version and job.args.build:
+                build_index = get_build_index()
+                if build_index:
+                    build_index.invalidate(get_build_key(job.args.mta_version, job.args.build))
+            deploy(job.args, job.cancel)
+            status, error = "succeeded", None
+        except SystemExit as err:
+            status, error = "cancelled" if job.cancel.is_set() else "failed", str(err)
+            logging.error(f"Job {job.id} {status}: {error}")
+        except Exception as err:
+            status, error = "failed", f"{type(err).__name__}: {err}"
+            logging.exception(f"Job {job.id} failed")
+        with self._condition:
+            job.status, job.error, job.finished = status, error, time.time()
+            self.running.remove(job)
+            self._finish(job)
+        job.done.set()
+        logging.info(f"Job {job.id} {status} in {job.finished - job.started:.1f}s")
+
+    def _finish(self, job):
+        self.counts[job.status] += 1
+        self.finished.append(job)
+        if len(self.finished) > MAX_FINISHED_JOBS:
+            del self.jobs[self.finished.pop(0).id]
+        self._condition.notify_all()
+
+    def metrics(self):
+        """Returns queue depth, job counts, latency percentiles and connection pool stats"""
+        with self._condition:
+            # Jobs cancelled while queued never ran
+            finished = [job for job in self.finished if job.started]
+            metrics = {"queue_depth": len(self.queued), "running": len(self.running), **self.counts}
+        metrics.update(wait_seconds=percentiles([job.started - job.submitted for job in finished]),
+                       run_seconds=percentiles([job.finished - job.started for job in finished]),
+                       total_seconds=percentiles([job.finished - job.submitted for job in finished]),
+                       connections=self.pool.stats() if self.pool else None,
+                       uptime_seconds=time.time() - self.started)
+        return metrics
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, message_format, *args):
+        logging.debug("Deploy service: " + message_format, *args)
+
+    def address_string(self):
+        # Clients of unix socket have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def do_GET(self):
+        queue = self.server.queue
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        if parts == ["health"]:
+            return self._send(200, {"status": "ok"})
+        if parts == ["metrics"]:
+            return self._send(200, queue.metrics())
+        if parts == ["jobs"]:
+            return self._send(200, [job.to_dict() for job in queue.list()])
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = queue.get(parts[1])
+            if job is None:
+                return self._send(404, {"error": f"Unknown job {parts[1]}"})
+            wait = parse_qs(url.query).get("wait")
+            if wait:
+                try:
+                    seconds = float(wait[0])
+                except ValueError:
+                    seconds = None
+                if seconds is None or not 0 <= seconds < float("inf"):
+                    return self._send(400, {"error": f"Invalid wait: {wait[0]}, expected seconds"})
+                # Long poll, CI pipelines wait for the result with one request
+                job.done.wait(seconds)
+            return self._send(200, job.to_dict())
+        return self._send(404, {"error": f"Unknown path {url.path}"})
+
+    def do_DELETE(self):
+        parts = [part for part in urlparse(self.path).path.split("/") if part]
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        job = self.server.queue.cancel(parts[1])
+        if job is None:
+            return self._send(404, {"error": f"Unknown job {parts[1]}"})
+        return self._send(200, job.to_dict())
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            job = Job(parse_job_args(json.loads(self.rfile.read(length) or b"{}")))
+        except (ValueError, SystemExit) as err:
+            return self._send(400, {"error": str(err)})
+        self.server.queue.submit(job)
+        return self._send(202, job.to_dict())
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(queue, listen=None, socket_path=None):
+    """
+    Creates HTTP server of the service API
+    :param queue: JobQueue
+    :param listen: host:port to listen on
+    :param socket_path: Unix socket to listen on instead of TCP
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixHTTPServer(socket_path, _ServiceHandler)
+    else:
+        host, _, port = listen.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), _ServiceHandler)
+        server.daemon_threads = True
+    server.queue = queue
+    return server
+
+
+if __name__ == "__main__":
+    load_config()
+    parser = argparse.ArgumentParser(
+        description="Runs deployments as a service: deploy jobs are accepted over HTTP, queued and run with "
+                    "limits, SSH connections and caches stay warm between jobs.")
+    parser.add_argument('--listen', required=False, default="127.0.0.1:8700",
+                        help='Optional, address and port of the HTTP API (default: 127.0.0.1:8700)')
+    parser.add_argument('--socket', required=False,
+                        help='Optional, unix socket of the HTTP API, used instead of --listen')
+    parser.add_argument('--max_jobs', required=False, type=int, default=4,
+                        help='Optional, number of jobs running at once (default: 4)')
+    parser.add_argument('--jobs_per_host', required=False, type=int, default=1,
+                        help='Optional, number of running jobs deploying to the same host (default: 1)')
+    parser.add_argument('--jobs_per_registry', required=False, type=int, default=2,
+                        help='Optional, number of running jobs pulling from the same registry (default: 2)')
+    parser.add_argument('--bandwidth_mbps', required=False, type=float,
+                        help='Optional, total MB/s of downloads and uploads of all jobs (default: bandwidth_limit_mbps '
+                             'from config.json, no limit)')
+    parser.add_argument('--idle_timeout', required=False, type=int, default=600,
+                        help='Optional, seconds an unused SSH connection is kept open (default: 600)')
+    parser.add_argument('--podman_backend', required=False, choices=['cli', 'api'], default='cli',
+                        help='Optional, drive podman by its CLI (default) or by its REST API over the podman socket')
+    parser.add_argument('--pull_backend', required=False, choices=['podman', 'skopeo'], default='podman',
+                        help='Optional, bring images of all jobs to storage by podman pull and tag (default) or by skopeo copy straight to their final names')
+    parser.add_argument('--registry_mirror', required=False, action='store_true',
+                        help='Optional, pull images of all jobs through a registry mirror started by the service')
+
+    args = parser.parse_args()
+
+    if args.registry_mirror:
+        start_mirror()
+    set_podman_backend(args.podman_backend)
+    set_pull_backend(args.pull_backend)
+    if args.bandwidth_mbps:
+        set_bandwidth_limit(args.bandwidth_mbps)
+    pool = ConnectionPool(args.idle_timeout)
+    set_connection_pool(pool)
+    queue = JobQueue(args.max_jobs, args.jobs_per_host, args.jobs_per_registry, pool).start()
+    server = create_server(queue, args.listen, args.socket)
+    logging.info(f"Deploy service listening on {args.socket or args.listen}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close_idle(0)
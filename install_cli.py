@@ -2,9 +2,12 @@
 import argparse
 import json
 
+import config
 from config import set_config
-from local_deployment import run_local_deployment
-from remote_deployment import run_remote_deployment
+from utils.build_index import get_build_index, get_build_key
+from utils.podman import set_podman_backend, set_pull_backend
+from utils.policy import Deadline, deadline_scope
+from utils.trace import enable_tracing, write_trace
 from validate_arguments import ValidateArguments
 
 CONFIG_FILE = "config.json"
@@ -15,10 +18,70 @@ def load_config():
         configuration = json.load(f)
     set_config(configuration)
 
-if __name__ == "__main__":
-    load_config()
-    # config.validate_config()
+def deploy(args, cancel=None):
+    """
+    Runs multi-host, local or remote deployment depending on arguments
+    :param args: Parsed arguments, see get_parser
+    :param cancel: Optional threading.Event stopping the deployment when it is set
+    """
+    with deadline_scope(Deadline(args.deadline or config.DEPLOY_DEADLINE, cancel)):
+        _deploy(args)
 
+
+def _deploy(args):
+    # Deployment modules are imported by the branch which needs them: a local deployment doesn't load
+    # the SSH backend, --help and argument errors load neither
+    if args.hosts or args.inventory:
+        from multi_host_deployment import run_multi_host_deployment
+        run_multi_host_deployment({"version": args.mta_version,
+                                   "build": args.build,
+                                   "args_image_output_file": args.image_output_file,
+                                   "args_dependency_file": args.dependency_file,
+                                   "args_upstream": args.upstream,
+                                   "args_hosts": args.hosts,
+                                   "args_inventory": args.inventory,
+                                   "args_host_workers": args.host_workers,
+                                   "args_os": args.os,
+                                   "args_platform": args.platform,
+                                   "args_pull_workers": args.pull_workers,
+                                   "args_incremental": args.incremental,
+                                   "args_sync_images": args.sync_images,
+                                   "args_relay_images": args.relay_images,
+                                   "args_force_redeploy": args.force_redeploy
+                               })
+    elif not args.ip_address:
+        from local_deployment import run_local_deployment
+        run_local_deployment({"version": args.mta_version,
+                              "build": args.build,
+                              "args_image_output_file": args.image_output_file,
+                              "args_dependency_file": args.dependency_file,
+                              "args_upstream": args.upstream,
+                              "args_pull_workers": args.pull_workers,
+                              "args_incremental": args.incremental,
+                              "args_unpack_workers": args.unpack_workers,
+                              "args_sync_images": args.sync_images,
+                              "args_force_redeploy": args.force_redeploy
+                          })
+    else:
+        from remote_deployment import run_remote_deployment
+        run_remote_deployment({"version": args.mta_version,
+                               "build": args.build,
+                               "args_image_output_file": args.image_output_file,
+                               "args_dependency_file": args.dependency_file,
+                               "args_upstream": args.upstream,
+                               "args_ip_address": args.ip_address,
+                               "args_os": args.os,
+                               "args_platform": args.platform,
+                               "args_pull_workers": args.pull_workers,
+                               "args_incremental": args.incremental,
+                               "args_sync_images": args.sync_images,
+                               "args_relay_images": args.relay_images,
+                               "args_force_redeploy": args.force_redeploy
+                          })
+
+
+def get_parser():
+    """Returns parser of command line arguments, deploy_service.py parses arguments of its jobs with it too"""
     parser = argparse.ArgumentParser(
         description="Deploys and prepares MTA CLI either locally or remotely.")
     parser.add_argument('--mta_version', required=False, help="The MTA version to use.", action=ValidateArguments)
@@ -34,24 +97,65 @@ if __name__ == "__main__":
                         help='Optional, IP address of target server where MTA CLI will be deployed')
     parser.add_argument('--os', required=False, help='Optional for remote deployment, OS of remote host (windows/linux/darwin)')
     parser.add_argument('--platform', required=False, help='Optional for remote deployment, platform of remote host (amd64/arm64')
+    parser.add_argument('--hosts', required=False,
+                        help='Optional, comma separated list of remote hosts, each optionally with its os/platform: 10.0.0.1=linux/amd64,10.0.0.2')
+    parser.add_argument('--inventory', required=False,
+                        help='Optional, JSON file with list of remote hosts: [{"ip_address": "...", "os": "...", "platform": "..."}]')
+    parser.add_argument('--host_workers', required=False, type=int, default=4,
+                        help='Optional, number of hosts deployed concurrently in multi-host mode (default: 4)')
+    parser.add_argument('--incremental', required=False, action='store_true',
+                        help='Optional, unpack only dependencies which changed since the previous deployment')
+    parser.add_argument('--sync_images', required=False, action='store_true',
+                        help='Optional, keep images whose digest is already present and pull only missing ones')
+    parser.add_argument('--relay_images', required=False, action='store_true',
+                        help='Optional, pull images once on this machine and send remote hosts only the layers they miss')
+    parser.add_argument('--registry_mirror', required=False, action='store_true',
+                        help='Optional, pull images through a registry mirror started on this machine')
+    parser.add_argument('--unpack_workers', required=False, type=int, default=1,
+                        help='Optional, number of files extracted concurrently by local incremental unpack (default: 1)')
+    parser.add_argument('--pull_workers', required=False, type=int, default=1,
+                        help='Optional, number of images pulled concurrently (default: 1, sequential)')
+    parser.add_argument('--refresh_build_index', required=False, action='store_true',
+                        help='Optional, regenerate images list and dependency zips of the build even if they are in the build index')
+    parser.add_argument('--force_redeploy', required=False, action='store_true',
+                        help='Optional, ignore deployment state recorded on the target and deploy everything again')
+    parser.add_argument('--deadline', required=False, type=float,
+                        help='Optional, seconds after which the deployment is stopped, running steps are killed (default: deploy_deadline from config.json, no limit)')
+    parser.add_argument('--podman_backend', required=False, choices=['cli', 'api'], default='cli',
+                        help='Optional, drive podman by its CLI (default) or by its REST API over the podman socket')
+    parser.add_argument('--pull_backend', required=False, choices=['podman', 'skopeo'], default='podman',
+                        help='Optional, bring images to storage by podman pull and tag (default) or by skopeo copy straight to their final names, one batch per host')
+    parser.add_argument('--trace_file', '--trace-file', required=False,
+                        help='Optional, file where timing trace of all deployment phases and commands is written')
+    parser.add_argument('--trace_format', required=False, choices=['chrome', 'json'], default='chrome',
+                        help='Optional, format of the trace file: chrome (trace-event format, default) or json')
+
+    return parser
 
+
+if __name__ == "__main__":
+    load_config()
+    # config.validate_config()
+
+    parser = get_parser()
     args = parser.parse_args()
 
-    if not args.ip_address:
-        run_local_deployment({"version": args.mta_version,
-                              "build": args.build,
-                              "args_image_output_file": args.image_output_file,
-                              "args_dependency_file": args.dependency_file,
-                              "args_upstream": args.upstream
-                          })
-    else:
-        run_remote_deployment({"version": args.mta_version,
-                               "build": args.build,
-                               "args_image_output_file": args.image_output_file,
-                               "args_dependency_file": args.dependency_file,
-                               "args_upstream": args.upstream,
-                               "args_ip_address": args.ip_address,
-                               "args_os": args.os,
-                               "args_platform": args.platform
-                          })
+    if args.refresh_build_index and args.mta_version and args.build:
+        build_index = get_build_index()
+        if build_index:
+            build_index.invalidate(get_build_key(args.mta_version, args.build))
+
+    if args.registry_mirror:
+        from utils.mirror import start_mirror
+        start_mirror()
+
+    set_podman_backend(args.podman_backend)
+    set_pull_backend(args.pull_backend)
 
+    if args.trace_file:
+        enable_tracing()
+    try:
+        deploy(args)
+    finally:
+        if args.trace_file:
+            write_trace(args.trace_file, args.trace_format)
@@ -2,13 +2,26 @@ import logging
 import os
 
 import config
-from utils.images import remove_old_images, generate_images_list, pull_tag_images, pull_stage_ga_images
-from utils.utils import read_file, get_target_dependency_path, get_latest_upstream_dependency, download_file, \
+from utils.images import get_image_manifest, deploy_images, remove_old_images
+from utils.utils import get_target_dependency_path, get_latest_upstream_dependency, download_file, \
     pull_stage_ga_dependency_file, ensure_podman_running
+from utils.scheduler import Scheduler
+from utils.state import read_target_state, get_desired_state, make_plan, is_noop, describe_plan, write_state
+from utils.trace import span
 from utils.zip import generate_zip, get_zip_folder_name, get_zip_name, unpack_zip
 
 
 def run_local_deployment(data):
+    with span("local_deployment"):
+        _run_local_deployment(data)
+
+
+def _run_local_deployment(data):
+    """
+    Compares deployment state of the local host with the requested one and declares only the phases needed to
+    reconcile them as a dependency graph: image pulls, getting the dependency zip and its unpacking run as soon as
+    their inputs are ready instead of back to back
+    """
     version = data["version"]
     build = data["build"]
     if data["args_upstream"]:
@@ -17,37 +30,68 @@ def run_local_deployment(data):
         upstream = False
     image_output_file = data["args_image_output_file"]
     arg_dependency_file = data["args_dependency_file"]
-    ensure_podman_running()
+    pull_workers = data.get("args_pull_workers", 1)
+    sync = data.get("args_sync_images", False)
+    bundle = version and build and not upstream and build not in ("stage", "candidate", "ga")
+
+    image_list = get_image_manifest(version, build, image_output_file) if bundle else None
+    desired = get_desired_state(data, image_list)
+    plan = make_plan(read_target_state(), desired, data.get("args_force_redeploy", False))
+    if is_noop(plan):
+        logging.info("Local host is up to date, nothing to deploy")
+        return
+    logging.info(f"Deployment plan of local host: {describe_plan(plan)}")
+
+    scheduler = Scheduler(config.SCHEDULER_LIMITS, name="local deployment")
+    podman = scheduler.add("podman_check", ensure_podman_running)
+    removal = None
     if version and build and not upstream:
-        remove_old_images(version)
         logging.info(f"Deploying MTA Version: {version} {build}")
-        if build == "stage" or build == "candidate" or build == "ga":
-            pull_stage_ga_images(version, build)
-            full_zip_name = pull_stage_ga_dependency_file(version, build)
+        # Removal of old images must not race with pulls nor with the binary extraction
+        if plan["full_images"] and not sync:
+            removal = scheduler.add("remove_old_images", lambda: remove_old_images(version), [podman])
+        if plan["images"]:
+            targets = None if plan["full_images"] else plan["images"]
+            scheduler.add("images", lambda: deploy_images(version, build, image_list, workers=pull_workers, sync=sync,
+                                                          remove_old=False, targets=targets),
+                          [podman, removal], "registry")
+    zip_task = None
+    if plan["dependencies"]:
+        if arg_dependency_file:
+            logging.info(f"Using existing dependencies zip: {arg_dependency_file}")
+            zip_task = scheduler.add("dependency_zip", lambda: arg_dependency_file)
+        elif not (version and build) or upstream:
+            print("Deploying Kantra latest")
+            zip_task = scheduler.add("dependency_zip", download_upstream_zip, resource="network")
+        elif not bundle:
+            zip_task = scheduler.add("dependency_zip", lambda: pull_stage_ga_dependency_file(version, build),
+                                     resource="network")
         else:
-            if not image_output_file:
-                logging.info(f"Generating images list for {version}-{build}")
-                image_list, stdout_err = generate_images_list(version, build)
-            else:
-                logging.info(f"Using images list provided as CLI argument: {image_output_file}")
-                image_list = read_file(image_output_file)
-            pull_tag_images(version, image_list)
-            if not arg_dependency_file:
-                logging.info(f"Generating dependencies zip for {version}-{build}")
-                generate_zip(version, build)
-                zip_folder_name = get_zip_folder_name(image_list)
-                zip_name = get_zip_name(zip_folder_name.split("-")[1])
-                full_zip_name = os.path.join(config.MISC_DOWNSTREAM_PATH, zip_folder_name, zip_name)
-                logging.info (f"Using generated zip dependency file: {full_zip_name}")
-            else:
-                full_zip_name=arg_dependency_file
-                logging.info(f"Using existing dependencies zip: {full_zip_name}")
-    else:
-        print("Deploying Kantra latest")
-        if not arg_dependency_file:
-            full_zip_name = get_zip_name()
-            url = get_latest_upstream_dependency('konveyor', 'kantra', full_zip_name)
-            logging.info(f"Downloading dependencies zip for upstream")
-            download_file(url, full_zip_name)
-    unpack_zip(full_zip_name, get_target_dependency_path())
+            zip_task = scheduler.add("dependency_zip", lambda: generate_dependency_zip(version, build, image_list),
+                                     [podman, removal], "registry")
+        scheduler.add("unpack", lambda: unpack_zip(scheduler.result(zip_task), get_target_dependency_path(),
+                                                   incremental=data.get("args_incremental", False),
+                                                   workers=data.get("args_unpack_workers", 1)),
+                      [zip_task], "disk")
+    scheduler.run()
+    write_state(desired, scheduler.result(zip_task) if zip_task else None)
+
+
+def generate_dependency_zip(version, build, image_list):
+    """Generates dependencies zip of the bundle and returns its path"""
+    logging.info(f"Generating dependencies zip for {version}-{build}")
+    generate_zip(version, build, image_list)
+    zip_folder_name = get_zip_folder_name(image_list)
+    zip_name = get_zip_name(zip_folder_name.split("-")[1])
+    full_zip_name = os.path.join(config.MISC_DOWNSTREAM_PATH, zip_folder_name, zip_name)
+    logging.info (f"Using generated zip dependency file: {full_zip_name}")
+    return full_zip_name
+
 
+def download_upstream_zip():
+    """Downloads latest upstream dependencies zip and returns its path"""
+    full_zip_name = get_zip_name()
+    url = get_latest_upstream_dependency('konveyor', 'kantra', full_zip_name)
+    logging.info(f"Downloading dependencies zip for upstream")
+    download_file(url, full_zip_name)
+    return full_zip_name
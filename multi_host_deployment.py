@@ -0,0 +1,133 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.policy import carry
+from utils.state import is_noop
+from utils.trace import span
+from remote_deployment import prepare_remote_artifacts, deploy_to_host, cleanup_remote_artifacts, \
+    get_remote_image_list, plan_host
+
+
+def parse_hosts(hosts=None, inventory_file=None, default_os=None, default_platform=None):
+    """
+    Builds list of target hosts from CLI list and/or inventory file
+    :param hosts: Comma separated list of hosts, each host can define its os and platform: 10.0.0.1=linux/amd64
+    :param inventory_file: JSON file with list of hosts: [{"ip_address": "10.0.0.1", "os": "linux", "platform": "amd64"}]
+    :param default_os: OS used for hosts which don't define it
+    :param default_platform: Platform used for hosts which don't define it
+    :return: List of dicts with ip_address, os and platform
+    """
+    targets = []
+    if hosts:
+        for item in hosts.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            ip_address, _, os_platform = item.partition("=")
+            host_os, _, host_platform = os_platform.partition("/")
+            targets.append({"ip_address": ip_address,
+                            "os": host_os or default_os,
+                            "platform": host_platform or default_platform})
+    if inventory_file:
+        try:
+            with open(inventory_file, "r") as f:
+                inventory = json.load(f)
+        except Exception as err:
+            raise SystemExit(f"There was an error reading inventory file: {err}")
+        for host in inventory:
+            if "ip_address" not in host:
+                raise SystemExit(f"Inventory entry has no ip_address: {host}")
+            targets.append({"ip_address": host["ip_address"],
+                            "os": host.get("os") or default_os,
+                            "platform": host.get("platform") or default_platform})
+    if not targets:
+        raise SystemExit("No hosts to deploy to")
+    return targets
+
+
+def run_multi_host_deployment(data):
+    """
+    Deploys MTA CLI to many remote hosts at once. Hosts are planned concurrently, shared artifacts
+    (images list, dependency zips) needed by hosts which are not up to date are computed once, then these hosts
+    are deployed concurrently using bounded worker pool.
+    :param data: Deployment arguments, see install_cli.py
+    :return: List of per-host results
+    """
+    targets = parse_hosts(data["args_hosts"], data["args_inventory"], data["args_os"], data["args_platform"])
+    workers = max(1, min(int(data.get("args_host_workers") or 1), len(targets)))
+
+    with span("multi_host_deployment", hosts=len(targets)):
+        return _run_multi_host_deployment(data, targets, workers)
+
+
+def _run_multi_host_deployment(data, targets, workers):
+    start = time.monotonic()
+    results = {host["ip_address"]: {"ip_address": host["ip_address"], "status": "ok", "duration": 0.0, "error": None}
+               for host in targets}
+    image_list = get_remote_image_list(data)
+
+    def plan(host):
+        try:
+            return plan_host(data, host["ip_address"], image_list, host["os"], host["platform"])
+        except (SystemExit, Exception) as err:
+            fail(host, err)
+            return None
+
+    def fail(host, err):
+        results[host["ip_address"]].update(status="failed", error=str(err))
+        logging.error(f"Deployment to {host['ip_address']} failed: {err}")
+
+    # Hosts are planned first, so only artifacts needed by at least one host are prepared
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        planned = [(host, planned_host) for host, planned_host in zip(targets, executor.map(carry(plan), targets))
+                   if planned_host]
+    try:
+        pending = [(host, planned_host) for host, planned_host in planned if not is_noop(planned_host["plan"])]
+        logging.info(f"Hosts planned in {time.monotonic() - start:.1f}s: {len(pending)} of {len(targets)} "
+                     f"hosts need deployment")
+        if pending:
+            images = set()
+            for _host, planned_host in pending:
+                images.update(planned_host["plan"]["images"])
+            artifacts = prepare_remote_artifacts(data, [(host["os"], host["platform"]) for host, planned_host in pending
+                                                        if planned_host["plan"]["dependencies"]], image_list, images)
+            logging.info(f"Shared artifacts prepared in {time.monotonic() - start:.1f}s, "
+                         f"deploying to {len(pending)} hosts using {workers} workers")
+
+            def deploy(item):
+                host, planned_host = item
+                host_start = time.monotonic()
+                try:
+                    deploy_to_host(data, host["ip_address"], artifacts, host["os"], host["platform"], planned_host)
+                except (SystemExit, Exception) as err:
+                    fail(host, err)
+                results[host["ip_address"]]["duration"] = time.monotonic() - host_start
+
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(carry(deploy), pending))
+            finally:
+                cleanup_remote_artifacts(artifacts)
+    finally:
+        for _host, planned_host in planned:
+            planned_host["client"].close()
+
+    results = list(results.values())
+    print_summary(results, time.monotonic() - start)
+    failed = [result for result in results if result["status"] != "ok"]
+    if failed:
+        raise SystemExit(f"Deployment failed on {len(failed)} of {len(results)} hosts")
+    return results
+
+
+def print_summary(results, total_duration):
+    """Prints per-host deployment summary"""
+    print("Deployment summary:")
+    for result in results:
+        line = f"  {result['ip_address']:<20} {result['status']:<7} {result['duration']:8.1f}s"
+        if result["error"]:
+            line += f"  {result['error'].splitlines()[0]}"
+        print(line)
+    print(f"Total time: {total_duration:.1f}s")
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+import argparse
+import json
+
+from config import set_config
+from multi_host_deployment import parse_hosts
+from utils.prefetch import parse_platforms, prefetch_dependencies
+from validate_arguments import ValidateArguments
+
+CONFIG_FILE = "config.json"
+
+def load_config():
+    """Loads config from JSON-file."""
+    with open(CONFIG_FILE, "r") as f:
+        configuration = json.load(f)
+    set_config(configuration)
+
+
+def prefetch(data):
+    """Downloads dependency zips of all platforms of the fleet into the artifact cache before deployments start"""
+    targets = parse_platforms(data["args_platforms"])
+    if data["args_hosts"] or data["args_inventory"]:
+        targets += [(host["os"], host["platform"]) for host in
+                    parse_hosts(data["args_hosts"], data["args_inventory"], data["args_os"], data["args_platform"])]
+    if not targets:
+        targets = [(data["args_os"], data["args_platform"])]
+    zips = prefetch_dependencies(data["version"], data["build"], bool(data["args_upstream"]), targets,
+                                 data["args_workers"])
+    for (host_os, host_platform), zip_name in sorted(zips.items(), key=lambda item: str(item[0])):
+        print(f"  {host_os or 'local'}/{host_platform or 'local'}: {zip_name}")
+
+
+if __name__ == "__main__":
+    load_config()
+    parser = argparse.ArgumentParser(
+        description="Prefetches dependency zips of all platforms of a fleet concurrently, deployments then read them from the artifact cache.")
+    parser.add_argument('--mta_version', required=False, help="The MTA version to use.", action=ValidateArguments)
+    parser.add_argument('--build', required=False, help="stage, candidate or ga", action=ValidateArguments)
+    parser.add_argument('--upstream', required=False,
+                        help='Optional, prefetches latest upstream zips instead of downstream', action=ValidateArguments)
+    parser.add_argument('--platforms', required=False,
+                        help='Optional, comma separated os/platform pairs (linux/amd64,darwin/arm64) or "all"')
+    parser.add_argument('--hosts', required=False,
+                        help='Optional, hosts in the format of install_cli.py --hosts, their platforms are prefetched')
+    parser.add_argument('--inventory', required=False,
+                        help='Optional, inventory file in the format of install_cli.py --inventory')
+    parser.add_argument('--os', required=False, help='Optional, OS of hosts which don\'t define it')
+    parser.add_argument('--platform', required=False, help='Optional, platform of hosts which don\'t define it')
+    parser.add_argument('--workers', required=False, type=int, default=4,
+                        help='Optional, number of concurrent downloads (default: 4)')
+
+    args = parser.parse_args()
+    prefetch({"version": args.mta_version,
+              "build": args.build,
+              "args_upstream": args.upstream,
+              "args_platforms": args.platforms,
+              "args_hosts": args.hosts,
+              "args_inventory": args.inventory,
+              "args_os": args.os,
+              "args_platform": args.platform,
+              "args_workers": args.workers})
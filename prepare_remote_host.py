@@ -1,12 +1,17 @@
 #!/usr/bin/python
 import argparse
 import json
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from config import set_config
+from utils.testing_repo import get_wheelhouse, refresh_checkout, install_requirements
 from utils.utils import connect_ssh, run_command, get_repo_folder_name, get_home_dir, write_env_file
 
 CONFIG_FILE = "config.json"
+TESTING_REPO = "https://github.com/konveyor/kantra-cli-tests"
 
 def load_config():
     """Loads config from JSON-file."""
@@ -15,16 +20,60 @@ def load_config():
     set_config(configuration)
 
 
-def prepare_host(data):
-    ip_address = data["args_ip_address"]
-    host_os = data["args_os"]
+def prepare_hosts(data):
+    """
+    Prepares testing repo on all hosts concurrently. In incremental mode the wheelhouse of its requirements
+    is built once on the controller before the hosts are prepared.
+    :param data: Arguments, see __main__
+    :return: List of per-host results
+    """
+    hosts = [host.strip() for item in data["args_ip_address"] for host in item.split(",") if host.strip()]
+    if not hosts:
+        raise SystemExit("No hosts to prepare, use --ip_address")
+    start = time.monotonic()
+    wheelhouse = get_wheelhouse(TESTING_REPO) if data["args_incremental"] else None
+    workers = max(1, min(int(data["args_host_workers"] or 1), len(hosts)))
 
+    def prepare(ip_address):
+        result = {"ip_address": ip_address, "status": "ok", "duration": 0.0, "error": None}
+        host_start = time.monotonic()
+        try:
+            prepare_host(ip_address, data["args_os"], wheelhouse)
+        except (SystemExit, Exception) as err:
+            result.update(status="failed", error=str(err))
+            logging.error(f"Preparation of {ip_address} failed: {err}")
+        result["duration"] = time.monotonic() - host_start
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(prepare, hosts))
+    from multi_host_deployment import print_summary
+    print_summary(results, time.monotonic() - start)
+    failed = [result for result in results if result["status"] != "ok"]
+    if failed:
+        raise SystemExit(f"Preparation failed on {len(failed)} of {len(results)} hosts")
+    return results
+
+
+def prepare_host(ip_address, host_os, wheelhouse=None):
+    """
+    Prepares testing repo on one host
+    :param ip_address: Host address
+    :param host_os: OS of the host
+    :param wheelhouse: Wheelhouse built by get_wheelhouse for incremental preparation, None for a fresh clone
+    """
     try:
         client = connect_ssh(ip_address)
     except Exception as err:
         raise SystemExit("There was an issue connecting to remote host: {}".format(err))
 
-    prepare_testing_repo("https://github.com/konveyor/kantra-cli-tests", host_os, client=client)
+    try:
+        if wheelhouse:
+            prepare_testing_repo_incremental(TESTING_REPO, wheelhouse, host_os, client=client)
+        else:
+            prepare_testing_repo(TESTING_REPO, host_os, client=client)
+    finally:
+        client.close()
 
 
 def prepare_testing_repo(repo="", host_os="", client=None):
@@ -32,11 +81,26 @@ def prepare_testing_repo(repo="", host_os="", client=None):
     run_command(f"rm -rf {repo_folder_name}", client=client)
     run_command(f"git clone --recurse-submodules {repo} ", client=client)
     run_command(f"cd {repo_folder_name}; pip3 install -r requirements.txt", client=client)
+    write_testing_env_file(repo_folder_name, host_os, client=client)
+
+
+def prepare_testing_repo_incremental(repo, wheelhouse, host_os="", client=None):
+    """
+    Updates existing checkout (or clones it shallow) and installs requirements from the wheelhouse
+    unless they are installed already
+    """
+    state = refresh_checkout(repo, client)
+    install_requirements(repo, wheelhouse, state, client)
+    write_testing_env_file(get_repo_folder_name(repo), host_os, client=client)
+
+
+def write_testing_env_file(repo_folder_name, host_os, client=None):
     home_dir = get_home_dir(client=client)
     env_file=assemble_env_file(home_dir, repo_folder_name, host_os)
 
     write_env_file(os.path.join(home_dir, repo_folder_name, '.env'), env_file, client=client)
 
+
 def assemble_env_file(user_home, repo_folder_name, os_type):
     def get(key, default=""):
         return os.environ.get(key) or default
@@ -58,10 +122,18 @@ if __name__ == "__main__":
     load_config()
     parser = argparse.ArgumentParser(
         description="Deploys and prepares MTA CLI either locally or remotely.")
-    parser.add_argument('--ip_address', required=False,
-                        help='Optional, IP address of target server where MTA CLI will be deployed')
+    parser.add_argument('--ip_address', required=False, action="append", default=[],
+                        help='Optional, IP address of target server where MTA CLI will be deployed, '
+                             'can be repeated or comma separated to prepare many hosts at once')
     parser.add_argument('--os', required=False, help='Optional for remote deployment, OS of remote host (windows/linux/darwin)')
+    parser.add_argument('--incremental', action="store_true",
+                        help='Optional, update existing checkout instead of cloning again and install requirements '
+                             'from a wheelhouse built on this machine, only when they changed')
+    parser.add_argument('--host_workers', required=False, type=int, default=4,
+                        help='Optional, number of hosts prepared concurrently (default: 4)')
 
     args = parser.parse_args()
-    prepare_host({"args_ip_address": args.ip_address,
-                  "args_os": args.os})
+    prepare_hosts({"args_ip_address": args.ip_address,
+                   "args_os": args.os,
+                   "args_incremental": args.incremental,
+                   "args_host_workers": args.host_workers})
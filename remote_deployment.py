@@ -2,56 +2,192 @@ import logging
 import os
 
 import config
-from utils.images import remove_old_images, generate_images_list, pull_tag_images, pull_stage_ga_images
-from utils.utils import connect_ssh, read_file, get_target_dependency_path, ensure_podman_running, \
-    pull_stage_ga_dependency_file
+from utils.images import get_image_manifest, deploy_images, get_image_jobs, get_job_target, sync_images, \
+    run_image_jobs
+from utils.prefetch import prefetch_dependencies
+from utils.utils import connect_ssh, get_target_dependency_path, ensure_podman_running
+from utils.relay import save_images, relay_images, remove_archives
+from utils.state import read_target_state, get_desired_state, make_plan, is_noop, describe_plan, write_state
+from utils.trace import host_context, span
 from utils.zip import generate_zip, get_zip_folder_name, get_zip_name, unpack_zip
 
 
 def run_remote_deployment(data):
-    version = data["version"]
-    build = data["build"]
-    image_output_file = data["args_image_output_file"]
-    arg_dependency_file = data["args_dependency_file"]
-    ip_address = data["args_ip_address"]
     host_os = data["args_os"]
     host_platform = data["args_platform"]
 
-    if data["args_upstream"]:
-        upstream = True
-    else:
-        upstream = False
-
+    image_list = get_remote_image_list(data)
+    host = plan_host(data, data["args_ip_address"], image_list, host_os, host_platform)
     try:
-        client = connect_ssh(ip_address)
-    except Exception as err:
-        raise SystemExit("There was an issue connecting to remote host: {}".format(err))
+        if is_noop(host["plan"]):
+            return
+        plan = host["plan"]
+        artifacts = prepare_remote_artifacts(data, [(host_os, host_platform)] if plan["dependencies"] else [],
+                                             image_list, plan["images"])
+        try:
+            deploy_to_host(data, data["args_ip_address"], artifacts, host_os, host_platform, host)
+        finally:
+            cleanup_remote_artifacts(artifacts)
+    finally:
+        host["client"].close()
+
+
+def get_remote_image_list(data):
+    """Returns images list of bundle builds (ImageManifest), None for stage/ga/upstream"""
+    version = data["version"]
+    build = data["build"]
+    if version and build and not data["args_upstream"] and build not in ("stage", "candidate", "ga"):
+        return get_image_manifest(version, build, data["args_image_output_file"])
+    return None
+
+
+def plan_host(data, ip_address, image_list=None, host_os=None, host_platform=None):
+    """
+    Connects to remote host and plans its deployment: deployment state, host facts, present images and dependencies
+    are read by one command and compared with the desired state
+    :param data: Deployment arguments
+    :param ip_address: Address of the remote host
+    :param image_list: ImageManifest of bundle builds
+    :param host_os: OS of the remote host
+    :param host_platform: Platform of the remote host
+    :return: Dict with client (open connection, closed by the caller), desired state and plan
+    """
+    with host_context(ip_address), span("host_plan") as attrs:
+        try:
+            client = connect_ssh(ip_address)
+        except Exception as err:
+            raise SystemExit("There was an issue connecting to remote host: {}".format(err))
+        try:
+            desired = get_desired_state(data, image_list, host_os, host_platform)
+            plan = make_plan(read_target_state(client), desired, data.get("args_force_redeploy", False))
+        except BaseException:
+            client.close()
+            raise
+        finally:
+            attrs["round_trips"] = client.round_trips
+        if is_noop(plan):
+            logging.info(f"Host {ip_address} is up to date, nothing to deploy")
+        else:
+            logging.info(f"Deployment plan of {ip_address}: {describe_plan(plan)}")
+        return {"client": client, "desired": desired, "plan": plan}
 
-    ensure_podman_running(client=client)
-    if version and build and not upstream:
-        remove_old_images(version, client=client)
 
+def prepare_remote_artifacts(data, targets, image_list=None, images=None):
+    """
+    Computes artifacts which are shared by all remote hosts: images list and dependency zips.
+    Every artifact is generated or downloaded only once, no matter how many hosts will use it.
+    :param data: Deployment arguments
+    :param targets: List of (os, platform) tuples of hosts whose dependencies are deployed
+    :param image_list: ImageManifest of bundle builds, it is resolved here if not given
+    :param images: Names of images deployed to at least one host, only these are relayed. All images if None
+    :return: Dict with image_list (ImageManifest, None for stage/ga/upstream), zips mapping (os, platform) to zip path
+             and relay_archives mapping image name to its archive when images are relayed
+    """
+    with span("shared_artifacts"):
+        return _prepare_remote_artifacts(data, targets, image_list, images)
+
+
+def _prepare_remote_artifacts(data, targets, image_list, images):
+    version = data["version"]
+    build = data["build"]
+    image_output_file = data["args_image_output_file"]
+    arg_dependency_file = data["args_dependency_file"]
+    upstream = bool(data["args_upstream"])
+    targets = list(dict.fromkeys(targets))
+    artifacts = {"image_list": image_list, "zips": {}, "relay_archives": None}
+
+    if version and build and not upstream:
         if build == "stage" or build == "candidate" or build == "ga":
-            pull_stage_ga_images(version, build, client=client)
-            full_zip_name = pull_stage_ga_dependency_file(version, build, host_os, host_platform)
+            if not arg_dependency_file and targets:
+                artifacts["zips"] = prefetch_dependencies(version, build, upstream, targets)
         else:
-            if not image_output_file:
-                logging.info(f"Generating images list for {version}-{build}")
-                image_list, stdout_err = generate_images_list(version, build)
-            else:
-                logging.info(f"Using images list provided as CLI argument: {image_output_file}")
-                image_list = read_file(image_output_file)
-            pull_tag_images(version, image_list, client)
-            if not arg_dependency_file:
+            if image_list is None:
+                image_list = get_image_manifest(version, build, image_output_file)
+                artifacts["image_list"] = image_list
+            if not arg_dependency_file and targets:
                 logging.info(f"Generating dependencies zip for {version}-{build}")
-                generate_zip(version, build)
+                generate_zip(version, build, image_list)
                 zip_folder_name = get_zip_folder_name(image_list)
-                zip_name = get_zip_name(zip_folder_name.split("-")[1], host_os, host_platform )
-                full_zip_name = os.path.join(config.MISC_DOWNSTREAM_PATH, zip_folder_name, zip_name)
-                logging.info(f"Using generated zip dependency file: {full_zip_name}")
-            else:
-                full_zip_name = arg_dependency_file
-                logging.info(f"Using existing dependencies zip: {full_zip_name}")
-
-    unpack_zip(full_zip_name, get_target_dependency_path(client), client)
-    client.close()
\ No newline at end of file
+                for host_os, host_platform in targets:
+                    zip_name = get_zip_name(zip_folder_name.split("-")[1], host_os, host_platform)
+                    full_zip_name = os.path.join(config.MISC_DOWNSTREAM_PATH, zip_folder_name, zip_name)
+                    logging.info(f"Using generated zip dependency file: {full_zip_name}")
+                    artifacts["zips"][(host_os, host_platform)] = full_zip_name
+    elif not arg_dependency_file and targets:
+        logging.info("Deploying Kantra latest")
+        artifacts["zips"] = prefetch_dependencies(version, build, upstream, targets)
+
+    if arg_dependency_file:
+        logging.info(f"Using existing dependencies zip: {arg_dependency_file}")
+        for target in targets:
+            artifacts["zips"][target] = arg_dependency_file
+
+    if data.get("args_relay_images") and version and build and not upstream and (images is None or images):
+        # Images are pulled once on the controller and relayed to every host
+        logging.info("Pulling images on controller to relay them to remote hosts")
+        ensure_podman_running()
+        jobs = get_image_jobs(version, build, artifacts["image_list"])
+        if images is not None:
+            jobs = [job for job in jobs if get_job_target(job) in images]
+        if data.get("args_sync_images"):
+            sync_images(jobs, workers=data.get("args_pull_workers", 1))
+        else:
+            run_image_jobs(jobs, workers=data.get("args_pull_workers", 1))
+        artifacts["relay_archives"] = save_images([get_job_target(job) for job in jobs])
+
+    return artifacts
+
+
+def cleanup_remote_artifacts(artifacts):
+    """Removes temporary artifacts created by prepare_remote_artifacts"""
+    if artifacts["relay_archives"]:
+        remove_archives(artifacts["relay_archives"])
+
+
+def deploy_to_host(data, ip_address, artifacts, host_os=None, host_platform=None, host=None):
+    """
+    Deploys MTA CLI to a single remote host using artifacts prepared by prepare_remote_artifacts.
+    Only steps of the host plan are run, the deployment state is written to the host afterwards.
+    :param data: Deployment arguments
+    :param ip_address: Address of the remote host
+    :param artifacts: Shared artifacts, see prepare_remote_artifacts
+    :param host_os: OS of the remote host
+    :param host_platform: Platform of the remote host
+    :param host: Planned host, see plan_host. The host is connected and planned here if not given
+    """
+    version = data["version"]
+    build = data["build"]
+    pull_workers = data.get("args_pull_workers", 1)
+    upstream = bool(data["args_upstream"])
+    if host is None:
+        host = plan_host(data, ip_address, artifacts["image_list"], host_os, host_platform)
+        owned = True
+    else:
+        owned = False
+    client, plan = host["client"], host["plan"]
+
+    with host_context(ip_address), span("host_deployment") as attrs:
+        # Round trips of planning are reported by its own span
+        round_trips = client.round_trips
+        try:
+            full_zip_name = None
+            if plan["images"]:
+                ensure_podman_running(client=client)
+                if artifacts["relay_archives"]:
+                    relay_images({name: archive for name, archive in artifacts["relay_archives"].items()
+                                  if name in plan["images"]}, client)
+                elif version and build and not upstream:
+                    deploy_images(version, build, artifacts["image_list"], client, workers=pull_workers,
+                                  sync=data.get("args_sync_images", False), remove_old=plan["full_images"],
+                                  targets=None if plan["full_images"] else plan["images"])
+
+            if plan["dependencies"]:
+                full_zip_name = artifacts["zips"][(host_os, host_platform)]
+                unpack_zip(full_zip_name, get_target_dependency_path(client), client,
+                           incremental=data.get("args_incremental", False))
+            if not is_noop(plan):
+                write_state(host["desired"], full_zip_name, client)
+        finally:
+            attrs["round_trips"] = client.round_trips - round_trips
+            if owned:
+                client.close()
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from utils.registry_mirror import BlobStore, RegistryMirror
+
+
+def get_digest(content):
+    return f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+
+class _UpstreamHandler(BaseHTTPRequestHandler):
+    """Stand-in upstream registry serving blobs of server.blobs, counting requests per path"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, message_format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        digest = self.path.rsplit("/", 1)[-1]
+        if digest == self.server.stalled:
+            self.send_response(200)
+            self.send_header("Content-Length", "1024")
+            self.end_headers()
+            self.server.release.wait(10)
+            return
+        content = self.server.blobs.get(digest)
+        if content is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class RegistryMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.upstream = ThreadingHTTPServer(("127.0.0.1", 0), _UpstreamHandler)
+        self.upstream.daemon_threads = True
+        self.upstream.blobs, self.upstream.requests, self.upstream.stalled = {}, [], None
+        self.upstream.release = threading.Event()
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+        self.addCleanup(self.upstream.server_close)
+        self.addCleanup(self.upstream.shutdown)
+        self.addCleanup(self.upstream.release.set)
+        self.upstream_host = f"127.0.0.1:{self.upstream.server_address[1]}"
+
+        self.store = BlobStore(os.path.join(self.tmp, "blobs"), 1024 ** 2)
+        self.mirror = RegistryMirror(self.store, "127.0.0.1:0", insecure_upstreams=[self.upstream_host]).start()
+        self.addCleanup(self.mirror.stop)
+        self.session = requests.Session()
+        self.session.trust_env = False
+        self.addCleanup(self.session.close)
+
+    def get_blob(self, digest, host=None):
+        url = f"http://{self.mirror.address}/v2/{host or self.upstream_host}/mta/mta-cli/blobs/{digest}"
+        return self.session.get(url, timeout=10)
+
+    def test_one_upstream_fetch_per_blob(self):
+        content = os.urandom(4096)
+        digest = get_digest(content)
+        self.upstream.blobs[digest] = content
+        for _ in range(3):
+            response = self.get_blob(digest)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, content)
+            self.assertEqual(response.headers["Docker-Content-Digest"], digest)
+        self.assertEqual(len(self.upstream.requests), 1)
+        self.assertEqual(self.mirror.upstream_fetches, 1)
+
+    def test_digest_mismatch_is_rejected(self):
+        digest = get_digest(b"expected")
+        self.upstream.blobs[digest] = b"tampered"
+        response = self.get_blob(digest)
+        self.assertEqual(response.status_code, 502)
+        self.assertIsNone(self.store.get(digest))
+        self.assertEqual([name for name in os.listdir(self.store.path)], [])
+
+    def test_host_outside_allowlist_is_refused(self):
+        response = self.get_blob(get_digest(b"blob"), host="registry.example.com")
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("DENIED", response.text)
+        self.assertEqual(self.mirror.upstream_fetches, 0)
+
+    def test_stalled_upstream_times_out(self):
+        digest = get_digest(b"stalled")
+        self.upstream.stalled = digest
+        with mock.patch.object(config, "STEP_TIMEOUTS", {"http": 1, "download": 1}):
+            started = time.monotonic()
+            response = self.get_blob(digest)
+        self.assertEqual(response.status_code, 502)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertIsNone(self.store.get(digest))
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def put(self, store, content):
+        digest = get_digest(content)
+        writer = store.writer(digest)
+        writer.write(content)
+        writer.commit({"content_type": "application/octet-stream"})
+        return digest
+
+    def test_least_recently_used_blob_is_evicted(self):
+        store = BlobStore(self.tmp, 2500)
+        first, second = self.put(store, b"1" * 1000), self.put(store, b"2" * 1000)
+        for age, digest in ((200, first), (100, second)):
+            mtime = time.time() - age
+            os.utime(store.blob_path(digest), (mtime, mtime))
+        # Reading the older blob makes the other one least recently used
+        self.assertIsNotNone(store.get(first))
+        third = self.put(store, b"3" * 1000)
+        self.assertIsNotNone(store.get(first))
+        self.assertIsNone(store.get(second))
+        self.assertIsNotNone(store.get(third))
+        self.assertFalse(os.path.exists(store.blob_path(second) + ".json"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.policy import Deadline, deadline_scope
+from utils.relay import read_archive_info, stream_archive
+
+BASE = "sha256:" + "b" * 64
+OWN = "sha256:" + "c" * 64
+
+
+class _Channel:
+    """Stand-in of paramiko channel collecting data sent to remote `podman load`"""
+
+    def __init__(self, exit_status=0, stderr=b"", fail_after=None):
+        self.data = io.BytesIO()
+        self.exit_status = exit_status
+        self.stderr = stderr
+        self.fail_after = fail_after
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        if self.fail_after is not None and self.data.tell() + len(data) > self.fail_after:
+            raise OSError("Socket is closed")
+        self.data.write(data)
+
+    def shutdown_write(self):
+        pass
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        data, self.stderr = self.stderr[:size], self.stderr[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class _Stream:
+    def __init__(self, channel, data=b""):
+        self.channel = channel
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class _Client:
+    host = "10.0.0.1"
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.commands = []
+
+    def exec_command(self, command):
+        self.commands.append(command)
+        return None, _Stream(self.channel), _Stream(self.channel, self.channel.stderr)
+
+
+class StreamArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.archive = os.path.join(self.tmp, "image.tar")
+        members = {"base/layer.tar": os.urandom(4096), "own/layer.tar": os.urandom(4096),
+                   "abc123.json": json.dumps({"rootfs": {"type": "layers", "diff_ids": [BASE, OWN]}}).encode(),
+                   "manifest.json": json.dumps([{"Config": "abc123.json", "RepoTags": ["mta-cli:7.3.0"],
+                                                 "Layers": ["base/layer.tar", "own/layer.tar"]}]).encode()}
+        with tarfile.open(self.archive, "w") as tar:
+            for name, data in members.items():
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+        self.info = read_archive_info(self.archive)
+
+    def get_sent_sizes(self, channel):
+        with tarfile.open(fileobj=gzip.GzipFile(fileobj=io.BytesIO(channel.data.getvalue())), mode="r") as tar:
+            return {member.name: member.size for member in tar}
+
+    def test_placeholders_only_for_known_layers(self):
+        channel = _Channel()
+        sent = stream_archive(self.archive, self.info, {BASE, "sha256:" + "d" * 64}, "mta-cli:7.3.0", _Client(channel))
+        self.assertEqual(sent, len(channel.data.getvalue()))
+        sizes = self.get_sent_sizes(channel)
+        self.assertEqual(sizes["base/layer.tar"], 0)
+        self.assertEqual(sizes["own/layer.tar"], 4096)
+        self.assertGreater(sizes["manifest.json"], 0)
+        self.assertTrue(channel.closed)
+
+    def test_no_placeholders_without_known_layers(self):
+        channel = _Channel()
+        stream_archive(self.archive, self.info, set(), "mta-cli:7.3.0", _Client(channel))
+        sizes = self.get_sent_sizes(channel)
+        self.assertEqual(sizes["base/layer.tar"], 4096)
+        self.assertEqual(sizes["own/layer.tar"], 4096)
+
+    def test_channel_error_reports_remote_stderr(self):
+        channel = _Channel(stderr=b"Error: payload does not match", fail_after=0)
+        with self.assertRaises(SystemExit) as raised:
+            stream_archive(self.archive, self.info, set(), "mta-cli:7.3.0", _Client(channel))
+        self.assertIn("Socket is closed", str(raised.exception))
+        self.assertIn("payload does not match", str(raised.exception))
+        self.assertTrue(channel.closed)
+
+    def test_load_failure(self):
+        channel = _Channel(exit_status=125, stderr=b"Error: layer not known")
+        with self.assertRaises(SystemExit) as raised:
+            stream_archive(self.archive, self.info, set(), "mta-cli:7.3.0", _Client(channel))
+        self.assertIn("exit code 125", str(raised.exception))
+        self.assertIn("layer not known", str(raised.exception))
+
+    def test_cancelled_deadline_stops_streaming(self):
+        cancel = threading.Event()
+        channel = _Channel()
+        original = channel.sendall
+
+        def sendall(data):
+            original(data)
+            cancel.set()
+        channel.sendall = sendall
+        with deadline_scope(Deadline(cancel=cancel)), self.assertRaises(SystemExit) as raised:
+            stream_archive(self.archive, self.info, set(), "mta-cli:7.3.0", _Client(channel))
+        self.assertIn("cancelled", str(raised.exception))
+        self.assertTrue(channel.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.state import get_revalidated_sha, is_noop, make_plan
+
+CLI = "registry.redhat.io/mta/mta-cli-rhel9:7.3.0"
+PROVIDER = "registry.redhat.io/mta/mta-java-external-provider-rhel9:7.3.0"
+ZIP_SHA = "a" * 64
+
+
+def get_desired(build="46", images=None, dependencies=ZIP_SHA):
+    return {"version": "7.3.0", "build": build, "upstream": False, "dependencies": dependencies,
+            "images": {CLI: "sha256:1", PROVIDER: "sha256:2"} if images is None else images}
+
+
+def get_current(record, images=None, dependencies=True):
+    """Target state as read_target_state returns it, images default to those of the record"""
+    if images is None:
+        images = {name: {digest} for name, digest in (record or {}).get("images", {}).items() if digest}
+    return {"record": record, "images": images, "dependencies": dependencies}
+
+
+class MakePlanTest(unittest.TestCase):
+
+    def test_up_to_date(self):
+        desired = get_desired()
+        plan = make_plan(get_current(dict(desired)), desired)
+        self.assertTrue(is_noop(plan))
+        self.assertEqual(plan["reasons"], [])
+
+    def test_no_record(self):
+        plan = make_plan(get_current(None, images={}, dependencies=False), get_desired())
+        self.assertFalse(is_noop(plan))
+        self.assertTrue(plan["full_images"])
+        self.assertEqual(sorted(plan["images"]), [CLI, PROVIDER])
+        self.assertTrue(plan["dependencies"])
+        self.assertIn("no deployment state on target", plan["reasons"])
+
+    def test_force(self):
+        desired = get_desired()
+        plan = make_plan(get_current(dict(desired)), desired, force=True)
+        self.assertFalse(is_noop(plan))
+        self.assertTrue(plan["full_images"])
+        self.assertEqual(sorted(plan["images"]), [CLI, PROVIDER])
+        self.assertTrue(plan["dependencies"])
+        self.assertEqual(plan["reasons"], ["redeployment forced"])
+
+    def test_different_build(self):
+        plan = make_plan(get_current(get_desired(build="45")), get_desired(build="46"))
+        self.assertTrue(plan["full_images"])
+        self.assertEqual(sorted(plan["images"]), [CLI, PROVIDER])
+        self.assertTrue(plan["dependencies"])
+        self.assertIn("deployed 7.3.0-45 differs from 7.3.0-46", plan["reasons"])
+
+    def test_changed_image(self):
+        desired = get_desired()
+        current = get_current(dict(desired), images={CLI: {"sha256:1"}, PROVIDER: {"sha256:old"}})
+        plan = make_plan(current, desired)
+        self.assertFalse(plan["full_images"])
+        self.assertEqual(plan["images"], [PROVIDER])
+        self.assertFalse(plan["dependencies"])
+
+    def test_none_digests_are_pulled(self):
+        # Stage/candidate/GA images are pulled by tag, the tag can be respun with the same name
+        desired = get_desired(build="stage", images={CLI: None, PROVIDER: None})
+        current = get_current(dict(desired), images={CLI: {"sha256:1"}, PROVIDER: {"sha256:2"}})
+        plan = make_plan(current, desired)
+        self.assertFalse(is_noop(plan))
+        self.assertFalse(plan["full_images"])
+        self.assertEqual(sorted(plan["images"]), [CLI, PROVIDER])
+        self.assertFalse(plan["dependencies"])
+        self.assertEqual(plan["reasons"], [f"images pulled by tag: {CLI}, {PROVIDER}"])
+
+    def test_unknown_dependencies(self):
+        desired = get_desired(dependencies=None)
+        plan = make_plan(get_current(dict(desired)), desired)
+        self.assertEqual(plan["images"], [])
+        self.assertTrue(plan["dependencies"])
+        self.assertIn("dependency zip is not known before it is fetched", plan["reasons"])
+
+
+class RevalidatedShaTest(unittest.TestCase):
+
+    def test_entry_without_validators_is_not_trusted(self):
+        class Cache:
+            def get_validators(self, url):
+                return None
+
+            def lookup(self, url, validators=None):
+                raise AssertionError("lookup must not be called without validators")
+
+        self.assertIsNone(get_revalidated_sha(Cache(), "http://example.com/mta.zip"))
+
+
+if __name__ == "__main__":
+    unittest.main()
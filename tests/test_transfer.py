@@ -0,0 +1,109 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import transfer
+from utils.transfer import _upload_parts, get_part_path
+
+
+class _RemoteFile:
+    """File written over SFTP, the connection drops once the client's write budget is used up"""
+
+    def __init__(self, client, path, mode):
+        self.client = client
+        self.file = open(path, mode)
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def seek(self, offset):
+        self.file.seek(offset)
+
+    def write(self, data):
+        if self.client.drop_after is not None:
+            if self.client.drop_after <= 0:
+                self.client.drop_after = None
+                self.client.active = False
+                raise EOFError("connection dropped")
+            self.client.drop_after -= len(data)
+        self.file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+class _Sftp:
+    def __init__(self, client):
+        self.client = client
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def open(self, path, mode, bufsize=-1):
+        return _RemoteFile(self.client, path, mode)
+
+    def close(self):
+        pass
+
+
+class _Client:
+    host = "10.0.0.1"
+
+    def __init__(self, drop_after=None):
+        self.drop_after = drop_after
+        self.active = True
+
+    def open_sftp(self, **kwargs):
+        return _Sftp(self)
+
+    def is_active(self):
+        return self.active
+
+    def reconnect(self):
+        self.active = True
+
+
+class UploadPartsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.local_path = os.path.join(self.tmp, "dependencies.zip")
+        self.content = os.urandom(4 * transfer.BLOCK_SIZE)
+        with open(self.local_path, "wb") as f:
+            f.write(self.content)
+        self.staged = os.path.join(self.tmp, "remote", "dependencies.zip")
+        self.parts = [(0, len(self.content))]
+
+    def read_part(self):
+        with open(get_part_path(self.staged, 0, len(self.content)), "rb") as f:
+            return f.read()
+
+    def test_retry_does_not_count_sent_bytes_as_resumed(self):
+        sent, resumed = _upload_parts(self.local_path, self.staged, self.parts, _Client(drop_after=transfer.BLOCK_SIZE))
+        self.assertEqual(self.read_part(), self.content)
+        self.assertEqual(resumed, 0)
+        self.assertEqual(sent, len(self.content))
+
+    def test_part_left_by_earlier_run_is_resumed(self):
+        os.makedirs(os.path.dirname(self.staged))
+        with open(get_part_path(self.staged, 0, len(self.content)), "wb") as f:
+            f.write(self.content[:transfer.BLOCK_SIZE])
+        sent, resumed = _upload_parts(self.local_path, self.staged, self.parts,
+                                      _Client(drop_after=transfer.BLOCK_SIZE))
+        self.assertEqual(self.read_part(), self.content)
+        self.assertEqual(resumed, transfer.BLOCK_SIZE)
+        self.assertEqual(sent, len(self.content) - transfer.BLOCK_SIZE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import zip as zip_utils
+from utils.zip import MANIFEST_FILE, build_zip_manifest, exchange_paths, unpack_zip_incremental
+
+
+class UnpackIncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmp, "kantra")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def make_zip(self, name, members):
+        path = os.path.join(self.tmp, name)
+        with zipfile.ZipFile(path, "w") as zip_ref:
+            for member, content in members.items():
+                zip_ref.writestr(member, content)
+        return path
+
+    def read(self, name):
+        with open(os.path.join(self.target, name)) as f:
+            return f.read()
+
+    def read_manifest(self):
+        with open(os.path.join(self.target, MANIFEST_FILE)) as f:
+            return json.load(f)
+
+    def test_interrupted_unpack_keeps_target_manifest(self):
+        old_zip = self.make_zip("old.zip", {"lib/a.jar": "old a", "lib/b.jar": "b"})
+        new_zip = self.make_zip("new.zip", {"lib/a.jar": "new a", "lib/b.jar": "b", "lib/c.jar": "c"})
+        unpack_zip_incremental(old_zip, self.target)
+
+        # Interrupted after extraction, before the staging copy replaces the target
+        with mock.patch.object(zip_utils, "switch_directories", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                unpack_zip_incremental(new_zip, self.target)
+        self.assertEqual(self.read_manifest(), build_zip_manifest(old_zip))
+        self.assertEqual(self.read("lib/a.jar"), "old a")
+
+        unpack_zip_incremental(new_zip, self.target)
+        self.assertEqual(self.read_manifest(), build_zip_manifest(new_zip))
+        self.assertEqual(self.read("lib/a.jar"), "new a")
+        self.assertEqual(self.read("lib/c.jar"), "c")
+
+    def test_stale_files_removed(self):
+        unpack_zip_incremental(self.make_zip("old.zip", {"a": "a", "b": "b"}), self.target)
+        unpack_zip_incremental(self.make_zip("new.zip", {"a": "a"}), self.target)
+        self.assertEqual(sorted(os.listdir(self.target)), [MANIFEST_FILE, "a"])
+        self.assertFalse(os.path.exists(f"{self.target}.staging"))
+        self.assertFalse(os.path.exists(f"{self.target}.old"))
+
+    def test_rename_fallback(self):
+        unpack_zip_incremental(self.make_zip("old.zip", {"a": "old"}), self.target)
+        with mock.patch.object(zip_utils, "exchange_paths", return_value=False):
+            unpack_zip_incremental(self.make_zip("new.zip", {"a": "new"}), self.target, workers=2)
+        self.assertEqual(self.read("a"), "new")
+        self.assertFalse(os.path.exists(f"{self.target}.old"))
+
+    def test_exchange_paths(self):
+        first, second = os.path.join(self.tmp, "first"), os.path.join(self.tmp, "second")
+        for path in (first, second):
+            os.makedirs(path)
+            open(os.path.join(path, os.path.basename(path)), "w").close()
+        if not exchange_paths(first, second):
+            self.skipTest("renameat2(RENAME_EXCHANGE) is not supported here")
+        self.assertEqual(os.listdir(first), ["second"])
+        self.assertEqual(os.listdir(second), ["first"])
+
+
+if __name__ == "__main__":
+    unittest.main()
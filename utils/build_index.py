@@ -0,0 +1,156 @@
+"""
+Persistent index of build artifacts generated from a bundle.
+
+For every `<bundle><version>-<build>` the index keeps the parsed images list (output of GET_IMAGES_OUTPUT)
+and location, size and SHA-256 of the dependency zips extracted by EXTRACT_BINARY under MISC_DOWNSTREAM_PATH.
+Entries expire after a TTL and can be invalidated explicitly (--refresh_build_index). Extracted zips are
+verified before they are reused: by size and modification time, and by hash when the file was touched.
+"""
+import logging
+import os
+import threading
+import time
+
+import config
+from utils.cache import IndexLock, hash_file
+
+INDEX_FILE = "index.json"
+DEFAULT_BUILD_INDEX_DIR = os.path.join("~", ".cache", "konveyor-cli-deployment", "builds")
+
+_index = None
+_index_lock = threading.Lock()
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+
+def get_build_key(version, build):
+    """Returns index key of the build, e.g. mta-operator-bundle-container-7.3.0-12"""
+    bundle = config.BUNDLE.split()[-1] if config.BUNDLE and config.BUNDLE.split() else ""
+    return f"{bundle}{version}-{build}"
+
+
+def get_build_lock(key):
+    """
+    Returns lock serializing generation of images list and dependency zips of one build. Concurrent deployments
+    of one process (deploy_service.py jobs) mustn't run the bundle tools into the same folder at the same time
+    :param key: Build key, see get_build_key
+    """
+    with _build_locks_lock:
+        return _build_locks.setdefault(key, threading.RLock())
+
+
+class BuildIndex:
+    """Index of image lists and extracted dependency zips, keyed by bundle, version and build"""
+
+    def __init__(self, path, ttl):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.index_path = os.path.join(self.path, INDEX_FILE)
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def new_index():
+        return {"builds": {}}
+
+    def _entry(self, index, key):
+        """Returns entry of the build, expired entries are dropped"""
+        entry = index["builds"].get(key)
+        if entry and time.time() - entry["created"] > self.ttl:
+            logging.info(f"Build index entry of {key} expired")
+            del index["builds"][key]
+            return None
+        return entry
+
+    def _update(self, key, **values):
+        with IndexLock(self) as index:
+            entry = self._entry(index, key) or {"created": time.time()}
+            entry.update(values)
+            index["builds"][key] = entry
+
+    def get_image_list(self, key):
+        """
+        :return: Parsed images list of the build or None
+        """
+        with IndexLock(self) as index:
+            entry = self._entry(index, key)
+            return entry.get("image_list") if entry else None
+
+    def store_image_list(self, key, image_list):
+        self._update(key, image_list=image_list)
+        logging.info(f"Images list of {key} stored in build index")
+
+    def get_zips(self, key, folder):
+        """
+        Checks that dependency zips extracted for the build are still present and unchanged
+        :param key: Build key
+        :param folder: Folder the zips were extracted to
+        :return: True if extraction can be skipped
+        """
+        with IndexLock(self) as index:
+            entry = self._entry(index, key)
+            zips = entry.get("zips") if entry else None
+            if not zips or zips["folder"] != folder or not zips["files"]:
+                return False
+            for name, record in zips["files"].items():
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    logging.info(f"Extracted zip {path} of {key} is missing")
+                    return False
+                if stat.st_size != record["size"]:
+                    logging.info(f"Extracted zip {path} of {key} was changed")
+                    return False
+                if stat.st_mtime != record["mtime"]:
+                    if hash_file(path) != record["sha256"]:
+                        logging.info(f"Extracted zip {path} of {key} was changed")
+                        return False
+                    record["mtime"] = stat.st_mtime
+        return True
+
+    def get_zip_sha(self, key, name):
+        """
+        :return: SHA-256 of the dependency zip extracted for the build or None
+        """
+        with IndexLock(self) as index:
+            entry = self._entry(index, key)
+            record = entry.get("zips", {}).get("files", {}).get(name) if entry else None
+            return record["sha256"] if record else None
+
+    def store_zips(self, key, folder):
+        """Records zips found in the folder as extracted artifacts of the build"""
+        files = {}
+        if os.path.isdir(folder):
+            for name in sorted(os.listdir(folder)):
+                path = os.path.join(folder, name)
+                if name.endswith(".zip") and os.path.isfile(path):
+                    stat = os.stat(path)
+                    files[name] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": hash_file(path)}
+        if not files:
+            logging.warning(f"No dependency zips found in {folder}, not indexing them")
+            return
+        self._update(key, zips={"folder": folder, "files": files})
+        logging.info(f"{len(files)} dependency zips of {key} stored in build index")
+
+    def invalidate(self, key=None):
+        """Drops entry of the build, or all entries when key is None"""
+        with IndexLock(self) as index:
+            if key is None:
+                index["builds"].clear()
+            else:
+                index["builds"].pop(key, None)
+        logging.info(f"Build index entries invalidated: {key or 'all'}")
+
+
+def get_build_index():
+    """
+    Returns build index configured in config.json or None if it is disabled (build_index_ttl_hours set to 0)
+    """
+    global _index
+    with _index_lock:
+        if _index is None and config.BUILD_INDEX_TTL_HOURS:
+            _index = BuildIndex(config.BUILD_INDEX_DIR or DEFAULT_BUILD_INDEX_DIR,
+                                float(config.BUILD_INDEX_TTL_HOURS) * 3600)
+        return _index
+
@@ -0,0 +1,246 @@
+"""
+Persistent on-disk cache for downloaded artifacts (dependency zips).
+
+Blobs are stored by their SHA-256 content hash, URLs are mapped to blobs in the index file together with
+validators (ETag, Last-Modified, Content-Length) of the version downloaded. The same URL can serve new content
+(stage/candidate/GA zips are respun under one URL), a cached artifact is used only after the server confirmed
+the validators still match. Cache size is bounded, least recently used blobs are evicted first.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows controller, only in-process locking is available
+    fcntl = None
+
+INDEX_FILE = "index.json"
+BLOBS_DIR = "blobs"
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "konveyor-cli-deployment", "artifacts")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Computes SHA-256 of a file
+    :param path: Path to the file
+    :param chunk_size: Read buffer size
+    :return: Hex digest
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def validators_match(stored, current):
+    """
+    Tells whether the server still serves the version validators were stored for: ETag or Last-Modified
+    must be present on both sides and equal, as must every other validator both sides have
+    :param stored: Validators stored with the cached artifact
+    :param current: Validators the server returned now
+    """
+    if not stored or not current:
+        return False
+    compared = [key for key in ("etag", "last_modified", "size") if stored.get(key) and current.get(key)]
+    return any(key != "size" for key in compared) and all(stored[key] == current[key] for key in compared)
+
+
+class ArtifactCache:
+    """Content-addressed artifact cache with size-bounded LRU eviction"""
+
+    def __init__(self, path, max_size):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self.blobs_path = os.path.join(self.path, BLOBS_DIR)
+        self.index_path = os.path.join(self.path, INDEX_FILE)
+        self._lock = threading.Lock()
+        os.makedirs(self.blobs_path, exist_ok=True)
+
+    def get_validators(self, url):
+        """Returns validators stored with the artifact cached for URL, None if there is none"""
+        with self._locked_index() as index:
+            return index.get("validators", {}).get(url) if index["urls"].get(url) in index["blobs"] else None
+
+    def fetch(self, url, dest, validators=None):
+        """
+        Materializes cached artifact for URL at dest
+        :param url: URL the artifact was downloaded from
+        :param dest: Path where the artifact should be placed
+        :param validators: Validators the server returned now (see download.get_validators). None if the server
+                           couldn't be asked, the cached artifact is then used as it is
+        :return: True on cache hit, False if the artifact has to be downloaded
+        """
+        with self._locked_index() as index:
+            sha = index["urls"].get(url)
+            entry = index["blobs"].get(sha) if sha else None
+            if not entry:
+                return False
+            if validators is None:
+                logging.warning(f"Using cached artifact for {url} which could not be revalidated")
+            elif not validators_match(index.get("validators", {}).get(url), validators):
+                logging.info(f"Cached artifact for {url} is outdated")
+                return False
+            blob = self._blob_path(sha)
+            if not self._verify_blob(blob, sha, entry):
+                logging.warning(f"Cached artifact for {url} is corrupted, dropping it")
+                self._drop(index, sha)
+                return False
+            entry["last_used"] = time.time()
+            self._materialize(blob, dest)
+        logging.info(f"Using cached artifact for {url}: {dest}")
+        return True
+
+    def lookup(self, url, validators=None):
+        """
+        :param validators: Validators the server returned now (see download.get_validators), nothing is trusted without them
+        :return: SHA-256 of the artifact cached for URL if it is still the one the server serves, None otherwise.
+                 The blob itself is not verified
+        """
+        with self._locked_index() as index:
+            sha = index["urls"].get(url)
+            if sha not in index["blobs"] or not validators_match(index.get("validators", {}).get(url), validators):
+                return None
+            return sha
+
+    def store(self, url, src, sha=None, validators=None):
+        """
+        Adds downloaded artifact to the cache and evicts old entries if cache is too big
+        :param url: URL the artifact was downloaded from
+        :param src: Path to the downloaded artifact
+        :param sha: SHA-256 of the artifact if already known
+        :param validators: Validators the server returned for the downloaded version, an artifact stored
+                           without them is never used
+        :return: SHA-256 of the artifact
+        """
+        sha = sha or hash_file(src)
+        size = os.path.getsize(src)
+        if size > self.max_size:
+            logging.info(f"Artifact {src} is bigger than cache size limit, not caching it")
+            return sha
+        with self._locked_index() as index:
+            blob = self._blob_path(sha)
+            if not os.path.exists(blob):
+                self._materialize(src, blob)
+            index["urls"][url] = sha
+            index.setdefault("validators", {})[url] = validators or {}
+            index["blobs"][sha] = {"size": size, "mtime": os.path.getmtime(blob), "last_used": time.time()}
+            self._evict(index)
+        logging.info(f"Artifact {src} stored in cache ({sha})")
+        return sha
+
+    def _evict(self, index):
+        total = sum(entry["size"] for entry in index["blobs"].values())
+        for sha, entry in sorted(index["blobs"].items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_size:
+                break
+            logging.info(f"Evicting cached artifact {sha}")
+            total -= entry["size"]
+            self._drop(index, sha)
+
+    @staticmethod
+    def _verify_blob(blob, sha, entry):
+        """Blob is hashed again only if its size or modification time differs from the stored one"""
+        try:
+            stat = os.stat(blob)
+        except FileNotFoundError:
+            return False
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime == entry.get("mtime"):
+            return True
+        if hash_file(blob) != sha:
+            return False
+        entry["mtime"] = stat.st_mtime
+        return True
+
+    def _drop(self, index, sha):
+        index["blobs"].pop(sha, None)
+        for url in [url for url, value in index["urls"].items() if value == sha]:
+            del index["urls"][url]
+            index.get("validators", {}).pop(url, None)
+        try:
+            os.remove(self._blob_path(sha))
+        except FileNotFoundError:
+            pass
+
+    def _blob_path(self, sha):
+        return os.path.join(self.blobs_path, sha)
+
+    @staticmethod
+    def _materialize(src, dest):
+        """Hard links src to dest when possible, copies it otherwise"""
+        if os.path.exists(dest) and os.path.samefile(src, dest):
+            return
+        tmp_dest = f"{dest}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.link(src, tmp_dest)
+        except OSError:
+            shutil.copyfile(src, tmp_dest)
+        os.replace(tmp_dest, dest)
+
+    @staticmethod
+    def new_index():
+        return {"urls": {}, "validators": {}, "blobs": {}}
+
+    def _locked_index(self):
+        return IndexLock(self)
+
+
+class IndexLock:
+    """
+    Locks the index (across threads and processes), loads it and saves it back on exit.
+    Works with any object having index_path, _lock and new_index().
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock_file = None
+        self.index = None
+
+    def __enter__(self):
+        self.cache._lock.acquire()
+        self.lock_file = open(self.cache.index_path + ".lock", "w")
+        if fcntl:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            with open(self.cache.index_path, "r") as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.index = self.cache.new_index()
+        return self.index
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                tmp_path = self.cache.index_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self.index, f)
+                os.replace(tmp_path, self.cache.index_path)
+        finally:
+            self.lock_file.close()
+            self.cache._lock.release()
+        return False
+
+
+def get_artifact_cache():
+    """
+    Returns artifact cache configured in config.json or None if caching is disabled
+    (cache_max_size_gb set to 0)
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None and config.CACHE_MAX_SIZE_GB:
+            _cache = ArtifactCache(config.CACHE_DIR or DEFAULT_CACHE_DIR,
+                                   int(float(config.CACHE_MAX_SIZE_GB) * 1024 ** 3))
+        return _cache
@@ -4,6 +4,7 @@ for different repository types in the Red Hat Migration Toolkit for Applications
 
 Attributes:
     repositories (dict): Maps repository types (e.g., "ga", "stage") to their respective registry URLs.
+    brew_proxy (str): Registry bundle build images are pulled from.
     related_images (list): A list of related MTA images for different platforms and versions.
     basic_images (list): A list of fundamental MTA images required for operation.
     zip_urls (dict): URLs for downloading MTA zip files, formatted per repository type.
@@ -16,6 +17,8 @@ repositories = {
     # Add more repositories as needed
 }
 
+brew_proxy = "brew.registry.redhat.io"
+
 related_images = ["mta-java-external-provider-rhel9", "mta-generic-external-provider-rhel9",
                   "mta-dotnet-external-provider-rhel9"]
 basic_images = ['mta-cli-rhel9']
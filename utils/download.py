@@ -0,0 +1,410 @@
+"""
+HTTP download engine used for dependency zips.
+
+Supports resuming interrupted transfers with HTTP Range requests, optional parallel segment fetching
+for servers which accept ranges, adaptive read buffers and SHA-256 hashing while the file streams in.
+Partial downloads are kept next to the target file (`<file>.part` plus `<file>.part.json` with its state)
+so the next attempt or the next run continues where the previous one stopped.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+
+from utils.policy import backoff, carry, current_deadline, get_step_timeout
+from utils.throttle import throttle
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Adaptive buffer is sized to hold roughly this much time of transfer
+CHUNK_TARGET_SECONDS = 0.25
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+PROGRESS_INTERVAL = 5
+HASH_READ_SIZE = 1024 * 1024
+
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout, urllib3.exceptions.ProtocolError,
+                    urllib3.exceptions.ReadTimeoutError)
+
+
+class ContentChanged(Exception):
+    """Server answered a ranged request with If-Range by the whole file, its content changed"""
+
+
+class Progress:
+    """Thread-safe throughput / ETA reporter"""
+
+    def __init__(self, name, total=None, done=0):
+        self.name = name
+        self.total = total
+        self.done = done
+        self.start = time.monotonic()
+        self.start_done = done
+        self.last_report = self.start
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.last_report >= PROGRESS_INTERVAL:
+                self.last_report = now
+                logging.info(self.describe(now))
+
+    def rate(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        return (self.done - self.start_done) / elapsed if elapsed > 0 else 0.0
+
+    def describe(self, now=None):
+        rate = self.rate(now)
+        message = f"Downloading {self.name}: {self.done / 1024 ** 2:.1f} MB"
+        if self.total:
+            message += f" of {self.total / 1024 ** 2:.1f} MB"
+        message += f" ({rate / 1024 ** 2:.2f} MB/s"
+        if self.total and rate > 0:
+            message += f", ETA {(self.total - self.done) / rate:.0f}s"
+        return message + ")"
+
+
+class OrderedHasher:
+    """
+    Hashes file content in order while segments are written out of order.
+    Data arriving at the current hash position is hashed from memory, ranges written by
+    other segments are read back from the (page-cached) file once the hash position reaches them.
+    """
+
+    def __init__(self, path, ranges):
+        self.path = path
+        self.sha = hashlib.sha256()
+        self.position = 0
+        # Written ranges as {start: end}, extended by writers as data arrives
+        self.ranges = {start: start for start, _end in ranges}
+        self._lock = threading.Lock()
+
+    def update(self, start, offset, data):
+        """
+        Records data written at offset by the segment starting at start
+        """
+        with self._lock:
+            if offset == self.position:
+                self.sha.update(data)
+                self.position += len(data)
+            self.ranges[start] = offset + len(data)
+            self._catch_up()
+
+    def _available(self):
+        return max((end for start, end in self.ranges.items() if start <= self.position), default=self.position)
+
+    def _catch_up(self):
+        if self._available() <= self.position:
+            return
+        with open(self.path, "rb") as f:
+            while True:
+                available = self._available()
+                if available <= self.position:
+                    return
+                f.seek(self.position)
+                data = f.read(min(HASH_READ_SIZE, available - self.position))
+                if not data:
+                    return
+                self.sha.update(data)
+                self.position += len(data)
+
+    def hexdigest(self):
+        with self._lock:
+            self._catch_up()
+            return self.sha.hexdigest()
+
+
+def download(url, local_filename, segments=1, expected_sha256=None, retries=3, verify=False):
+    """
+    Downloads file with resume support, optionally using several parallel ranged requests
+    :param url: URL of the file
+    :param local_filename: Path where the file should be saved
+    :param segments: Number of parallel ranged requests, used only if the server supports ranges
+    :param expected_sha256: Optional SHA-256 the downloaded file is verified against
+    :param retries: How many times an interrupted transfer is resumed before giving up
+    :param verify: Verify TLS certificates
+    :return: Dict with path, size, sha256 and duration of the download
+    """
+    part_file = local_filename + ".part"
+    start = time.monotonic()
+    session = requests.Session()
+    session.verify = verify
+
+    total, etag, ranges_supported = None, None, False
+    if segments > 1:
+        total, etag, ranges_supported = _probe(session, url)
+
+    state = _load_state(part_file, url, etag)
+    try:
+        sha = _download_parts(session, url, part_file, total, etag, ranges_supported, segments, retries, state)
+    except ContentChanged:
+        # Like the sequential download, start over when the file changed since the part file was written
+        logging.info(f"{url} changed on the server during the download, restarting it")
+        _remove_partial(part_file)
+        total, etag, ranges_supported = _probe(session, url)
+        try:
+            sha = _download_parts(session, url, part_file, total, etag, ranges_supported, segments, retries, {})
+        except ContentChanged:
+            _remove_partial(part_file)
+            raise SystemExit(f"Error downloading file {url}: it keeps changing on the server")
+
+    size = os.path.getsize(part_file)
+    if expected_sha256 and sha != expected_sha256.lower():
+        _remove_partial(part_file)
+        raise SystemExit(f"Checksum mismatch for {url}: expected {expected_sha256}, got {sha}")
+    if os.path.exists(local_filename):
+        # File can be hard linked to a cached blob, never overwrite it in place
+        os.remove(local_filename)
+    os.replace(part_file, local_filename)
+    _remove_partial(part_file, keep_data=True)
+
+    duration = time.monotonic() - start
+    rate = size / duration / 1024 ** 2 if duration > 0 else 0.0
+    logging.info(f"File saved as {local_filename} ({size / 1024 ** 2:.1f} MB in {duration:.1f}s, {rate:.2f} MB/s)")
+    return {"path": local_filename, "size": size, "sha256": sha, "duration": duration}
+
+
+def get_validators(url, cached=None, verify=False):
+    """
+    Asks the server which version of the file it serves, by a conditional HEAD request if validators of a
+    cached copy are given
+    :param url: URL of the file
+    :param cached: Validators of the cached copy, sent as If-None-Match / If-Modified-Since
+    :param verify: Verify TLS certificates
+    :return: Dict with etag, last_modified and size (cached unchanged if the server answered 304), empty dict
+             if the server doesn't identify the version by ETag or Last-Modified, None if it can't be asked
+    """
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        response = requests.head(url, headers=headers, allow_redirects=True, timeout=_get_timeout(url), verify=verify)
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as err:
+        logging.warning(f"Could not revalidate {url}: {err}")
+        return None
+    if response.status_code == 304 and cached:
+        return dict(cached)
+    if response.status_code != 200:
+        logging.warning(f"Could not revalidate {url}: HTTP {response.status_code}")
+        return None
+    length = response.headers.get("Content-Length")
+    validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"),
+                  "size": int(length) if length and length.isdigit() else None}
+    return validators if validators["etag"] or validators["last_modified"] else {}
+
+
+def _download_parts(session, url, part_file, total, etag, ranges_supported, segments, retries, state):
+    """Downloads into part file, by parallel segments if the server supports ranges and the file is big enough"""
+    if ranges_supported and total and total >= 2 * MIN_SEGMENT_SIZE:
+        return _download_segmented(session, url, part_file, total, etag, segments, retries, state)
+    return _download_sequential(session, url, part_file, retries, state)
+
+
+def _probe(session, url):
+    """Returns total size, ETag and whether the server accepts byte ranges"""
+    try:
+        response = session.head(url, allow_redirects=True, timeout=_get_timeout(url))
+    except TRANSIENT_ERRORS as err:
+        logging.warning(f"Could not probe {url}, falling back to single stream download: {err}")
+        return None, None, False
+    if response.status_code != 200:
+        return None, None, False
+    length = response.headers.get("Content-Length")
+    total = int(length) if length and length.isdigit() else None
+    ranges_supported = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return total, response.headers.get("ETag"), ranges_supported
+
+
+def _download_sequential(session, url, part_file, retries, state):
+    """Single stream download, resumed with Range requests after interruptions"""
+    sha = hashlib.sha256()
+    offset = 0
+    if state.get("mode") == "sequential" and os.path.exists(part_file):
+        # Hash the already downloaded prefix once, the rest is hashed while it streams in
+        with open(part_file, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_READ_SIZE), b""):
+                sha.update(chunk)
+                offset += len(chunk)
+    progress = Progress(os.path.basename(part_file[:-len(".part")]), done=offset)
+
+    attempt = 0
+    while True:
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if state.get("etag"):
+                headers["If-Range"] = state["etag"]
+        try:
+            with session.get(url, stream=True, headers=headers, timeout=_get_timeout(url)) as response:
+                if response.status_code == 416 and offset:
+                    # Nothing left to download, the part file is already complete
+                    return sha.hexdigest()
+                if response.status_code not in (200, 206):
+                    raise SystemExit(f"Error downloading file {url}: HTTP {response.status_code}")
+                if response.status_code == 200 and offset:
+                    logging.info(f"Server does not support resume for {url}, restarting download")
+                    offset = 0
+                    sha = hashlib.sha256()
+                    progress.done = 0
+                length = response.headers.get("Content-Length")
+                progress.total = offset + int(length) if length and length.isdigit() else None
+                _save_state(part_file, {"url": url, "etag": response.headers.get("ETag"), "mode": "sequential"})
+                with open(part_file, "ab" if offset else "wb") as f:
+                    for chunk in _iter_adaptive(response):
+                        f.write(chunk)
+                        sha.update(chunk)
+                        offset += len(chunk)
+                        progress.add(len(chunk))
+                if progress.total and offset != progress.total:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Connection closed after {offset} of {progress.total} bytes")
+                return sha.hexdigest()
+        except TRANSIENT_ERRORS as err:
+            attempt += 1
+            if attempt > retries:
+                raise SystemExit(f"Error downloading file {url}: {err}")
+            logging.warning(f"Download of {url} interrupted at {offset} bytes ({err}), resuming ({attempt}/{retries})")
+            current_deadline().sleep(backoff(attempt))
+
+
+def _download_segmented(session, url, part_file, total, etag, segments, retries, state):
+    """Parallel download of byte ranges into preallocated part file"""
+    if state.get("mode") == "segmented" and state.get("size") == total and os.path.exists(part_file):
+        ranges = state["ranges"]
+        logging.info(f"Resuming segmented download of {url}")
+    else:
+        segment_size = -(-total // segments)
+        ranges = [[start, min(start + segment_size, total), start] for start in range(0, total, segment_size)]
+        with open(part_file, "wb") as f:
+            f.truncate(total)
+    state = {"url": url, "etag": etag, "mode": "segmented", "size": total, "ranges": ranges}
+    state_lock = threading.Lock()
+    hasher = OrderedHasher(part_file, [(start, end) for start, end, _pos in ranges])
+    for item in ranges:
+        hasher.ranges[item[0]] = item[2]
+    progress = Progress(os.path.basename(part_file[:-len(".part")]), total,
+                        sum(pos - start for start, _end, pos in ranges))
+
+    changed = threading.Event()
+
+    def fetch(item):
+        start, end, _pos = item
+        attempt = 0
+        while item[2] < end and not changed.is_set():
+            headers = {"Range": f"bytes={item[2]}-{end - 1}"}
+            if etag:
+                headers["If-Range"] = etag
+            try:
+                with session.get(url, stream=True, headers=headers, timeout=_get_timeout(url)) as response:
+                    if response.status_code == 200 and etag:
+                        # Other segments stop too, their bytes belong to the old content
+                        changed.set()
+                        raise ContentChanged(url)
+                    if response.status_code != 206:
+                        raise SystemExit(f"Error downloading range of {url}: HTTP {response.status_code}")
+                    with open(part_file, "r+b") as f:
+                        f.seek(item[2])
+                        for chunk in _iter_adaptive(response, end - item[2]):
+                            if changed.is_set():
+                                return
+                            f.write(chunk)
+                            f.flush()
+                            hasher.update(start, item[2], chunk)
+                            item[2] += len(chunk)
+                            progress.add(len(chunk))
+                if item[2] < end and not changed.is_set():
+                    raise requests.exceptions.ChunkedEncodingError(
+                        f"Connection closed at {item[2]} of segment {start}-{end}")
+            except TRANSIENT_ERRORS as err:
+                attempt += 1
+                if attempt > retries:
+                    raise SystemExit(f"Error downloading file {url}: {err}")
+                logging.warning(f"Segment {start}-{end} of {url} interrupted ({err}), resuming ({attempt}/{retries})")
+                current_deadline().sleep(backoff(attempt))
+            finally:
+                with state_lock:
+                    _save_state(part_file, state)
+
+    logging.info(f"Downloading {url} using {len(ranges)} parallel segments")
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(carry(fetch), item) for item in ranges]
+        for future in futures:
+            if changed.is_set():
+                break
+            future.result()
+    if changed.is_set():
+        raise ContentChanged(url)
+    return hasher.hexdigest()
+
+
+def _get_timeout(url):
+    """
+    Timeouts of connecting and of waiting for data, a stalled stream fails after the download step timeout
+    and is resumed. Both are capped by the deadline of the deployment.
+    """
+    stall = get_step_timeout("download", f"download of {url}")
+    return get_step_timeout("http", f"download of {url}"), stall
+
+
+def _iter_adaptive(response, limit=None):
+    """
+    Reads response body with buffer size adapted to observed throughput
+    :param response: Streaming requests response
+    :param limit: Maximum number of bytes to read
+    """
+    chunk_size = MIN_CHUNK_SIZE
+    remaining = limit
+    deadline = current_deadline()
+    while remaining is None or remaining > 0:
+        # Read timeout only catches a stalled stream, a slow one is stopped by the deadline
+        deadline.check(f"Download of {response.url}")
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        started = time.monotonic()
+        chunk = response.raw.read(size, decode_content=True)
+        if not chunk:
+            return
+        elapsed = time.monotonic() - started
+        if remaining is not None:
+            remaining -= len(chunk)
+        if elapsed > 0:
+            chunk_size = int(min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, len(chunk) / elapsed * CHUNK_TARGET_SECONDS)))
+        else:
+            chunk_size = min(MAX_CHUNK_SIZE, chunk_size * 2)
+        throttle(len(chunk))
+        yield chunk
+
+
+def _load_state(part_file, url, etag):
+    """Loads state of a previous partial download, discards it if it belongs to different URL or content"""
+    try:
+        with open(part_file + ".json", "r") as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
+    if state.get("url") != url or (etag and state.get("etag") and state["etag"] != etag):
+        _remove_partial(part_file)
+        return {}
+    return state
+
+
+def _save_state(part_file, state):
+    with open(part_file + ".json", "w") as f:
+        json.dump(state, f)
+
+
+def _remove_partial(part_file, keep_data=False):
+    for path in ([] if keep_data else [part_file]) + [part_file + ".json"]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
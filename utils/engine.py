@@ -0,0 +1,205 @@
+"""
+Command execution engine built on asyncio.
+
+stdout and stderr of local subprocesses and SSH channels are drained concurrently, so a command filling one
+of the pipes never blocks while the other one is read. Output is split into lines as it arrives and passed to
+a callback (and debug log) immediately, the last lines of both streams are kept in bounded ring buffers for
+error reports. Every command can have a timeout and is killed (or its channel closed) when it expires or when
+the coroutine running it is cancelled.
+
+execute() is the coroutine to be used inside an event loop, run() is its blocking wrapper for threads
+without a running loop.
+"""
+import asyncio
+import collections
+import logging
+import os
+import signal
+import time
+
+READ_SIZE = 64 * 1024
+RING_LINES = 200
+CANCEL_POLL_INTERVAL = 0.1
+
+
+class CommandResult:
+    """Outcome of executed command"""
+
+    def __init__(self, command, host):
+        self.command = command
+        self.host = host
+        self.exit_status = None
+        self.timed_out = False
+        self.cancelled = False
+        self.duration = 0.0
+        self.streams = {"stdout": _Stream(), "stderr": _Stream()}
+
+    @property
+    def stdout(self):
+        """Whole stdout, empty when the command ran with capture=False"""
+        return self.streams["stdout"].text()
+
+    @property
+    def stderr(self):
+        return self.streams["stderr"].text()
+
+    def tail(self, stream, lines=RING_LINES):
+        """Last lines of stream (stdout/stderr) kept for error reports"""
+        return "\n".join(list(self.streams[stream].ring)[-lines:])
+
+    def describe(self):
+        """Error report with exit status and last output lines"""
+        if self.timed_out:
+            status = f"timed out after {self.duration:.1f}s"
+        elif self.cancelled:
+            status = "was cancelled"
+        else:
+            status = f"failed with exit code {self.exit_status}"
+        return f"{status}\nSTDOUT:\n{self.tail('stdout')}\nSTDERR:\n{self.tail('stderr')}"
+
+
+class _Stream:
+    """Splits incoming bytes into lines, keeps last lines in ring buffer and optionally whole output"""
+
+    def __init__(self):
+        self.ring = collections.deque(maxlen=RING_LINES)
+        self.chunks = None
+        self.pending = b""
+
+    def feed(self, data, on_line, name):
+        if self.chunks is not None:
+            self.chunks.append(data)
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self._emit(line, on_line, name)
+
+    def close(self, on_line, name):
+        if self.pending:
+            self._emit(self.pending, on_line, name)
+            self.pending = b""
+
+    def _emit(self, line, on_line, name):
+        line = line.rstrip(b"\r").decode("utf-8", errors="replace")
+        self.ring.append(line)
+        if on_line:
+            on_line(name, line)
+
+    def text(self):
+        return b"".join(self.chunks or []).decode("utf-8", errors="replace")
+
+
+async def execute(command, client=None, timeout=None, on_line=None, capture=True, cancel=None):
+    """
+    Executes command locally or on remote host
+    :param command: Shell command
+    :param client: SSH client (RemoteSession), the command is executed remotely when set
+    :param timeout: Seconds after which the command is killed, no limit if None
+    :param on_line: Callback called with stream name (stdout/stderr) and line as soon as the line is read
+    :param capture: Keep whole output in CommandResult.stdout/stderr, otherwise only the ring buffers are kept
+    :param cancel: Optional threading.Event (or other object with is_set()), the command is killed when it is set
+                   (e.g. from another thread)
+    :return: CommandResult, it is returned (not raised) also for failed and timed out commands
+    """
+    result = CommandResult(command, client.host if client else "local")
+    for stream in result.streams.values():
+        stream.chunks = [] if capture else None
+
+    def emit(name, line):
+        logging.debug(f"[{result.host}] {name}: {line}")
+        if on_line:
+            on_line(name, line)
+
+    start = time.monotonic()
+    runner = _execute_remote(command, client, result, emit) if client else _execute_local(command, result, emit)
+    if cancel is not None:
+        runner = _until_cancelled(runner, cancel, result)
+    try:
+        await asyncio.wait_for(runner, timeout)
+    except asyncio.TimeoutError:
+        result.timed_out = True
+    except asyncio.CancelledError:
+        result.cancelled = True
+        raise
+    finally:
+        result.duration = time.monotonic() - start
+        for name, stream in result.streams.items():
+            stream.close(emit, name)
+    return result
+
+
+async def _until_cancelled(runner, cancel, result):
+    """Runs coroutine until it finishes or cancel event is set"""
+    task = asyncio.ensure_future(runner)
+    try:
+        while not task.done():
+            if cancel.is_set():
+                result.cancelled = True
+                task.cancel()
+                break
+            await asyncio.wait({task}, timeout=CANCEL_POLL_INTERVAL)
+        await task
+    except asyncio.CancelledError:
+        if not result.cancelled:
+            raise
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+async def _execute_local(command, result, emit):
+    # Own process group, so that killing it also kills processes started by the shell
+    process = await asyncio.create_subprocess_shell(command, stdin=asyncio.subprocess.DEVNULL,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                    start_new_session=True)
+
+    async def drain(name, reader):
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                return
+            result.streams[name].feed(data, emit, name)
+
+    try:
+        await asyncio.gather(drain("stdout", process.stdout), drain("stderr", process.stderr))
+        result.exit_status = await process.wait()
+    finally:
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+
+async def _execute_remote(command, client, result, emit):
+    _stdin, stdout, _stderr = client.exec_command(command)
+    channel = stdout.channel
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    # Channel fileno is a pipe signalled when data arrives on stdout or stderr or the channel is closed
+    fd = channel.fileno()
+    loop.add_reader(fd, ready.set)
+    try:
+        while True:
+            while channel.recv_ready():
+                result.streams["stdout"].feed(channel.recv(READ_SIZE), emit, "stdout")
+            while channel.recv_stderr_ready():
+                result.streams["stderr"].feed(channel.recv_stderr(READ_SIZE), emit, "stderr")
+            if (channel.eof_received or channel.closed) and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+            ready.clear()
+            await ready.wait()
+        result.exit_status = await loop.run_in_executor(None, channel.recv_exit_status)
+    finally:
+        loop.remove_reader(fd)
+        if result.exit_status is None:
+            channel.close()
+
+
+def run(command, client=None, timeout=None, on_line=None, capture=True, cancel=None):
+    """
+    Blocking wrapper of execute(), safe to call from any thread without running event loop
+    :return: CommandResult
+    """
+    return asyncio.run(execute(command, client, timeout, on_line, capture, cancel))
@@ -1,66 +1,442 @@
+import json
 import logging
+import math
+import shlex
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import config
-from utils.const import related_images, repositories, basic_images
-from utils.utils import run_command, convert_to_json
+from utils.build_index import get_build_index, get_build_key, get_build_lock
+from utils.const import brew_proxy, related_images, repositories, basic_images
+from utils.manifest import ImageManifest
+from utils.mirror import get_mirror_for
+from utils.podman import get_podman_api, get_pull_backend, pull_image
+from utils.policy import carry, current_deadline, get_step_timeout, hedge, retry
+from utils.remote import run_script
+from utils.trace import span
+from utils.utils import run_command, read_file
 
+# Prefix of lines printed by the copy script, followed by job index and what the line reports
+COPY_MARKER = "mta-copy"
 
-def pull_tag_images(mta_version, output_file, client=None):
+
+def deploy_images(mta_version, build, image_list=None, client=None, workers=1, sync=False, remove_old=True,
+                  targets=None):
+    """
+    Brings images of the deployed build to local or remote storage
+    :param mta_version: MTA version to be deployed
+    :param build: Build number or stage/candidate/ga
+    :param image_list: ImageManifest or output with list of images, required for build numbers
+    :param client: SSH client, optional parameter to deploy images on remote host
+    :param workers: Number of images pulled concurrently
+    :param sync: Keep images already present in storage instead of removing and pulling everything again
+    :param remove_old: Remove old images of the version first, callers scheduling the removal separately disable it
+    :param targets: Names of images to be deployed, all images of the build are deployed if None
+    :return: Per-image report
+    """
+    jobs = get_image_jobs(mta_version, build, image_list, client)
+    if targets is not None:
+        jobs = [job for job in jobs if get_job_target(job) in targets]
+    with span("images", host=client.host if client else "local", images=len(jobs)):
+        if sync:
+            return sync_images(jobs, client, workers)
+        if remove_old:
+            remove_old_images(mta_version, client=client)
+        return run_image_jobs(jobs, client, workers)
+
+
+def get_image_jobs(mta_version, build, image_list=None, client=None):
+    """
+    Builds pull/tag jobs for images of the deployed build
+    :param mta_version: MTA version to be deployed
+    :param build: Build number or stage/candidate/ga
+    :param image_list: ImageManifest or output with list of images, required for build numbers
+    :param client: SSH client of the host pulling the images, images are pulled through the registry mirror
+                   only if the host can reach it
+    :return: List of job dicts with image, pull_url, tag and digest
+    """
+    if build == "stage" or build == "candidate" or build == "ga":
+        jobs = get_stage_ga_image_jobs(mta_version, build)
+    else:
+        jobs = get_bundle_image_jobs(mta_version, image_list)
+    mirror = get_mirror_for(client)
+    if mirror:
+        # Pull through the registry mirror, the image is tagged to its final name afterwards. A slow pull
+        # can be hedged by pulling from the upstream registry directly
+        for job in jobs:
+            job["tag"] = get_job_target(job)
+            job["alternate"] = job["pull_url"]
+            job["pull_url"] = mirror.rewrite(job["pull_url"])
+    return jobs
+
+
+def get_job_target(job):
+    """Returns final name of the image produced by a pull/tag job"""
+    return job["tag"] or job["pull_url"]
+
+
+def get_alternate_source(job):
+    """
+    Returns alternate pull URL a slow pull of the job is hedged with, None if there is none
+    :param job: Job dict, its alternate is set when it is pulled through the registry mirror
+    """
+    if job.get("alternate"):
+        return job["alternate"]
+    for prefix, alternate in (config.PULL_ALTERNATES or {}).items():
+        if job["pull_url"].startswith(prefix.rstrip("/") + "/"):
+            return alternate.rstrip("/") + job["pull_url"][len(prefix.rstrip("/")):]
+    return None
+
+
+def pull_tag_images(mta_version, output_file, client=None, workers=1):
     """
     Pulls and tags images from the list it gets
     :param mta_version: MTA version to be deployed
     :param output_file: Output with list of images to be pulled. Can be generated and forwarded here or provided as CLI parameter
     :param client: SSH client, optional parameter. Will be used to connect to remote host and pull images there if present.
+    :param workers: Number of images pulled concurrently, 1 keeps the pulls sequential
+    :return: Per-image report, list of dicts with image, status, duration and error
     """
-    related_images = convert_to_json(output_file).get('related_images_pullspecs', None)
+    return run_image_jobs(get_bundle_image_jobs(mta_version, output_file), client, workers)
+
+
+def pull_stage_ga_images(mta_version, repo, client=None, workers=1):
+    """
+    Pulls images for Stage / GA
+    :param mta_version: MTA version to be pulled
+    :param repo: either ga or stage to be pulled
+    :param client: SSH client, optional parameter to pull images on remote host
+    :param workers: Number of images pulled concurrently, 1 keeps the pulls sequential
+    :return: Per-image report, list of dicts with image, status, duration and error
+    """
+    return run_image_jobs(get_stage_ga_image_jobs(mta_version, repo), client, workers)
+
+
+def get_bundle_image_jobs(mta_version, output_file):
+    """
+    Builds pull/tag jobs for images of a bundle build
+    :param mta_version: MTA version to be deployed
+    :param output_file: ImageManifest or output with list of images to be pulled
+    :return: List of job dicts with image, pull_url, tag and digest
+    """
+    manifest = ImageManifest.load(output_file)
     required_version_tuple = (7, 3, 0)
     current_version_tuple = tuple(map(int, mta_version.split('.')))
-    if related_images:  # If related images are present then proceed
-        keywords = ['java', 'generic', 'dotnet', 'cli']
-        for image in related_images:
-            if any(keyword in image for keyword in keywords):  # Check if the image contains any of the keywords.
-                logging.info(f"Image : {image}")
-                # Pull image from registry-proxy.engineer.redhat.com
-                proxy_image_url = 'brew.registry.redhat.io/rh-osbs/mta-{}'.format(image.split('/')[-1])
-                pull_command = f'podman pull {proxy_image_url} --tls-verify=false'
-                logging.info(f'Pulling image: {proxy_image_url}')
-                run_command(pull_command, True, client)
-                logging.info('Pull successful')
-                tag_image = image.split('@sha')[-2]
-                if 'dotnet' in tag_image and current_version_tuple < required_version_tuple :
-                    tag_image = tag_image.replace("rhel9", "rhel8")
-                logging.info(f'Tagging image {proxy_image_url} to {tag_image}:{mta_version}')
-                tag_command = f'podman tag {proxy_image_url} {tag_image}:{mta_version}'  #Tag image to correct version
-                run_command(tag_command, True, client)
-                logging.info(f'Tagging {image} is completed...')
-
-
-def pull_stage_ga_images(mta_version, repo, client=None):
+    jobs = []
+    for record in manifest.deployed_images():
+        logging.info(f"Image : {record.pullspec}")
+        # Pull image from registry-proxy.engineer.redhat.com
+        proxy_image_url = f"{brew_proxy}/rh-osbs/mta-{record.pullspec.split('/')[-1]}"
+        tag_image = record.name
+        if record.component.startswith('dotnet') and current_version_tuple < required_version_tuple:
+            tag_image = tag_image.replace("rhel9", "rhel8")
+        jobs.append({"image": record.pullspec, "pull_url": proxy_image_url, "tag": f"{tag_image}:{mta_version}",
+                     "digest": record.digest})
+    return jobs
+
+
+def get_stage_ga_image_jobs(mta_version, repo):
     """
-    Pulls images for Stage / GA
+    Builds pull/tag jobs for Stage / GA images
     :param mta_version: MTA version to be pulled
     :param repo: either ga or stage to be pulled
-    :return:
+    :return: List of job dicts with image, pull_url, tag and digest (always None, images are pulled by tag)
     """
     required_version_tuple = (7, 3, 0)
     current_version_tuple = tuple(map(int, mta_version.split('.')))
     images = basic_images + related_images
+    jobs = []
 
     for image in images:
         if 'dotnet' in image and current_version_tuple < required_version_tuple:
             image = image.replace("rhel9", "rhel8")
         image_url = repositories.get(repo) + f'/mta/{image}:{mta_version}'
         logging.info(f"Processing repository: {repo} (url: {image_url})")
-        # Pull the image
-        pull_command = f"podman pull {image_url} --tls-verify=false"
-        run_command(pull_command, client=client)
-        logging.info(f"Pulled image from {repo}")
         # Tag the image based on the repository type
-        tag_command = f"podman tag {image_url} {repositories.get('ga') + f'/mta/{image}:{mta_version}'}"
+        tag = None
         if repo != 'ga' and repo != 'candidate':
-            run_command(tag_command, client=client)
-            logging.info(f"Tagged image {image} to ga")
+            tag = repositories.get('ga') + f'/mta/{image}:{mta_version}'
+        jobs.append({"image": image, "pull_url": image_url, "tag": tag, "digest": None})
+    return jobs
+
+
+def get_local_images(client=None):
+    """
+    Lists images present in local or remote storage
+    :param client: SSH client, optional parameter to inspect remote storage
+    :return: Tuple of dicts: digest -> image ID, image ID -> set of names
+    """
+    api = get_podman_api(client)
+    if api:
+        images = api.list_images()
+    else:
+        out, _err = run_command("podman images --format json", client=client)
+        images = json.loads(out or "[]")
+    by_digest, names = {}, {}
+    for image in images:
+        image_id = image.get("Id") or image.get("ID")
+        names[image_id] = set(image.get("Names") or [])
+        digests = [image.get("Digest")] + [repo_digest.split("@")[-1] for repo_digest in image.get("RepoDigests") or []]
+        for digest in digests:
+            if digest:
+                by_digest[digest] = image_id
+    return by_digest, names
+
+
+def sync_images(jobs, client=None, workers=1):
+    """
+    Brings storage to the required set of images with minimal work: images whose digest is already
+    present are skipped or only retagged, only missing ones are pulled.
+    :param jobs: List of job dicts, see get_bundle_image_jobs
+    :param client: SSH client, optional parameter to sync images on remote host
+    :param workers: Number of images pulled concurrently
+    :return: Per-image report with action (skipped/retagged/pulled)
+    """
+    by_digest, names = get_local_images(client)
+    skipped, retag, pull = [], [], []
+    for job in jobs:
+        image_id = by_digest.get(job["digest"]) if job["digest"] else None
+        if not image_id:
+            pull.append(job)
+        elif not job["tag"] or job["tag"] in names[image_id]:
+            skipped.append(job)
+        else:
+            retag.append((job, image_id))
+
+    reports = [{"image": job["image"], "status": "ok", "action": "skipped", "duration": 0.0, "error": None}
+               for job in skipped]
+    if retag:
+        api = get_podman_api(client)
+        if api:
+            for job, image_id in retag:
+                api.tag(image_id, job["tag"])
+        else:
+            # All retags are done by one script, remotely it is a single round trip
+            run_script([f"podman tag {image_id} {job['tag']}" for job, image_id in retag], client=client)
+        reports += [{"image": job["image"], "status": "ok", "action": "retagged", "duration": 0.0, "error": None}
+                    for job, _image_id in retag]
+    if pull:
+        for report in run_image_jobs(pull, client, workers):
+            report.setdefault("action", "pulled")
+            reports.append(report)
+
+    logging.info(f"Image sync: {len(skipped)} skipped, {len(retag)} retagged, {len(pull)} pulled")
+    for report in reports:
+        logging.info(f"Image {report['image']}: {report['action']}")
+    return reports
+
+
+def pull_tag_image(job, client=None):
+    """
+    Pulls a single image and tags it if a tag is requested. Runs as an independent job.
+    :param job: Dict with image name, pull_url and tag (tag can be None)
+    :param client: SSH client, optional parameter to pull the image on remote host
+    :return: Dict with image, status, duration and error
+    """
+    with span("pull", image=job["image"], host=client.host if client else "local") as attrs:
+        report = _pull_tag_image(job, client)
+        attrs["status"] = report["status"]
+        if report.get("source") == "alternate":
+            attrs["source"] = "alternate"
+    return report
+
+
+def _pull_tag_image(job, client):
+    start = time.monotonic()
+    report = {"image": job["image"], "status": "ok", "duration": 0.0, "error": None}
+    api = get_podman_api(client)
+    alternate = get_alternate_source(job)
+    step = f"Pull of {job['image']}"
+    try:
+        if alternate and config.HEDGE_AFTER:
+            image, source = retry(lambda: hedge(lambda cancel: _pull(job["pull_url"], job, client, api, cancel),
+                                                lambda cancel: _pull(alternate, job, client, api, cancel),
+                                                float(config.HEDGE_AFTER), step), step)
+        else:
+            image, source = retry(lambda: _pull(job["pull_url"], job, client, api), step), "primary"
+        report["source"] = source
+        # Image pulled from the alternate source is tagged to the name the primary pull would give it
+        tag = get_job_target(job) if source == "alternate" else job["tag"]
+        if tag:
+            logging.info(f"Tagging image {image} to {tag}")
+            if api:
+                api.tag(image, tag)
+            else:
+                run_command(f"podman tag {image} {tag}", True, client)
+            logging.info(f"Tagging {job['image']} is completed...")
+    except SystemExit as err:
+        # run_command reports failures via SystemExit, keep them per image instead of aborting other pulls
+        report["status"] = "failed"
+        report["error"] = str(err)
+    report["duration"] = time.monotonic() - start
+    return report
+
+
+def _pull(reference, job, client, api, cancel=None):
+    """
+    Pulls one reference of the job, bound by the pull step timeout
+    :return: Image ID (API) or reference (CLI) the pulled image can be tagged by
+    """
+    logging.info(f"Pulling image: {reference}")
+    if api:
+        current_deadline().check(f"Pull of {reference}")
+        return pull_image(api, reference, job["image"], current_deadline().watch(cancel))["id"]
+    # Pull progress is logged as it arrives, only the last lines are kept for the error report
+    run_command(f"podman pull {reference} --tls-verify=false", True, client, capture=False,
+                timeout=get_step_timeout("pull", f"Pull of {reference}"), cancel=cancel,
+                on_line=lambda _stream, line: logging.info(f"[{job['image']}] {line}"))
+    logging.info(f"Pull successful: {reference}")
+    return reference
+
+
+def get_copy_script(jobs, workers):
+    """
+    Script copying images from registries directly into containers-storage under their final names.
+    Jobs are split into lanes running concurrently, every lane copies its images one by one.
+    Prints "mta-copy unsupported" if skopeo is missing or storage isn't local to the host (podman machine),
+    otherwise for every job its skopeo output, layers of the stored image and exit status of the copy.
+    :param jobs: List of job dicts, see get_bundle_image_jobs
+    :param workers: Number of lanes
+    :return: Shell script
+    """
+    layers_format = shlex.quote("{{json .LayersData}}")
+    lines = ['if [ "$(uname -s)" != Linux ] || ! command -v skopeo >/dev/null 2>&1; then',
+             f'  echo "{COPY_MARKER} unsupported"; exit 0',
+             'fi',
+             'tmp=$(mktemp -d)',
+             'copy_image() {',
+             '  if skopeo copy --src-tls-verify=false "docker://$2" "containers-storage:$3" > "$tmp/$1.log" 2>&1; then',
+             '    status=0',
+             '  else',
+             '    status=$?',
+             '  fi',
+             f'  sed "s/^/{COPY_MARKER} $1 log /" "$tmp/$1.log"',
+             '  if [ $status -eq 0 ]; then',
+             f'    echo "{COPY_MARKER} $1 layers $(skopeo inspect --format {layers_format} "containers-storage:$3" 2>/dev/null)"',
+             '  fi',
+             f'  echo "{COPY_MARKER} $1 status $status"',
+             '}']
+    for lane in range(workers):
+        copies = [f"copy_image {index} {shlex.quote(job['pull_url'])} {shlex.quote(get_job_target(job))}"
+                  for index, job in enumerate(jobs) if index % workers == lane]
+        if copies:
+            lines.append("(" + "; ".join(copies) + ") &")
+    lines += ["wait", 'rm -rf "$tmp"']
+    return "\n".join(lines)
+
+
+def get_copied_bytes(layers, log):
+    """
+    :param layers: LayersData of the stored image, list of dicts with Digest and Size
+    :param log: skopeo copy output lines
+    :return: Tuple of bytes copied and number of layers skopeo found in storage already
+    """
+    reused = [line.split()[2].split(":")[-1] for line in log
+              if line.startswith("Copying blob") and "skipped" in line and len(line.split()) > 2]
+    copied, skipped = 0, 0
+    for layer in layers or []:
+        digest = (layer.get("Digest") or "").split(":")[-1]
+        if digest and any(digest.startswith(prefix) for prefix in reused):
+            skipped += 1
+        else:
+            copied += int(layer.get("Size") or 0)
+    return copied, skipped
+
+
+def copy_images(jobs, client=None, workers=1):
+    """
+    Copies images from registries into storage under their final names. All images of the host are copied by
+    one script, there is no separate tag step and remotely it is a single round trip.
+    :param jobs: List of job dicts, see get_bundle_image_jobs
+    :param client: SSH client, optional parameter to copy images on remote host
+    :param workers: Number of concurrent copies
+    :return: Tuple of per-image reports of copied images (action copied, bytes, layers and reused layers) and
+             list of jobs to be pulled by podman: failed copies, or all jobs if skopeo can't be used on the host
+    """
+    host = client.host if client else "local"
+    # Images pulled by digest only have no name they could be stored under, podman pulls them
+    fallback = [job for job in jobs if "@" in get_job_target(job)]
+    copyable = [job for job in jobs if "@" not in get_job_target(job)]
+    if not copyable:
+        return [], jobs
+    workers = max(1, min(int(workers or 1), len(copyable)))
+    start = time.monotonic()
+    results = {index: {"log": [], "layers": None, "status": None, "duration": 0.0} for index in range(len(copyable))}
+    unsupported = []
+
+    def on_line(_stream, line):
+        parts = line.split(" ", 3)
+        if parts[:2] == [COPY_MARKER, "unsupported"]:
+            unsupported.append(line)
+        if len(parts) < 3 or parts[0] != COPY_MARKER or not parts[1].isdigit() or int(parts[1]) not in results:
+            return
+        result, kind, value = results[int(parts[1])], parts[2], parts[3] if len(parts) > 3 else ""
+        if kind == "log":
+            logging.info(f"[{copyable[int(parts[1])]['image']}] {value}")
+            result["log"].append(value)
+        elif kind in ("layers", "status"):
+            result[kind] = value
+            result["duration"] = time.monotonic() - start
+
+    timeout = get_step_timeout("pull", f"Copy of images to {host}")
+    logging.info(f"Copying {len(copyable)} images to storage of {host} using {workers} workers")
+    with span("copy", host=host, images=len(copyable)) as attrs:
+        run_command(get_copy_script(copyable, workers), False, client, capture=False, on_line=on_line,
+                    timeout=timeout * math.ceil(len(copyable) / workers) if timeout else None)
+        if unsupported:
+            attrs["fallback"] = len(jobs)
+            logging.warning(f"skopeo can't copy into storage of {host}, images are pulled by podman")
+            return [], jobs
+        reports = []
+        for index, job in enumerate(copyable):
+            result = results[index]
+            if result["status"] != "0":
+                logging.warning(f"Copy of {job['image']} failed, pulling it by podman: "
+                                f"{' '.join(result['log'][-3:]) or 'no output'}")
+                fallback.append(job)
+                continue
+            try:
+                layers = json.loads(result["layers"] or "null") or []
+            except ValueError:
+                layers = []
+            copied, reused = get_copied_bytes(layers, result["log"])
+            reports.append({"image": job["image"], "status": "ok", "action": "copied", "duration": result["duration"],
+                            "error": None, "bytes": copied, "layers": len(layers), "reused": reused})
+        attrs.update(bytes=sum(report["bytes"] for report in reports), copied=len(reports), fallback=len(fallback))
+    for report in reports:
+        logging.info(f"Copied {report['image']} to {host}: {report['bytes'] / 1024 ** 2:.1f} MB in "
+                     f"{report['duration']:.1f}s, {report['reused']} of {report['layers']} layers already stored")
+    return reports, fallback
+
+
+def run_image_jobs(jobs, client=None, workers=1):
+    """
+    Runs pull/tag jobs either sequentially or concurrently and collects per-image report.
+    With the skopeo pull backend images are copied by copy_images first, podman pulls those it couldn't copy.
+    :param jobs: List of job dicts, see pull_tag_image
+    :param client: SSH client, optional parameter to pull images on remote host
+    :param workers: Number of concurrent pulls
+    :return: Per-image report. Raises SystemExit after all jobs are finished if any of them failed
+    """
+    reports = []
+    if get_pull_backend() == "skopeo" and jobs:
+        reports, jobs = copy_images(jobs, client, workers)
+    workers = max(1, min(int(workers or 1), len(jobs) or 1))
+    if workers == 1:
+        reports += [pull_tag_image(job, client) for job in jobs]
+    else:
+        logging.info(f"Pulling {len(jobs)} images using {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            reports += list(executor.map(carry(lambda job: pull_tag_image(job, client)), jobs))
+
+    for report in reports:
+        logging.info(f"Image {report['image']}: {report['status']} ({report['duration']:.1f}s)")
+    failed = [report for report in reports if report["status"] != "ok"]
+    if failed:
+        details = "\n".join(f"{report['image']}: {report['error']}" for report in failed)
+        raise SystemExit(f"Failed to pull {len(failed)} of {len(reports)} images:\n{details}")
+    return reports
 
 
 def remove_old_images(version="upstream", client=None):
@@ -69,23 +445,29 @@ def remove_old_images(version="upstream", client=None):
     :param version: MTA version to be cleaned up
     :param client: SSH client, optional parameter to run cleanup remotely
     """
+    with span("image_removal", host=client.host if client else "local"):
+        _remove_old_images(version, client)
+
+
+def _remove_old_images(version, client):
+    api = get_podman_api(client)
+    if api:
+        try:
+            image_ids = sorted({image["Id"] for image in api.list_images()
+                                if any("registry" in name and version in name for name in image.get("Names") or [])})
+            for image_id in image_ids:
+                api.remove(image_id)
+                logging.info(f"Image {image_id[:12]} was removed successfully")
+        except SystemExit as e:
+            logging.error(f"Error while removing images: {e}")
+        return
+    # Listing and removal are done by one script, remotely it is a single round trip
+    list_command = f"podman images | grep registry | grep -F -- {shlex.quote(version)} | awk '{{print $3}}' | sort -u"
+    script = [f"images=$({list_command})",
+              'if [ -n "$images" ]; then echo "$images"; podman rmi $images --force >&2; fi']
     try:
-        result, result_err = run_command("podman images", client=client)
-        # logging.info(f"List of images: {result}")
-
-        # Filtering lines that contain "registry" and version
-        images = []
-
-        for line in result.splitlines():  # result is already a string
-            columns = line.split()
-            if "registry" in line and version in line:
-                # Third column - IMAGE ID
-                if len(columns) >= 3:
-                    images.append(columns[2])
-
-        # Deleting images gotten after filtering
-        for image in images:
-            run_command(f"podman rmi {image} --force", client=client)
+        result, result_err = run_script(script, client=client)
+        for image in result.split():
             logging.info(f"Image {image} was removed successfully")
     except subprocess.CalledProcessError as e:
         logging.error(f"Error while performing command: {e}")
@@ -93,6 +475,34 @@ def remove_old_images(version="upstream", client=None):
         logging.error(f"Unexpected error: {e}")
 
 
+def get_image_manifest(version, build, image_output_file=None):
+    """
+    Returns images list of the build, parsed once: from the file given as CLI argument, from the build index
+    or generated by GET_IMAGES_OUTPUT
+    :param version: MTA version, for example 7.2.0
+    :param build: build number
+    :param image_output_file: Optional file with output of GET_IMAGES_OUTPUT
+    :return: ImageManifest
+    """
+    if image_output_file:
+        logging.info(f"Using images list provided as CLI argument: {image_output_file}")
+        return ImageManifest.parse(read_file(image_output_file))
+    index = get_build_index()
+    key = get_build_key(version, build)
+    # Concurrent jobs of the same build wait for the first one, then read its images list from the index
+    with get_build_lock(key):
+        cached = index.get_image_list(key) if index else None
+        if cached:
+            logging.info(f"Using images list of {key} from build index")
+            return ImageManifest(cached)
+        logging.info(f"Generating images list for {version}-{build}")
+        image_list, stdout_err = generate_images_list(version, build)
+        manifest = ImageManifest.parse(image_list)
+        if index:
+            index.store_image_list(key, manifest.to_dict())
+        return manifest
+
+
 def generate_images_list(version, build):
     """
     Generates list of images and pulls them
@@ -101,4 +511,5 @@ def generate_images_list(version, build):
     :return: String containing list of images. Can be converted to JSON after that.
     """
     get_images_output_command = f'cd {config.MISC_DOWNSTREAM_PATH}; ./{config.GET_IMAGES_OUTPUT}{config.BUNDLE}{version}-{build}'
-    return run_command(get_images_output_command)
\ No newline at end of file
+    with span("image_list_generation", version=version, build=build):
+        return run_command(get_images_output_command)
@@ -0,0 +1,139 @@
+"""
+Image manifest of a bundle build.
+
+Output of GET_IMAGES_OUTPUT (a JSON object surrounded by log lines) is parsed once into ImageManifest with
+one compact record per related image and indexes by component and digest, so consumers resolve images by
+lookups instead of re-parsing the output and scanning image names.
+"""
+import json
+import logging
+import re
+
+# Components deployed with the CLI, other related images (operator, UI, ...) are not pulled
+DEPLOYED_KEYWORDS = ("java", "generic", "dotnet", "cli")
+NAME_RE = re.compile(r"^mta-(?P<component>.+?)(?:-(?P<rhel>rhel\d+))?$")
+# Possible start of JSON object: "{" followed by a key or by the end of empty object
+OBJECT_START_RE = re.compile(r'\{\s*["}]')
+
+_decoder = json.JSONDecoder()
+
+
+def find_json_object(text, required_keys=()):
+    """
+    Finds JSON object in text surrounded by other output. Objects are decoded incrementally starting at
+    every possible object start, so the text is not backtracked over and nested objects don't confuse the search.
+    :param text: Text containing the object
+    :param required_keys: Keys the object must have, the first decoded object is returned if empty
+    :return: Decoded dict
+    """
+    match = OBJECT_START_RE.search(text)
+    while match:
+        try:
+            value, end = _decoder.raw_decode(text, match.start())
+        except ValueError:
+            match = OBJECT_START_RE.search(text, match.start() + 1)
+            continue
+        if all(key in value for key in required_keys):
+            return value
+        match = OBJECT_START_RE.search(text, end)
+    raise ValueError("No JSON object found in input.")
+
+
+class ImageRecord:
+    """Related image of the bundle"""
+    __slots__ = ("pullspec", "name", "digest", "repository", "component", "rhel", "nvr")
+
+    def __init__(self, pullspec, nvr=None):
+        self.pullspec = pullspec
+        self.name, _, digest = pullspec.partition("@")
+        self.digest = digest or None
+        self.repository = self.name.split("/")[-1]
+        match = NAME_RE.match(self.repository)
+        self.component = match["component"] if match else self.repository
+        self.rhel = match["rhel"] if match else None
+        self.nvr = nvr
+
+    @property
+    def deployed(self):
+        return any(keyword in self.component for keyword in DEPLOYED_KEYWORDS)
+
+    def __repr__(self):
+        return f"ImageRecord({self.pullspec!r})"
+
+
+class ImageManifest:
+    """Parsed images list of a bundle build indexed by component and digest"""
+
+    def __init__(self, data):
+        self.data = data
+        nvrs = {}
+        for item in data.get("related_images") or []:
+            for repository, value in item.items():
+                if isinstance(value, dict) and value.get("nvr"):
+                    nvrs[repository] = value["nvr"]
+        self.records = [ImageRecord(pullspec) for pullspec in data.get("related_images_pullspecs") or []]
+        for record in self.records:
+            record.nvr = nvrs.get(record.repository)
+        self.nvrs = nvrs
+        self.deployed = [record for record in self.records if record.deployed]
+        self.by_component = {}
+        self.by_digest = {}
+        for record in self.records:
+            self.by_component.setdefault(record.component, record)
+            if record.digest:
+                self.by_digest[record.digest] = record
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parses output of GET_IMAGES_OUTPUT
+        :param text: Script output containing the JSON object
+        :return: ImageManifest
+        """
+        try:
+            data = find_json_object(text, ("related_images_pullspecs",))
+        except ValueError:
+            try:
+                data = find_json_object(text)
+            except ValueError as err:
+                raise SystemExit(f"There was an error converting string to JSON format: {err}")
+        manifest = cls(data)
+        logging.info(f"Images list parsed: {len(manifest.records)} related images")
+        return manifest
+
+    @classmethod
+    def load(cls, image_list):
+        """Returns ImageManifest for manifest, parsed dict or script output"""
+        if isinstance(image_list, cls):
+            return image_list
+        if isinstance(image_list, dict):
+            return cls(image_list)
+        return cls.parse(image_list)
+
+    def to_dict(self):
+        """Returns data the manifest was built from, ImageManifest(data) restores it"""
+        return self.data
+
+    def deployed_images(self):
+        """Records of images deployed with the CLI, in the order of the images list"""
+        return self.deployed
+
+    def get(self, component):
+        """Returns record of component (e.g. cli, java-external-provider) or None"""
+        return self.by_component.get(component)
+
+    def get_by_digest(self, digest):
+        return self.by_digest.get(digest)
+
+    def get_zip_folder_name(self):
+        """
+        Gets folder name where dependency zip is extracted, e.g. MTA-7.3.0-12, from the CLI image nvr
+        :return: Folder name or None if the manifest has no CLI nvr
+        """
+        nvr = self.nvrs.get("mta-cli-rhel9")
+        if nvr is None:
+            nvr = next((value for repository, value in self.nvrs.items() if "mta-cli-rhel9" in repository), None)
+        if nvr is None:
+            return None
+        _, major, minor = nvr.rsplit("-", 2)
+        return f"MTA-{major}-{minor}"
@@ -0,0 +1,68 @@
+"""
+Registry mirror of the process.
+
+The mirror is started by --registry_mirror, images pulled afterwards are routed through it. The mirror server
+(utils.registry_mirror) and the HTTP stack under it are imported only then, deployments without the mirror
+don't pay for loading them.
+"""
+import ipaddress
+import logging
+import os
+import threading
+
+import config
+
+DEFAULT_MIRROR_DIR = os.path.join("~", ".cache", "konveyor-cli-deployment", "registry")
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+def start_mirror():
+    """
+    Starts registry mirror configured in config.json, images pulled afterwards are routed through it
+    :return: Running RegistryMirror
+    """
+    global _mirror
+    with _mirror_lock:
+        if _mirror is None:
+            from utils.registry_mirror import BlobStore, RegistryMirror
+            store = BlobStore(config.MIRROR_DIR or DEFAULT_MIRROR_DIR,
+                              int(float(config.MIRROR_MAX_SIZE_GB) * 1024 ** 3))
+            _mirror = RegistryMirror(store, config.MIRROR_LISTEN, config.MIRROR_ADDRESS,
+                                     config.MIRROR_INSECURE_UPSTREAMS).start()
+        return _mirror
+
+
+def get_mirror():
+    """Returns running registry mirror or None"""
+    return _mirror
+
+
+def get_mirror_for(client=None):
+    """
+    Returns running registry mirror if the host can reach it, None otherwise. A mirror listening on loopback
+    of this machine (default mirror_listen) serves local deployments and hosts reached via loopback only
+    :param client: SSH client, optional parameter for remote host
+    """
+    mirror = _mirror
+    if mirror is None or client is None or not is_loopback(mirror.address) or is_loopback(client.host):
+        return mirror
+    logging.warning(f"Registry mirror listens on {mirror.address} which {client.host} can't reach, pulling "
+                    f"from upstream registries. Set mirror_listen (and mirror_address) in config.json to an address "
+                    f"of this machine in the network of the hosts")
+    return None
+
+
+def is_loopback(address):
+    """Tells whether host[:port] address is a loopback address"""
+    if address.startswith("["):
+        host = address[1:].split("]", 1)[0]
+    else:
+        host = address.rsplit(":", 1)[0] if address.count(":") == 1 else address
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
@@ -0,0 +1,67 @@
+"""
+Selection of the podman backend and of the way images are pulled.
+
+Podman is driven by its CLI unless --podman_backend api is used. The libpod REST API client (utils.podman_api)
+and the HTTP stack under it are imported only then, so deployments using the CLI don't pay for loading them.
+Images are pulled by podman unless --pull_backend skopeo is used, see utils.images.copy_images.
+"""
+import logging
+import threading
+
+_backend = "cli"
+_pull_backend = "podman"
+_local_api = None
+_apis_lock = threading.Lock()
+
+
+def set_podman_backend(backend):
+    """
+    Selects how podman is driven
+    :param backend: cli (podman processes) or api (libpod REST API)
+    """
+    global _backend
+    _backend = backend
+
+
+def set_pull_backend(backend):
+    """
+    Selects how images are brought to storage
+    :param backend: podman (pull, then tag) or skopeo (copy from registry to storage under the final name)
+    """
+    global _pull_backend
+    _pull_backend = backend
+
+
+def get_pull_backend():
+    return _pull_backend
+
+
+def get_podman_api(client=None):
+    """
+    Returns API client of local or remote podman, one per host, or None if the CLI backend is used
+    :param client: SSH client, optional parameter to get API of remote podman
+    """
+    global _local_api
+    if _backend != "api":
+        return None
+    from utils import podman_api
+    with _apis_lock:
+        if client is None:
+            if _local_api is None:
+                _local_api = podman_api.PodmanAPI()
+                logging.info(f"Using podman API at {_local_api.socket_path}")
+            return _local_api
+        # Kept with the connection, its channels are closed together with it
+        api = client.podman_api
+        if api is None:
+            api = client.podman_api = podman_api.PodmanAPI(client)
+            logging.info(f"Using podman API of {client.host} via dial-stdio")
+        return api
+
+
+def pull_image(api, reference, label, cancel=None):
+    """Pulls image using the API, logs progress and rate"""
+    report = api.pull(reference, on_line=lambda line: logging.info(f"[{label}] {line}"), cancel=cancel)
+    logging.info(f"Pulled {label}: {report['bytes'] / 1024 ** 2:.1f} MB in {report['duration']:.1f}s "
+                 f"({report['rate'] / 1024 ** 2:.1f} MB/s)")
+    return report
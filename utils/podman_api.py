@@ -0,0 +1,267 @@
+"""
+Podman REST API backend.
+
+Talks to the libpod REST API instead of spawning `podman` processes and parsing their text output. Locally
+the API is reached over the podman unix socket, on remote hosts through `podman system dial-stdio` running
+over the existing SSH connection. Connections are kept alive and pooled, so an image listing, pull or tag
+costs one HTTP request and no process spawn. Enabled with --podman_backend api.
+"""
+import http.client
+import io
+import json
+import os
+import socket
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+import config
+
+API_PREFIX = "/v4.0.0/libpod"
+DEFAULT_SOCKETS = (os.path.join(os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}"), "podman", "podman.sock"),
+                   "/run/podman/podman.sock")
+DIAL_COMMAND = "bash -lc 'podman system dial-stdio'"
+CONNECTION_ERRORS = (OSError, http.client.HTTPException, EOFError)
+
+
+def get_socket_path():
+    """Returns path of local podman socket: from config.json, CONTAINER_HOST or the default rootless/rootful one"""
+    if config.PODMAN_SOCKET:
+        return os.path.expanduser(config.PODMAN_SOCKET)
+    container_host = os.environ.get("CONTAINER_HOST", "")
+    if container_host.startswith("unix://"):
+        return container_host[len("unix://"):]
+    return next((path for path in DEFAULT_SOCKETS if os.path.exists(path)), DEFAULT_SOCKETS[0])
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    """HTTP connection over local unix socket"""
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class _ChannelReader(io.RawIOBase):
+    """Raw reader of SSH channel, buffered by io.BufferedReader which supports peek used by http.client"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.channel.recv(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class _ChannelSocket:
+    """Socket-like wrapper of SSH channel, enough for http.client"""
+
+    def __init__(self, channel, files=()):
+        self.channel = channel
+        # Stdin file shuts the channel down for writing when it is garbage collected
+        self.files = files
+
+    def sendall(self, data):
+        self.channel.sendall(data)
+
+    def makefile(self, mode, *args, **kwargs):
+        return io.BufferedReader(_ChannelReader(self.channel))
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        self.channel.close()
+
+
+class _DialStdioConnection(http.client.HTTPConnection):
+    """HTTP connection to podman socket of remote host, tunneled through `podman system dial-stdio`"""
+
+    def __init__(self, client, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.client = client
+
+    def connect(self):
+        files = self.client.exec_command(DIAL_COMMAND)
+        channel = files[1].channel
+        channel.settimeout(self.timeout)
+        self.sock = _ChannelSocket(channel, files)
+
+
+class PodmanAPI:
+    """Client of libpod REST API of local or remote podman"""
+
+    def __init__(self, client=None, socket_path=None, timeout=600):
+        self.client = client
+        self.socket_path = socket_path or (None if client else get_socket_path())
+        self.timeout = timeout
+        self.host = client.host if client else "local"
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self, reuse=True):
+        with self._lock:
+            if reuse and self._idle:
+                return self._idle.pop(), True
+        if self.client:
+            return _DialStdioConnection(self.client, self.timeout), False
+        return _UnixConnection(self.socket_path, self.timeout), False
+
+    def _release(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def _open(self, method, path, params=None):
+        """
+        Sends request and returns connection and response, the caller reads the response and releases the connection
+        """
+        url = f"{API_PREFIX}{path}" + (f"?{urlencode(params)}" if params else "")
+        connection, reused = self._connect()
+        while True:
+            try:
+                connection.request(method, url)
+                return connection, connection.getresponse()
+            except CONNECTION_ERRORS as err:
+                connection.close()
+                if not reused:
+                    raise SystemExit(f"Podman API of {self.host} is not reachable: {err}")
+                # Idle connection was closed by the service, retry with a new one
+                connection, reused = self._connect(reuse=False)
+
+    def request(self, method, path, params=None):
+        """
+        Sends request and reads whole response
+        :return: Tuple of status and decoded JSON body (None if the body is empty or not JSON)
+        """
+        connection, response = self._open(method, path, params)
+        try:
+            body = response.read()
+        except CONNECTION_ERRORS as err:
+            connection.close()
+            raise SystemExit(f"Podman API of {self.host} closed connection: {err}")
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        try:
+            return response.status, json.loads(body) if body else None
+        except ValueError:
+            return response.status, None
+
+    def _check(self, status, body, action):
+        if status >= 400:
+            message = body.get("message") if isinstance(body, dict) else body
+            raise SystemExit(f"Podman API {action} on {self.host} failed with status {status}: {message}")
+
+    def ping(self):
+        """Returns True if podman service responds"""
+        try:
+            status, _body = self.request("GET", "/_ping")
+            return status == 200
+        except SystemExit:
+            return False
+
+    def wait_ready(self, timeout=30.0):
+        """
+        Polls podman service with exponential backoff until it responds
+        :param timeout: Seconds to wait at most
+        :return: True if the service is ready
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        while True:
+            if self.ping():
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+    def list_images(self):
+        """
+        :return: List of image dicts with Id, Names, Digest, RepoDigests and Size
+        """
+        status, body = self.request("GET", "/images/json")
+        self._check(status, body, "image listing")
+        return body or []
+
+    def pull(self, reference, tls_verify=False, on_line=None, cancel=None):
+        """
+        Pulls image, pull progress is streamed as it arrives
+        :param reference: Image reference
+        :param tls_verify: Verify registry TLS certificate
+        :param on_line: Optional callback called with every progress line
+        :param cancel: Optional threading.Event, the pull is abandoned at the next progress line once it is set
+        :return: Dict with id, bytes (size of the pulled image), duration and rate in bytes per second
+        """
+        start = time.monotonic()
+        connection, response = self._open("POST", "/images/pull",
+                                          {"reference": reference, "tlsVerify": str(tls_verify).lower()})
+        image_id, error = None, None
+        try:
+            if response.status >= 400:
+                body = response.read()
+                connection.close()
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    pass
+                self._check(response.status, body, f"pull of {reference}")
+            for line in iter(response.readline, b""):
+                if cancel is not None and cancel.is_set():
+                    connection.close()
+                    raise SystemExit(f"Podman API pull of {reference} on {self.host} was cancelled")
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event.get("error"):
+                    error = event["error"]
+                elif event.get("stream") and on_line:
+                    on_line(event["stream"].rstrip())
+                image_id = event.get("id") or image_id
+        except CONNECTION_ERRORS as err:
+            connection.close()
+            raise SystemExit(f"Podman API of {self.host} closed connection during pull of {reference}: {err}")
+        self._release(connection)
+        if error or not image_id:
+            raise SystemExit(f"Podman API pull of {reference} on {self.host} failed: {error or 'no image pulled'}")
+
+        duration = time.monotonic() - start
+        status, image = self.request("GET", f"/images/{quote(image_id, safe='')}/json")
+        size = image.get("Size", 0) if status == 200 and image else 0
+        return {"id": image_id, "bytes": size, "duration": duration, "rate": size / duration if duration else 0.0}
+
+    def tag(self, image, target):
+        """
+        Tags image
+        :param image: Name or ID of the image
+        :param target: New name, e.g. registry.redhat.io/mta/mta-cli-rhel9:7.3.0
+        """
+        repository, tag = target, "latest"
+        name, separator, suffix = target.rpartition(":")
+        if separator and "/" not in suffix:
+            repository, tag = name, suffix
+        status, body = self.request("POST", f"/images/{quote(image, safe='')}/tag", {"repo": repository, "tag": tag})
+        self._check(status, body, f"tag of {image} to {target}")
+
+    def remove(self, image, force=True):
+        """Removes image by name or ID"""
+        status, body = self.request("DELETE", f"/images/{quote(image, safe='')}", {"force": str(force).lower()})
+        self._check(status, body, f"removal of {image}")
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
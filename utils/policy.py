@@ -0,0 +1,209 @@
+"""
+Deadlines, retries and hedging of external operations.
+
+A deployment runs under a Deadline: an optional overall time limit and a cancel event. Every external step
+(command, image pull, download, HTTP request, SSH connection) takes its timeout from step_timeouts in
+config.json, capped by the time left until the deadline, and is killed when the deadline is cancelled.
+The deadline is kept per thread, functions handed to thread pools are wrapped by carry() to run under the
+deadline of the thread which submitted them.
+
+Steps failing with errors classified as transient (timeouts, dropped connections, HTTP 429/5xx) are retried
+with jittered exponential backoff. A slow image pull can be hedged: when it doesn't finish within hedge_after
+seconds, the same image is pulled from an alternate source as well and the first pull to finish wins.
+"""
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import config
+
+DEFAULT_STEP_TIMEOUTS = {"pull": 1800, "download": 300, "http": 30, "ssh_connect": 30}
+DEFAULT_RETRIES = {"attempts": 3, "base_delay": 1.0, "max_delay": 30.0}
+TRANSIENT_PATTERN = re.compile(
+    r"timed out|timeout|connection (reset|refused|closed|aborted)|broken pipe|unexpected eof|\beof\b|"
+    r"temporary failure|temporarily unavailable|too many requests|service unavailable|bad gateway|"
+    r"gateway time|\bhttp (429|5\d\d)\b|tls handshake|no route to host|network is unreachable|"
+    r"error reading ssh protocol banner", re.IGNORECASE)
+
+_context = threading.local()
+
+
+class Deadline:
+    """Overall time limit and cancellation of a deployment"""
+
+    def __init__(self, seconds=None, cancel=None):
+        """
+        :param seconds: Time limit, no limit if None or 0
+        :param cancel: Optional threading.Event cancelling all steps when it is set
+        """
+        self.seconds = seconds
+        self.expires = time.monotonic() + float(seconds) if seconds else None
+        self.cancel = cancel or threading.Event()
+
+    def remaining(self):
+        """Seconds left, None if there is no limit"""
+        return None if self.expires is None else max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def is_set(self):
+        """True once the deadline is cancelled or expired, so it can be used as cancel event of commands"""
+        return self.cancel.is_set() or self.expired()
+
+    def check(self, step):
+        """Raises SystemExit if step can't be started or continued anymore"""
+        if self.cancel.is_set():
+            raise SystemExit(f"{step} stopped, deployment was cancelled")
+        if self.expired():
+            raise SystemExit(f"{step} stopped, deadline of {self.seconds}s exceeded")
+
+    def timeout(self, step, timeout=None):
+        """
+        :param step: Step name used in the error raised when the deadline is over
+        :param timeout: Timeout of the step, None for no limit
+        :return: Timeout capped by the time left, None if neither is limited
+        """
+        self.check(step)
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(float(timeout), remaining)
+
+    def sleep(self, seconds):
+        """Sleeps up to seconds, returns early when the deadline is cancelled or expires"""
+        remaining = self.remaining()
+        self.cancel.wait(seconds if remaining is None else min(seconds, remaining))
+
+    def watch(self, cancel=None):
+        """Returns cancel event for a command, set when either the deadline or cancel is set"""
+        return self if cancel is None else _Either(self, cancel)
+
+
+class _Either:
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def is_set(self):
+        return self.first.is_set() or self.second.is_set()
+
+
+_default_deadline = Deadline()
+
+
+def current_deadline():
+    """Returns deadline of the current thread, deadline without limit if none was set"""
+    return getattr(_context, "deadline", None) or _default_deadline
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """Steps run in this context (and thread) are bound by deadline"""
+    previous = getattr(_context, "deadline", None)
+    _context.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _context.deadline = previous
+
+
+def carry(func):
+    """Wraps func to run under the deadline of the calling thread, for functions passed to thread pools"""
+    deadline = current_deadline()
+
+    def run(*args, **kwargs):
+        with deadline_scope(deadline):
+            return func(*args, **kwargs)
+    return run
+
+
+def get_step_timeout(kind, step=None):
+    """
+    :param kind: Step kind, key of step_timeouts in config.json (pull, download, http, ssh_connect)
+    :param step: Step name for the error raised when the deadline is over
+    :return: Timeout of the step capped by the current deadline, None for no limit
+    """
+    timeouts = dict(DEFAULT_STEP_TIMEOUTS, **(config.STEP_TIMEOUTS or {}))
+    return current_deadline().timeout(step or kind, timeouts.get(kind))
+
+
+def is_transient(err):
+    """Tells whether err is worth retrying: timeouts, dropped connections, rate limiting and server errors"""
+    if isinstance(err, (ConnectionError, TimeoutError)):
+        return True
+    return bool(TRANSIENT_PATTERN.search(str(err)))
+
+
+def backoff(attempt):
+    """Delay before retry number attempt: exponential, half of it randomized so that retries don't align"""
+    retries = dict(DEFAULT_RETRIES, **(config.RETRIES or {}))
+    delay = min(float(retries["max_delay"]), float(retries["base_delay"]) * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry(func, step, attempts=None, transient=is_transient):
+    """
+    Calls func until it succeeds, retrying transient errors with jittered exponential backoff
+    :param func: Callable without arguments
+    :param step: Step name for logs
+    :param attempts: Number of attempts, defaults to retries.attempts from config.json
+    :param transient: Callable classifying exceptions as worth retrying
+    :return: Value returned by func
+    """
+    deadline = current_deadline()
+    attempts = max(1, int(attempts or dict(DEFAULT_RETRIES, **(config.RETRIES or {}))["attempts"]))
+    for attempt in range(1, attempts + 1):
+        deadline.check(step)
+        try:
+            return func()
+        except (SystemExit, Exception) as err:
+            if attempt == attempts or deadline.is_set() or not transient(err):
+                raise
+            delay = backoff(attempt)
+            logging.warning(f"{step} failed ({str(err).splitlines()[0] if str(err) else type(err).__name__}), "
+                            f"retrying in {delay:.1f}s (attempt {attempt + 1}/{attempts})")
+            deadline.sleep(delay)
+
+
+def hedge(primary, alternate, after, step):
+    """
+    Runs primary, starts alternate as well when primary doesn't finish within after seconds or fails.
+    Both callables get a cancel event, the slower one is cancelled once the other succeeds.
+    :param primary: Callable taking cancel event
+    :param alternate: Callable taking cancel event
+    :param after: Seconds primary runs alone
+    :param step: Step name for logs
+    :return: Tuple of the value of the first callable which succeeded and its name (primary/alternate).
+             Raises error of primary if both fail
+    """
+    deadline = current_deadline()
+    cancels = {"primary": threading.Event(), "alternate": threading.Event()}
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = {executor.submit(carry(primary), deadline.watch(cancels["primary"])): "primary"}
+        done, _pending = wait(futures, timeout=after)
+        if not done or next(iter(done)).exception() is not None:
+            reason = "failed" if done else f"not finished after {after}s"
+            logging.info(f"{step} {reason}, hedging with the alternate source")
+            futures[executor.submit(carry(alternate), deadline.watch(cancels["alternate"]))] = "alternate"
+        errors = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                if future.exception() is None:
+                    for other in cancels:
+                        if other != name:
+                            cancels[other].set()
+                    return future.result(), name
+                errors[name] = future.exception()
+        raise errors.get("primary") or errors["alternate"]
+    finally:
+        # Cancelled pull doesn't need to be waited for
+        executor.shutdown(wait=False)
@@ -0,0 +1,98 @@
+"""
+Concurrent prefetch of dependency zips for mixed fleets.
+
+Every dependency zip variant needed by the fleet (`mta-<version>-cli-<os>-<arch>.zip` for stage/candidate/ga,
+`kantra.<os>.<arch>.zip` for upstream) is resolved and downloaded in one pass with bounded concurrency
+before any host deployment starts. Downloads go through the artifact cache, so zips prefetched by prefetch.py
+are only read from local disk by later deployments. Zips of bundle builds are extracted from the bundle
+by generate_zip, all variants at once, and are not prefetched.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.policy import carry
+from utils.trace import span
+from utils.utils import download_file, get_latest_upstream_assets, get_stage_ga_dependency_url
+from utils.zip import get_zip_name
+
+ALL_PLATFORMS = [("linux", "amd64"), ("linux", "arm64"), ("darwin", "amd64"), ("darwin", "arm64"),
+                 ("windows", "amd64")]
+PREFETCH_WORKERS = 4
+
+
+def parse_platforms(platforms):
+    """
+    :param platforms: Comma separated os/platform pairs, e.g. linux/amd64,darwin/arm64, or "all"
+    :return: List of (os, platform) tuples
+    """
+    if not platforms:
+        return []
+    if platforms.strip() == "all":
+        return list(ALL_PLATFORMS)
+    targets = []
+    for item in platforms.split(","):
+        host_os, _, host_platform = item.strip().partition("/")
+        if not host_os or not host_platform:
+            raise SystemExit(f"Invalid platform {item!r}, expected os/platform, e.g. linux/amd64")
+        targets.append((host_os, host_platform))
+    return targets
+
+
+def get_dependency_sources(version, build, upstream, targets):
+    """
+    Resolves URL and file name of the dependency zip of every target, upstream releases are listed only once
+    :param version: MTA version, None for upstream
+    :param build: stage/candidate/ga, None for upstream
+    :param upstream: Deploy latest upstream
+    :param targets: List of (os, platform) tuples
+    :return: Dict mapping (os, platform) to (url, file name)
+    """
+    sources = {}
+    if not (version and build) or upstream:
+        assets = get_latest_upstream_assets('konveyor', 'kantra')
+        for host_os, host_platform in targets:
+            zip_name = get_zip_name(os_name=host_os, machine=host_platform)
+            sources[(host_os, host_platform)] = (assets.get(zip_name), zip_name)
+    elif build == "stage" or build == "candidate" or build == "ga":
+        for host_os, host_platform in targets:
+            sources[(host_os, host_platform)] = get_stage_ga_dependency_url(version, build, host_os, host_platform)
+    else:
+        raise SystemExit(f"Dependency zips of build {build} are extracted from the bundle, they can't be prefetched")
+    return sources
+
+
+def prefetch_dependencies(version, build, upstream, targets, workers=PREFETCH_WORKERS):
+    """
+    Downloads dependency zips of all targets concurrently, every file only once
+    :param version: MTA version, None for upstream
+    :param build: stage/candidate/ga, None for upstream
+    :param upstream: Deploy latest upstream
+    :param targets: List of (os, platform) tuples
+    :param workers: Number of concurrent downloads
+    :return: Dict mapping (os, platform) to local zip path. Raises SystemExit after all downloads if any failed
+    """
+    targets = list(dict.fromkeys(targets))
+    sources = get_dependency_sources(version, build, upstream, targets)
+    files = {}
+    for url, file_name in sources.values():
+        files.setdefault(file_name, url)
+    workers = max(1, min(int(workers or 1), len(files) or 1))
+    logging.info(f"Prefetching {len(files)} dependency zips for {len(targets)} platforms using {workers} workers")
+
+    def fetch(item):
+        file_name, url = item
+        try:
+            download_file(url, file_name)
+            return None
+        except (SystemExit, Exception) as err:
+            return f"{file_name}: {err}"
+
+    start = time.monotonic()
+    with span("prefetch", files=len(files)):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            errors = [error for error in executor.map(carry(fetch), files.items()) if error]
+    if errors:
+        raise SystemExit(f"Failed to prefetch {len(errors)} of {len(files)} dependency zips:\n" + "\n".join(errors))
+    logging.info(f"{len(files)} dependency zips prefetched in {time.monotonic() - start:.1f}s")
+    return {target: file_name for target, (_url, file_name) in sources.items()}
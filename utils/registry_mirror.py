@@ -0,0 +1,347 @@
+"""
+Embedded pull-through registry mirror.
+
+Serves the read-only part of the registry V2 API on the deployment controller. Image names are prefixed
+with the upstream registry host, e.g. `<mirror>/registry.redhat.io/mta/mta-cli-rhel9:7.3.0` is fetched from
+`registry.redhat.io/mta/mta-cli-rhel9:7.3.0`. Blobs and manifests referenced by digest are stored on disk
+deduplicated by digest, the store is bounded in size and least recently used blobs are evicted first.
+Upstream registries see one fetch per blob, all hosts pulling through the mirror are served from disk.
+The mirror is started by utils.mirror.start_mirror.
+
+The mirror listens on 127.0.0.1 unless mirror_listen in config.json names a LAN address remote hosts can reach.
+It only fetches from registries the deployment pulls from (utils.const) and from mirror_insecure_upstreams,
+other hosts are refused so the mirror can't be used as an open proxy. TLS certificates of upstream registries
+are verified except for mirror_insecure_upstreams.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+from utils.const import brew_proxy, repositories
+from utils.policy import get_step_timeout
+
+MANIFEST_TYPES = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+PATH_RE = re.compile(r"^/v2/(?P<host>[^/]+)/(?P<name>.+)/(?P<kind>manifests|blobs)/(?P<reference>[^/]+)$")
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStore:
+    """Digest-addressed blob store with size-bounded LRU eviction (last access time is kept in mtime)"""
+
+    def __init__(self, path, max_size):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._digest_locks = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    def blob_path(self, digest):
+        algorithm, _, value = digest.partition(":")
+        if algorithm != "sha256" or not re.fullmatch(r"[0-9a-f]{64}", value):
+            raise ValueError(f"Unsupported digest: {digest}")
+        return os.path.join(self.path, value)
+
+    def digest_lock(self, digest):
+        """Lock serializing upstream fetches of the same digest"""
+        with self._lock:
+            return self._digest_locks.setdefault(digest, threading.Lock())
+
+    def get(self, digest):
+        """
+        :return: Tuple of (path, metadata) if the blob is stored, None otherwise
+        """
+        path = self.blob_path(digest)
+        try:
+            with open(path + ".json", "r") as f:
+                metadata = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return path, metadata
+
+    def writer(self, digest):
+        return _BlobWriter(self, digest)
+
+    def evict(self):
+        with self._lock:
+            blobs = []
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                if name.endswith(".json") or name.endswith(".tmp"):
+                    continue
+                stat = os.stat(path)
+                blobs.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _mtime, size, _path in blobs)
+            for _mtime, size, path in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                logging.info(f"Evicting mirrored blob {os.path.basename(path)}")
+                for item in (path + ".json", path):
+                    try:
+                        os.remove(item)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+
+
+class _BlobWriter:
+    """Writes blob to temporary file, verifies its digest and commits it into the store"""
+
+    def __init__(self, store, digest):
+        self.store = store
+        self.digest = digest
+        self.path = store.blob_path(digest)
+        self.tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.sha = hashlib.sha256()
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha.update(data)
+
+    def commit(self, metadata):
+        self.file.close()
+        if f"sha256:{self.sha.hexdigest()}" != self.digest:
+            os.remove(self.tmp_path)
+            raise ValueError(f"Digest mismatch for {self.digest}")
+        with open(self.path + ".json", "w") as f:
+            json.dump(metadata, f)
+        os.replace(self.tmp_path, self.path)
+        self.store.evict()
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class UpstreamClient:
+    """HTTP client for upstream registries handling bearer token authentication"""
+
+    def __init__(self, insecure_hosts=()):
+        self.insecure_hosts = set(insecure_hosts)
+        self.session = requests.Session()
+        self._tokens = {}
+
+    def verify(self, url):
+        """TLS certificates are verified for all hosts but mirror_insecure_upstreams"""
+        return urlparse(url).netloc not in self.insecure_hosts
+
+    def get(self, host, path, headers, method="GET"):
+        scheme = "http" if host in self.insecure_hosts else "https"
+        url = f"{scheme}://{host}{path}"
+        token = self._tokens.get(host)
+        if token:
+            headers = dict(headers, Authorization=f"Bearer {token}")
+        response = self.session.request(method, url, headers=headers, stream=True, timeout=_get_timeout(url),
+                                        verify=self.verify(url))
+        if response.status_code == 401 and "WWW-Authenticate" in response.headers:
+            response.close()
+            self._tokens[host] = self._fetch_token(host, response.headers["WWW-Authenticate"])
+            headers = dict(headers, Authorization=f"Bearer {self._tokens[host]}")
+            response = self.session.request(method, url, headers=headers, stream=True, timeout=_get_timeout(url),
+                                            verify=self.verify(url))
+        return response
+
+    def _fetch_token(self, host, challenge):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm", None)
+        if not realm:
+            raise ValueError(f"Unsupported authentication challenge from {host}: {challenge}")
+        credentials = _registry_credentials(host)
+        response = self.session.get(realm, params=params, auth=credentials, verify=self.verify(realm),
+                                    timeout=get_step_timeout("http", f"request to {realm}"))
+        response.raise_for_status()
+        body = response.json()
+        return body.get("token") or body.get("access_token")
+
+
+def _get_timeout(url):
+    """
+    Timeouts of connecting and of waiting for data, as for downloads. A stalled upstream fails the request
+    instead of holding the handler thread forever.
+    """
+    stall = get_step_timeout("download", f"fetch of {url}")
+    return get_step_timeout("http", f"fetch of {url}"), stall
+
+
+def _registry_credentials(host):
+    """Reads credentials for registry host from containers auth file, as podman login stores them"""
+    candidates = [os.environ.get("REGISTRY_AUTH_FILE"),
+                  os.path.join(os.environ.get("XDG_RUNTIME_DIR", ""), "containers", "auth.json"),
+                  os.path.expanduser("~/.config/containers/auth.json"),
+                  os.path.expanduser("~/.docker/config.json")]
+    for path in filter(None, candidates):
+        try:
+            with open(path, "r") as f:
+                auth = json.load(f).get("auths", {}).get(host, {}).get("auth")
+        except (OSError, ValueError):
+            continue
+        if auth:
+            user, _, password = base64.b64decode(auth).decode().partition(":")
+            return user, password
+    return None
+
+
+class RegistryMirror:
+    """Pull-through registry mirror running in background thread"""
+
+    def __init__(self, store, listen, advertised_address=None, insecure_upstreams=()):
+        self.store = store
+        self.upstream = UpstreamClient(insecure_upstreams)
+        self.allowed_upstreams = set(repositories.values()) | {brew_proxy} | set(insecure_upstreams)
+        host, _, port = listen.rpartition(":")
+        host = host or "127.0.0.1"
+        self.server = ThreadingHTTPServer((host, int(port)), _MirrorHandler)
+        self.server.daemon_threads = True
+        self.server.mirror = self
+        port = self.server.server_address[1]
+        # Listening on all interfaces has to be configured explicitly, hosts in the LAN then use the outgoing one
+        self.address = advertised_address or f"{_local_ip() if host in ('0.0.0.0', '::') else host}:{port}"
+        self.upstream_fetches = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logging.info(f"Registry mirror listening on {self.server.server_address[0]}:{self.server.server_address[1]}, "
+                     f"advertised as {self.address}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_fetch(self):
+        with self._lock:
+            self.upstream_fetches += 1
+
+    def rewrite(self, image):
+        """Rewrites image pull URL so it is pulled through the mirror"""
+        return f"{self.address}/{image}"
+
+
+class _MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, message_format, *args):
+        logging.debug("Registry mirror: " + message_format, *args)
+
+    def do_HEAD(self):
+        self._handle(head=True)
+
+    def do_GET(self):
+        self._handle(head=False)
+
+    def _handle(self, head):
+        if self.path.rstrip("/") == "/v2":
+            return self._send(200, b"{}", {"Content-Type": "application/json"}, head)
+        match = PATH_RE.match(self.path.split("?")[0])
+        if not match:
+            return self._send(404, b'{"errors": [{"code": "NAME_UNKNOWN"}]}', {"Content-Type": "application/json"}, head)
+        if match["host"] not in self.server.mirror.allowed_upstreams:
+            logging.warning(f"Registry mirror refused {self.path}: {match['host']} is not an allowed upstream")
+            return self._send(403, b'{"errors": [{"code": "DENIED"}]}', {"Content-Type": "application/json"}, head)
+        try:
+            if match["kind"] == "blobs" or match["reference"].startswith("sha256:"):
+                self._serve_by_digest(match, head)
+            else:
+                self._proxy_tag(match, head)
+        except (requests.exceptions.RequestException, ValueError) as err:
+            logging.error(f"Registry mirror failed to serve {self.path}: {err}")
+            self._send(502, str(err).encode(), {"Content-Type": "text/plain"}, head)
+
+    def _upstream(self, match, method="GET"):
+        self.server.mirror.count_fetch()
+        headers = {"Accept": self.headers.get("Accept") or MANIFEST_TYPES}
+        return self.server.mirror.upstream.get(
+            match["host"], f"/v2/{match['name']}/{match['kind']}/{match['reference']}", headers, method)
+
+    def _proxy_tag(self, match, head):
+        """Tags can move, manifests referenced by tag are always resolved upstream"""
+        with self._upstream(match, "HEAD" if head else "GET") as response:
+            body = b"" if head else response.content
+            headers = {key: response.headers[key] for key in ("Content-Type", "Docker-Content-Digest", "Content-Length")
+                       if key in response.headers}
+            self._send(response.status_code, body, headers, head)
+
+    def _serve_by_digest(self, match, head):
+        digest = match["reference"]
+        store = self.server.mirror.store
+        stored = store.get(digest)
+        if not stored:
+            with store.digest_lock(digest):
+                stored = store.get(digest)
+                if not stored:
+                    stored = self._fetch_into_store(match, digest)
+                    if stored is None:
+                        return
+        path, metadata = stored
+        headers = {"Content-Type": metadata["content_type"], "Docker-Content-Digest": digest,
+                   "Content-Length": str(os.path.getsize(path))}
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    self.wfile.write(chunk)
+
+    def _fetch_into_store(self, match, digest):
+        """Fetches content from upstream into the store, relays upstream errors to client"""
+        store = self.server.mirror.store
+        with self._upstream(match) as response:
+            if response.status_code != 200:
+                self._send(response.status_code, response.content,
+                           {"Content-Type": response.headers.get("Content-Type", "application/json")}, False)
+                return None
+            writer = store.writer(digest)
+            try:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    writer.write(chunk)
+                writer.commit({"content_type": response.headers.get("Content-Type", "application/octet-stream"),
+                               "fetched": time.time()})
+            except Exception:
+                writer.abort()
+                raise
+        logging.info(f"Registry mirror stored {match['host']}/{match['name']}@{digest}")
+        return store.get(digest)
+
+    def _send(self, status, body, headers, head):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.send_header("Docker-Distribution-API-Version", "registry/2.0")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+def _local_ip():
+    """Returns address of the interface used for outgoing traffic, reachable by hosts in the same LAN"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect(("10.255.255.255", 1))
+            return sock.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
@@ -0,0 +1,181 @@
+"""
+Relay of container images from the deployment controller to remote hosts.
+
+The controller pulls every image once and saves it as docker-archive. For each remote host only the layers
+the host doesn't have yet are streamed (gzip compressed) over the existing SSH connection into `podman load`.
+Layers the host already has are replaced by empty placeholders: podman reuses layers found in storage by
+their diff ID and never reads the placeholder.
+"""
+import gzip
+import json
+import logging
+import os
+import shlex
+import shutil
+import tarfile
+import tempfile
+import time
+
+from utils.policy import current_deadline, get_step_timeout
+from utils.throttle import throttle
+from utils.trace import span
+from utils.transfer import get_connection_errors
+from utils.utils import run_command
+
+LAYERS_MARKER = "---LAYERS---"
+
+
+def save_images(tags, work_dir=None):
+    """
+    Saves images from controller storage as docker-archives
+    :param tags: Names of images to be saved
+    :param work_dir: Directory for archives, temporary directory is created when not set
+    :return: Dict mapping image name to archive path
+    """
+    work_dir = work_dir or tempfile.mkdtemp(prefix="mta-relay-")
+    archives = {}
+    for index, tag in enumerate(tags):
+        archive = os.path.join(work_dir, f"image-{index}.tar")
+        logging.info(f"Saving image {tag} to {archive}")
+        run_command(f"podman save --format docker-archive -o {archive} {tag}")
+        archives[tag] = archive
+    return archives
+
+
+def remove_archives(archives):
+    """Removes archives created by save_images together with their directory"""
+    for work_dir in {os.path.dirname(archive) for archive in archives.values()}:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def read_archive_info(archive):
+    """
+    Reads manifest and config of a docker-archive
+    :param archive: Path to the archive
+    :return: Dict with image id and list of (layer path, diff ID) tuples
+    """
+    with tarfile.open(archive, "r") as tar:
+        manifest = json.load(tar.extractfile("manifest.json"))[0]
+        image_config = json.load(tar.extractfile(manifest["Config"]))
+    diff_ids = image_config["rootfs"]["diff_ids"]
+    image_id = os.path.basename(manifest["Config"]).split(".")[0].replace("sha256:", "")
+    return {"id": image_id, "layers": list(zip(manifest["Layers"], diff_ids))}
+
+
+def get_remote_storage(client):
+    """
+    Lists images and layers present on remote host using one command
+    :param client: SSH client
+    :return: Tuple of (dict image ID -> set of names, set of layer diff IDs)
+    """
+    script = ('podman images --format json; echo "{marker}"; ids=$(podman images -q); '
+              'if [ -n "$ids" ]; then podman image inspect --format '
+              '\'{{{{range .RootFS.Layers}}}}{{{{println .}}}}{{{{end}}}}\' $ids; fi').format(marker=LAYERS_MARKER)
+    out, _err = run_command(script, client=client)
+    images_out, _, layers_out = out.partition(LAYERS_MARKER)
+    images = {}
+    for image in json.loads(images_out.strip() or "[]"):
+        images[(image.get("Id") or image.get("ID")).replace("sha256:", "")] = set(image.get("Names") or [])
+    return images, {line.strip() for line in layers_out.splitlines() if line.strip()}
+
+
+def relay_images(archives, client):
+    """
+    Transfers images to remote host, sending only the layers it doesn't have
+    :param archives: Dict mapping image name to docker-archive path, see save_images
+    :param client: SSH client
+    :return: Per-image report with image, action (skipped/retagged/loaded) and bytes sent
+    """
+    images, layers = get_remote_storage(client)
+    reports, retags = [], []
+    for tag, archive in archives.items():
+        info = read_archive_info(archive)
+        matching_id = next((image_id for image_id in images if image_id.startswith(info["id"])), None)
+        if matching_id:
+            if tag in images[matching_id]:
+                reports.append({"image": tag, "action": "skipped", "bytes": 0})
+            else:
+                retags.append(f"podman tag {matching_id} {tag}")
+                reports.append({"image": tag, "action": "retagged", "bytes": 0})
+            continue
+        start = time.monotonic()
+        with span("relay", image=tag, host=client.host) as attrs:
+            sent = stream_archive(archive, info, layers, tag, client)
+            attrs["bytes"] = sent
+        layers.update(diff_id for _path, diff_id in info["layers"])
+        logging.info(f"Image {tag} relayed to {client.host}: {sent} bytes in {time.monotonic() - start:.1f}s")
+        reports.append({"image": tag, "action": "loaded", "bytes": sent})
+    if retags:
+        run_command(" && ".join(retags), client=client)
+    for report in reports:
+        logging.info(f"Image {report['image']}: {report['action']} ({report['bytes']} bytes)")
+    return reports
+
+
+def stream_archive(archive, info, known_layers, tag, client):
+    """
+    Streams docker-archive with known layers replaced by empty placeholders into remote `podman load`.
+    Writes are bound by the deadline of the deployment, a stalled channel fails after the download step timeout.
+    :return: Number of compressed bytes sent
+    """
+    skip = {path for path, diff_id in info["layers"] if diff_id in known_layers}
+    logging.info(f"Relaying {tag}: {len(info['layers']) - len(skip)} of {len(info['layers'])} layers missing on remote host")
+    step = f"Relay of {tag} to {client.host}"
+    current_deadline().check(step)
+    _stdin, stdout, stderr = client.exec_command("bash -lc " + shlex.quote(f"gzip -dc | podman load && podman tag {info['id']} {tag}"))
+    channel = stdout.channel
+    channel.settimeout(get_step_timeout("download", step))
+    writer = _CountingWriter(channel, step)
+    try:
+        with tarfile.open(archive, "r") as src, gzip.GzipFile(fileobj=writer, mode="wb", compresslevel=1) as compressed, \
+                tarfile.open(fileobj=compressed, mode="w|") as dst:
+            for member in src:
+                if member.name in skip and member.isfile():
+                    placeholder = tarfile.TarInfo(member.name)
+                    placeholder.mode = member.mode
+                    dst.addfile(placeholder)
+                elif member.isfile():
+                    dst.addfile(member, src.extractfile(member))
+                else:
+                    dst.addfile(member)
+        channel.shutdown_write()
+        channel.settimeout(get_step_timeout("pull", step))
+        out = stdout.read().decode()
+        err = stderr.read().decode()
+        exit_status = channel.recv_exit_status()
+    except get_connection_errors() as error:
+        raise SystemExit(f"{step} failed: {error}\nSTDERR:\n{_read_stderr(channel)}")
+    finally:
+        channel.close()
+    if exit_status != 0:
+        raise SystemExit(f"Loading image {tag} on remote host failed with exit code {exit_status}\n"
+                         f"STDOUT:\n{out}\nSTDERR:\n{err}")
+    return writer.count
+
+
+def _read_stderr(channel):
+    """Remote stderr received so far, doesn't wait for more"""
+    chunks = []
+    while channel.recv_stderr_ready():
+        chunks.append(channel.recv_stderr(65536))
+    return b"".join(chunks).decode(errors="replace")
+
+
+class _CountingWriter:
+    """File-like wrapper of SSH channel counting bytes written, stops writing when the deadline is over"""
+
+    def __init__(self, channel, step):
+        self.channel = channel
+        self.step = step
+        self.deadline = current_deadline()
+        self.count = 0
+
+    def write(self, data):
+        self.deadline.check(self.step)
+        throttle(len(data))
+        self.channel.sendall(data)
+        self.count += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
@@ -0,0 +1,215 @@
+"""
+Remote execution layer: wraps paramiko SSH client so every deployment step reuses one connection,
+gathers host facts once per connection and counts round trips made to the remote host.
+paramiko is imported only by code paths which connect to remote hosts, local deployments never load it.
+"""
+import logging
+import threading
+import time
+
+FACTS_SCRIPT = (
+    'echo "home=$HOME"; echo "os=$(uname -s)"; echo "arch=$(uname -m)"; '
+    'if podman images >/dev/null 2>&1; then echo "podman=running"; '
+    'elif command -v podman >/dev/null 2>&1; then echo "podman=stopped"; else echo "podman=missing"; fi'
+)
+
+# Seconds between keepalive packets of pooled connections
+KEEPALIVE_INTERVAL = 30
+
+
+class RemoteSession:
+    """
+    Drop-in replacement of paramiko.SSHClient used by run_command and SFTP helpers.
+    Every exec channel and SFTP session opened through it is counted as a round trip.
+    """
+
+    def __init__(self, client, host, connect=None):
+        self.client = client
+        self.host = host
+        # Callable returning new paramiko.SSHClient, used to re-establish dropped connection
+        self._connect = connect
+        self.round_trips = 0
+        self._facts = None
+        self._lock = threading.Lock()
+        # PodmanAPI using this connection, see utils/podman_api.py
+        self.podman_api = None
+
+    def exec_command(self, command, *args, **kwargs):
+        self._count()
+        return self.client.exec_command(command, *args, **kwargs)
+
+    def open_sftp(self, window_size=None, max_packet_size=None):
+        self._count()
+        if window_size is None and max_packet_size is None:
+            return self.client.open_sftp()
+        import paramiko
+        return paramiko.SFTPClient.from_transport(self.client.get_transport(), window_size=window_size,
+                                                  max_packet_size=max_packet_size)
+
+    def get_transport(self):
+        return self.client.get_transport()
+
+    def is_active(self):
+        """Returns True if the SSH connection is still up"""
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def reconnect(self):
+        """Replaces dropped connection with a new one, gathered facts stay valid"""
+        if self._connect is None:
+            raise SystemExit(f"Connection to {self.host} was lost")
+        logging.info(f"Reconnecting to {self.host}")
+        self._count()
+        if self.podman_api:
+            # Its idle channels belong to the old connection
+            self.podman_api.close()
+        self.client.close()
+        self.client = self._connect()
+
+    def close(self):
+        if _pool is not None and _pool.release(self):
+            return
+        self.disconnect()
+
+    def disconnect(self):
+        """Closes the connection, even if connection pool is used"""
+        logging.info(f"Closing connection to {self.host} after {self.round_trips} round trips")
+        if self.podman_api:
+            self.podman_api.close()
+        self.client.close()
+
+    def _count(self):
+        with self._lock:
+            self.round_trips += 1
+
+    @property
+    def facts(self):
+        """
+        Host facts gathered once per connection with a single command
+        :return: Dict with home, os, arch and podman (running/stopped/missing)
+        """
+        with self._lock:
+            facts = self._facts
+        if facts is None:
+            # Imported here, utils.utils imports this module
+            from utils.utils import run_command
+            out, _err = run_command(FACTS_SCRIPT, fail_on_failure=False, client=self)
+            facts = self.set_facts(out)
+        return facts
+
+    def set_facts(self, out):
+        """
+        Stores facts printed by FACTS_SCRIPT, e.g. when it ran as part of a bigger script
+        :param out: Output of FACTS_SCRIPT
+        :return: Dict of facts
+        """
+        facts = dict(line.split("=", 1) for line in out.splitlines() if "=" in line)
+        facts["os"] = facts.get("os", "").lower()
+        logging.info(f"Host facts of {self.host}: {facts}")
+        with self._lock:
+            self._facts = facts
+        return facts
+
+    def invalidate_facts(self):
+        """Drops cached facts, e.g. after podman machine was started"""
+        with self._lock:
+            self._facts = None
+
+
+class ConnectionPool:
+    """
+    Keeps connections closed by deployments open for later deployments to the same host,
+    used by long-running processes (deploy_service.py)
+    """
+
+    def __init__(self, idle_timeout=600):
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        """
+        Returns idle connection to host or None. The round trip counter of the connection is reset and its facts
+        are dropped, podman may have been stopped or started while the connection was idle
+        :param host: Host address as passed to connect_ssh
+        """
+        while True:
+            with self._lock:
+                idle = self._idle.get(host)
+                session = idle.pop()[0] if idle else None
+                if session is None:
+                    self.misses += 1
+                    return None
+            if session.is_active():
+                with self._lock:
+                    self.hits += 1
+                session.round_trips = 0
+                session.invalidate_facts()
+                logging.info(f"Reusing connection to {host}")
+                return session
+            session.disconnect()
+
+    def release(self, session):
+        """
+        Takes connection back
+        :return: False if the connection is dropped and should be closed
+        """
+        if not session.is_active():
+            return False
+        logging.info(f"Keeping connection to {session.host} after {session.round_trips} round trips")
+        # Idle connections mustn't be dropped by firewalls and NAT on the way
+        session.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+        with self._lock:
+            self._idle.setdefault(session.host, []).append((session, time.monotonic()))
+        return True
+
+    def close_idle(self, max_age=None):
+        """Closes connections idle for longer than max_age seconds (default idle_timeout), 0 closes all"""
+        max_age = self.idle_timeout if max_age is None else max_age
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for host, idle in list(self._idle.items()):
+                expired += [session for session, since in idle if now - since >= max_age]
+                idle[:] = [(session, since) for session, since in idle if now - since < max_age]
+                if not idle:
+                    del self._idle[host]
+        for session in expired:
+            session.disconnect()
+
+    def stats(self):
+        """Returns dict with idle connections, hits and misses"""
+        with self._lock:
+            return {"idle": sum(len(idle) for idle in self._idle.values()), "hits": self.hits, "misses": self.misses}
+
+
+_pool = None
+
+
+def set_connection_pool(pool):
+    """
+    Makes connect_ssh reuse connections of the pool and close() return them to it
+    :param pool: ConnectionPool or None to close connections right away
+    """
+    global _pool
+    _pool = pool
+
+
+def get_connection_pool():
+    """Returns connection pool in use or None"""
+    return _pool
+
+
+def run_script(commands, client=None, fail_on_failure=True):
+    """
+    Runs several commands as one shell script, stopping at the first failing one.
+    Remotely this costs one round trip instead of one per command.
+    :param commands: List of shell commands
+    :param client: SSH client, optional parameter to run the script remotely
+    :param fail_on_failure: Raise SystemExit if the script fails
+    :return: Tuple of stdout and stderr
+    """
+    from utils.utils import run_command
+    return run_command("set -e\n" + "\n".join(commands), fail_on_failure, client)
@@ -0,0 +1,154 @@
+"""
+Dependency-graph scheduler for deployment phases.
+
+A deployment is declared as tasks with dependencies. Every task starts as soon as all its dependencies are
+finished, so independent phases (e.g. image pulls and the dependency zip download) overlap. Tasks can claim a
+resource (registry, network, disk) and the number of tasks holding the same resource at once is limited.
+After the run the critical path - the chain of tasks which determined the total duration - is reported.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils.policy import carry
+
+DEFAULT_LIMITS = {"registry": 2, "network": 2, "disk": 1}
+
+
+class Task:
+    """Scheduled unit of work"""
+
+    def __init__(self, name, func, deps=(), resource=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.resource = resource
+        self.result = None
+        self.status = "pending"
+        self.error = None
+        self.start = None
+        self.end = None
+        # Moment all dependencies were done, the rest of waiting until start is waiting for the resource
+        self.ready = None
+
+    @property
+    def duration(self):
+        return (self.end - self.start) if self.start is not None and self.end is not None else 0.0
+
+
+class Scheduler:
+    """Runs tasks of a dependency graph concurrently, respecting dependencies and resource limits"""
+
+    def __init__(self, limits=None, name="deployment"):
+        self.name = name
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.tasks = {}
+        self._semaphores = {resource: threading.Semaphore(max(1, int(limit)))
+                            for resource, limit in self.limits.items()}
+
+    def add(self, name, func, deps=(), resource=None):
+        """
+        Adds task to the graph
+        :param name: Unique task name, used by other tasks to depend on it
+        :param func: Callable without arguments, its return value is available via result()
+        :param deps: Names of tasks which must finish first, None entries are ignored
+        :param resource: Resource the task holds while it runs, one of the limits keys
+        :return: Task name
+        """
+        if name in self.tasks:
+            raise ValueError(f"Task {name} is already scheduled")
+        deps = [dep for dep in deps if dep]
+        unknown = [dep for dep in deps if dep not in self.tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks: {', '.join(unknown)}")
+        if resource and resource not in self._semaphores:
+            raise ValueError(f"Unknown resource {resource} of task {name}")
+        self.tasks[name] = Task(name, func, deps, resource)
+        return name
+
+    def result(self, name):
+        """Returns value returned by finished task"""
+        return self.tasks[name].result
+
+    def run(self):
+        """
+        Runs all tasks. Tasks depending on a failed task are skipped, the others run to completion.
+        :return: Dict mapping task name to its result. Raises SystemExit after the run if any task failed
+        """
+        start = time.monotonic()
+        pending = dict(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as executor:
+            while pending or running:
+                for task in list(pending.values()):
+                    statuses = [self.tasks[dep].status for dep in task.deps]
+                    if any(status in ("failed", "skipped") for status in statuses):
+                        task.status = "skipped"
+                        del pending[task.name]
+                        logging.info(f"Task {task.name} skipped, its dependency failed")
+                    elif all(status == "done" for status in statuses):
+                        task.ready = time.monotonic()
+                        running[executor.submit(carry(self._run_task), task)] = task
+                        del pending[task.name]
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    running.pop(future)
+        total = time.monotonic() - start
+
+        self.report(total)
+        failed = [task for task in self.tasks.values() if task.status == "failed"]
+        if failed:
+            details = "\n".join(f"{task.name}: {task.error}" for task in failed)
+            raise SystemExit(f"{len(failed)} of {len(self.tasks)} {self.name} tasks failed:\n{details}")
+        return {name: task.result for name, task in self.tasks.items()}
+
+    def _run_task(self, task):
+        semaphore = self._semaphores.get(task.resource)
+        if semaphore:
+            semaphore.acquire()
+        try:
+            task.start = time.monotonic()
+            task.status = "running"
+            logging.info(f"Task {task.name} started")
+            task.result = task.func()
+            task.status = "done"
+        except BaseException as err:
+            # Phases report errors via SystemExit, keep it per task so independent tasks can finish
+            task.status = "failed"
+            task.error = str(err) or type(err).__name__
+            logging.error(f"Task {task.name} failed: {task.error}")
+        finally:
+            task.end = time.monotonic()
+            if semaphore:
+                semaphore.release()
+
+    def critical_path(self):
+        """
+        Chain of tasks which determined the total duration: starting from the task which finished last,
+        every step goes to the dependency which finished last
+        :return: List of tasks, first to last
+        """
+        finished = [task for task in self.tasks.values() if task.end is not None]
+        if not finished:
+            return []
+        path = [max(finished, key=lambda task: task.end)]
+        while True:
+            deps = [self.tasks[dep] for dep in path[-1].deps if self.tasks[dep].end is not None]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda task: task.end))
+        return list(reversed(path))
+
+    def report(self, total):
+        """Logs duration of every task and the critical path"""
+        for task in sorted(self.tasks.values(), key=lambda item: item.start if item.start is not None else float("inf")):
+            waited = (task.start - task.ready) if task.start is not None and task.ready is not None else 0.0
+            resource = f", {task.resource} wait {waited:.1f}s" if task.resource else ""
+            logging.info(f"Task {task.name}: {task.status} in {task.duration:.1f}s{resource}")
+        path = self.critical_path()
+        chain = " -> ".join(f"{task.name} ({task.duration:.1f}s)" for task in path)
+        busy = sum(task.duration for task in self.tasks.values())
+        logging.info(f"Critical path of {self.name}: {chain}; wall time {total:.1f}s, sum of tasks {busy:.1f}s")
@@ -0,0 +1,200 @@
+"""
+Deployment state kept on every target.
+
+After a successful deployment a small record with version, build, deployed images (name -> digest) and
+SHA-256 of the dependency zip is written to the target home directory. The next deployment reads it back
+together with host facts, present images and presence of dependencies using a single command and compares
+it with the desired state: when nothing differs the target is left untouched, otherwise a plan with only
+the steps needed to reconcile the differences is executed.
+"""
+import json
+import logging
+import os
+import shlex
+import time
+
+from utils.build_index import get_build_index, get_build_key
+from utils.cache import get_artifact_cache, hash_file
+from utils.images import get_image_jobs, get_job_target
+from utils.remote import FACTS_SCRIPT
+from utils.utils import run_command, get_latest_upstream_dependency, get_stage_ga_dependency_url
+from utils.zip import get_zip_name, get_zip_folder_name
+
+STATE_FILE = ".mta-deploy-state.json"
+STATE_MARKER = "---STATE---"
+IMAGES_MARKER = "---IMAGES---"
+DEPENDENCIES_MARKER = "---DEPENDENCIES---"
+
+
+def read_target_state(client=None):
+    """
+    Reads state record, present images and presence of unpacked dependencies with one command.
+    Remotely the host facts are gathered by the same command.
+    :param client: SSH client, optional parameter to read state of remote host
+    :return: Dict with record (None if there is no valid record), images (name -> set of digests)
+             and dependencies (True if the dependencies folder is not empty)
+    """
+    commands = [FACTS_SCRIPT] if client else []
+    commands += [f'echo "{STATE_MARKER}"', f'cat "$HOME/{STATE_FILE}" 2>/dev/null',
+                 f'echo "{IMAGES_MARKER}"', 'podman images --format json 2>/dev/null',
+                 f'echo "{DEPENDENCIES_MARKER}"', 'ls -A "$HOME/.kantra" 2>/dev/null | head -n 1']
+    script = "; ".join(commands)
+    out, _err = run_command(script, fail_on_failure=False, client=client)
+    facts_out, _, rest = out.partition(STATE_MARKER)
+    record_out, _, rest = rest.partition(IMAGES_MARKER)
+    images_out, _, dependencies_out = rest.partition(DEPENDENCIES_MARKER)
+    if client:
+        client.set_facts(facts_out)
+
+    try:
+        record = json.loads(record_out) if record_out.strip() else None
+    except ValueError:
+        logging.warning("Deployment state record is corrupted, ignoring it")
+        record = None
+    images = {}
+    try:
+        present = json.loads(images_out.strip() or "[]")
+    except ValueError:
+        present = []
+    for image in present:
+        digests = {image.get("Digest")} | {item.split("@")[-1] for item in image.get("RepoDigests") or []}
+        for name in image.get("Names") or []:
+            images.setdefault(name, set()).update(digest for digest in digests if digest)
+    return {"record": record, "images": images, "dependencies": bool(dependencies_out.strip())}
+
+
+def get_desired_state(data, image_list=None, host_os=None, host_platform=None):
+    """
+    Describes what the target should look like after the deployment, without fetching any artifact
+    :param data: Deployment arguments
+    :param image_list: ImageManifest of bundle builds
+    :param host_os: OS of the target, None for local deployment
+    :param host_platform: Platform of the target, None for local deployment
+    :return: Dict with version, build, upstream, images (name -> digest, None for images pulled by a tag
+             which can move) and dependencies (SHA-256 of the dependency zip, None when it is not known
+             before fetching the zip)
+    """
+    version = data["version"]
+    build = data["build"]
+    upstream = bool(data["args_upstream"])
+    images = {}
+    if version and build and not upstream:
+        for job in get_image_jobs(version, build, image_list):
+            images[get_job_target(job)] = job["digest"]
+    return {"version": version, "build": build, "upstream": upstream, "images": images,
+            "dependencies": get_known_zip_sha(data, image_list, host_os, host_platform)}
+
+
+def get_known_zip_sha(data, image_list=None, host_os=None, host_platform=None):
+    """
+    Returns SHA-256 of the dependency zip if it can be known without downloading or generating it:
+    from the file given as CLI argument, the artifact cache (only if the server confirms it still serves
+    the cached version) or the build index
+    """
+    version = data["version"]
+    build = data["build"]
+    if data["args_dependency_file"]:
+        return hash_file(data["args_dependency_file"])
+    if not (version and build) or data["args_upstream"]:
+        cache = get_artifact_cache()
+        if not cache:
+            return None
+        url = get_latest_upstream_dependency('konveyor', 'kantra', get_zip_name(os_name=host_os, machine=host_platform))
+        return get_revalidated_sha(cache, url) if url else None
+    if build == "stage" or build == "candidate" or build == "ga":
+        cache = get_artifact_cache()
+        url, _name = get_stage_ga_dependency_url(version, build, host_os, host_platform)
+        return get_revalidated_sha(cache, url) if cache else None
+    index = get_build_index()
+    zip_folder_name = get_zip_folder_name(image_list) if image_list else None
+    if not index or not zip_folder_name:
+        return None
+    zip_name = get_zip_name(zip_folder_name.split("-")[1], host_os, host_platform)
+    return index.get_zip_sha(get_build_key(version, build), zip_name)
+
+
+def get_revalidated_sha(cache, url):
+    """
+    Returns SHA-256 of the artifact cached for URL if the server still serves the same version, the same URL
+    can serve a respun zip. None if it changed or can't be revalidated
+    """
+    # HTTP backend is loaded only when there is something to revalidate
+    from utils.download import get_validators
+    validators = cache.get_validators(url)
+    return cache.lookup(url, get_validators(url, validators)) if validators else None
+
+
+def make_plan(current, desired, force=False):
+    """
+    Compares target state with desired state
+    :param current: State read by read_target_state
+    :param desired: State built by get_desired_state
+    :param force: Ignore the state record, redeploy everything
+    :return: Dict with full_images (images of another build are deployed, old ones are removed),
+             images (names of images to be deployed), dependencies (True if the zip has to be unpacked)
+             and reasons. Plan with no images and no dependencies is a no-op.
+    """
+    record = None if force else current["record"]
+    reasons = ["redeployment forced"] if force else []
+    same_build = bool(record) and all(record.get(key) == desired[key] for key in ("version", "build", "upstream"))
+    if not record and not force:
+        reasons.append("no deployment state on target")
+    elif record and not same_build:
+        reasons.append(f"deployed {record.get('version')}-{record.get('build')} differs from "
+                       f"{desired['version']}-{desired['build']}")
+
+    images, moving = [], []
+    for name, digest in desired["images"].items():
+        # Image pulled by tag (stage/candidate/GA) can be respun under the same tag, it is always pulled
+        if digest is None:
+            moving.append(name)
+            images.append(name)
+            continue
+        recorded = same_build and record.get("images", {}).get(name, False) == digest
+        present = name in current["images"] and digest in current["images"][name]
+        if not (recorded and present):
+            images.append(name)
+    if same_build and moving:
+        reasons.append(f"images pulled by tag: {', '.join(moving)}")
+    if same_build and len(images) > len(moving):
+        reasons.append(f"images missing or changed: {', '.join(name for name in images if name not in moving)}")
+
+    dependencies = not (same_build and current["dependencies"] and desired["dependencies"]
+                        and record.get("dependencies") == desired["dependencies"])
+    if same_build and dependencies:
+        reasons.append("dependencies missing or changed" if desired["dependencies"] else
+                       "dependency zip is not known before it is fetched")
+    return {"full_images": bool(images) and not same_build, "images": images,
+            "dependencies": dependencies, "reasons": reasons}
+
+
+def is_noop(plan):
+    return not plan["images"] and not plan["dependencies"]
+
+
+def describe_plan(plan):
+    steps = []
+    if plan["images"]:
+        steps.append(f"{'all' if plan['full_images'] else len(plan['images'])} images")
+    if plan["dependencies"]:
+        steps.append("dependencies")
+    return f"{', '.join(steps) or 'nothing to do'} ({'; '.join(plan['reasons']) or 'up to date'})"
+
+
+def write_state(desired, zip_file=None, client=None):
+    """
+    Writes state record after successful deployment
+    :param desired: Deployed state, see get_desired_state
+    :param zip_file: Unpacked dependency zip, its hash is recorded
+    :param client: SSH client, optional parameter to write the record on remote host
+    """
+    record = dict(desired, deployed=time.time())
+    if zip_file:
+        record["dependencies"] = hash_file(zip_file)
+    content = json.dumps(record)
+    if client:
+        run_command(f'printf "%s" {shlex.quote(content)} > "$HOME/{STATE_FILE}"', client=client)
+    else:
+        with open(os.path.join(os.path.expanduser("~"), STATE_FILE), "w") as f:
+            f.write(content)
+    logging.info(f"Deployment state written to {client.host if client else 'local host'}")
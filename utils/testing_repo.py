@@ -0,0 +1,141 @@
+"""
+Incremental preparation of the testing repository (kantra-cli-tests) on remote hosts.
+
+An existing checkout is fetched (only the latest commit) and hard-reset instead of being cloned again, a missing
+one is cloned shallow. Python requirements are built into a wheelhouse once on the controller, keyed by the
+SHA-256 of requirements.txt. Hosts get the wheelhouse uploaded and install from it offline, the hash of the
+installed requirements is recorded on every host and the install is skipped while it doesn't change.
+"""
+import logging
+import os
+import shlex
+import shutil
+import zipfile
+
+from utils.cache import hash_file
+from utils.remote import FACTS_SCRIPT, run_script
+from utils.transfer import upload_file
+from utils.utils import get_repo_folder_name, run_command
+
+DEFAULT_REPOS_DIR = os.path.join("~", ".cache", "konveyor-cli-deployment", "repos")
+DEFAULT_WHEELHOUSE_DIR = os.path.join("~", ".cache", "konveyor-cli-deployment", "wheelhouse")
+# Wheelhouses and install records on remote hosts, relative to home directory
+REMOTE_WHEELHOUSE_DIR = ".mta-wheelhouse"
+REQUIREMENTS_MARKER = "=== requirements ==="
+
+
+def get_checkout_commands(repo, path):
+    """
+    Commands updating checkout at path to the latest commit of the default branch, cloning it if it's missing
+    :param repo: Repository URL
+    :param path: Checkout directory, relative paths are relative to home directory on remote hosts
+    :return: List of shell commands
+    """
+    path = shlex.quote(path)
+    return [f"if [ -d {path}/.git ]; then "
+            f"git -C {path} fetch --depth 1 origin HEAD && git -C {path} reset --hard FETCH_HEAD && "
+            f"git -C {path} clean -fd && git -C {path} submodule update --init --recursive --depth 1; "
+            f"else rm -rf {path} && git clone --depth 1 --recurse-submodules --shallow-submodules "
+            f"{shlex.quote(repo)} {path}; fi"]
+
+
+def get_wheelhouse(repo):
+    """
+    Builds wheelhouse of requirements.txt of the latest commit of repo on the controller, once per requirements hash
+    :param repo: Repository URL
+    :return: Dict with sha (SHA-256 of requirements.txt) and archive (zip of the wheels)
+    """
+    path = os.path.join(os.path.expanduser(DEFAULT_REPOS_DIR), get_repo_folder_name(repo))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    logging.info(f"Updating local checkout of {repo} in {path}")
+    run_script(get_checkout_commands(repo, path))
+    requirements = os.path.join(path, "requirements.txt")
+    sha = hash_file(requirements)
+
+    wheelhouse_dir = os.path.expanduser(DEFAULT_WHEELHOUSE_DIR)
+    archive = os.path.join(wheelhouse_dir, f"{sha[:16]}.zip")
+    if os.path.exists(archive):
+        logging.info(f"Using wheelhouse {archive} of requirements {sha[:16]}")
+        return {"sha": sha, "archive": archive}
+
+    build_dir = os.path.join(wheelhouse_dir, f"{sha[:16]}.build")
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    try:
+        logging.info(f"Building wheelhouse of {requirements}")
+        run_command(f"pip3 wheel -r {shlex.quote(requirements)} -w {shlex.quote(build_dir)}")
+        wheels = sorted(os.listdir(build_dir))
+        # Wheels are compressed already
+        with zipfile.ZipFile(f"{archive}.tmp", "w", zipfile.ZIP_STORED) as zip_ref:
+            for name in wheels:
+                zip_ref.write(os.path.join(build_dir, name), name)
+        os.replace(f"{archive}.tmp", archive)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    logging.info(f"Wheelhouse {archive} built with {len(wheels)} wheels")
+    return {"sha": sha, "archive": archive}
+
+
+def refresh_checkout(repo, client):
+    """
+    Updates checkout of repo in home directory of remote host, host facts are gathered by the same command
+    :param repo: Repository URL
+    :param client: SSH client
+    :return: Dict with requirements (SHA-256 of requirements.txt of the checkout) and installed
+             (SHA-256 of requirements installed by previous preparation, empty if there is none)
+    """
+    folder = get_repo_folder_name(repo)
+    record = shlex.quote(f"{REMOTE_WHEELHOUSE_DIR}/{folder}.installed")
+    requirements = shlex.quote(f"{folder}/requirements.txt")
+    out, _err = run_script([FACTS_SCRIPT] + get_checkout_commands(repo, folder) + [
+        f'echo "{REQUIREMENTS_MARKER}"',
+        f"echo \"requirements=$( (sha256sum {requirements} 2>/dev/null || shasum -a 256 {requirements}) "
+        f"| cut -d' ' -f1)\"",
+        f'echo "installed=$(cat {record} 2>/dev/null)"'], client=client)
+    facts_out, _, state_out = out.partition(REQUIREMENTS_MARKER)
+    client.set_facts(facts_out)
+    return dict(line.split("=", 1) for line in state_out.splitlines() if "=" in line)
+
+
+def install_requirements(repo, wheelhouse, state, client):
+    """
+    Installs requirements of the checkout on remote host unless they are installed already. When they match
+    the wheelhouse, it is uploaded and installed offline, otherwise packages are downloaded by pip on the host.
+    :param repo: Repository URL
+    :param wheelhouse: Dict returned by get_wheelhouse
+    :param state: Dict returned by refresh_checkout
+    :param client: SSH client
+    :return: skipped, offline or online
+    """
+    folder = get_repo_folder_name(repo)
+    requirements = state.get("requirements", "")
+    if requirements and requirements == state.get("installed"):
+        logging.info(f"Requirements of {folder} on {client.host} are installed already, skipping install")
+        return "skipped"
+
+    home_dir = client.facts["home"]
+    record = f"{home_dir}/{REMOTE_WHEELHOUSE_DIR}/{folder}.installed"
+    if requirements != wheelhouse["sha"]:
+        logging.info(f"Requirements of {folder} on {client.host} don't match the wheelhouse, installing them online")
+        run_script([f"cd {shlex.quote(folder)}", "pip3 install -r requirements.txt",
+                    f"mkdir -p {shlex.quote(os.path.dirname(record))}", f"echo {requirements} > {shlex.quote(record)}"],
+                   client=client)
+        return "online"
+
+    name = wheelhouse["sha"][:16]
+    remote_dir = f"{home_dir}/{REMOTE_WHEELHOUSE_DIR}/{name}"
+    remote_archive = f"{remote_dir}.zip"
+    logging.info(f"Installing requirements of {folder} on {client.host} from wheelhouse {name}")
+    upload_file(wheelhouse["archive"], remote_archive, client, then=[
+        f"rm -rf {shlex.quote(remote_dir)}",
+        f"unzip -q -o {shlex.quote(remote_archive)} -d {shlex.quote(remote_dir)}",
+        f"rm -f {shlex.quote(remote_archive)}",
+        f"cd {shlex.quote(folder)}",
+        # Wheels built on the controller may not fit the host, pip falls back to the package index then
+        f"pip3 install --no-index --find-links {shlex.quote(remote_dir)} -r requirements.txt || "
+        f"pip3 install --find-links {shlex.quote(remote_dir)} -r requirements.txt",
+        f"echo {requirements} > {shlex.quote(record)}",
+        # Wheelhouses of previous requirements
+        f"find {shlex.quote(os.path.dirname(remote_dir))} -mindepth 1 -maxdepth 1 -type d ! -name {name} "
+        f"-exec rm -rf {{}} +"])
+    return "offline"
@@ -0,0 +1,64 @@
+"""
+Process-wide bandwidth limit.
+
+Bytes the tool moves itself (dependency zip downloads, SFTP uploads, relayed image layers) are taken from one
+token bucket, so concurrent deployments - e.g. jobs of deploy_service.py - share the configured bandwidth.
+Image pulls done by podman are not limited.
+"""
+import threading
+import time
+
+import config
+
+# Burst allowed after idle time, in seconds of the limit
+BURST_SECONDS = 0.5
+
+
+class BandwidthLimiter:
+    """Token bucket limiting the rate of bytes passed to consume()"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate * BURST_SECONDS
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        """Blocks until count bytes may be sent or received"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate * BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens are taken right away, callers queue behind each other by the debt they leave
+            self.tokens -= count
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def set_bandwidth_limit(mbps):
+    """
+    Sets total bandwidth of the process
+    :param mbps: Megabytes per second, None or 0 for no limit
+    """
+    global _limiter
+    with _limiter_lock:
+        _limiter = BandwidthLimiter(float(mbps) * 1024 ** 2) if mbps else None
+
+
+def throttle(count):
+    """Waits until count bytes fit into the bandwidth limit from config.json or set_bandwidth_limit"""
+    global _limiter
+    limiter = _limiter
+    if limiter is None:
+        if not config.BANDWIDTH_LIMIT_MBPS:
+            return
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = BandwidthLimiter(float(config.BANDWIDTH_LIMIT_MBPS) * 1024 ** 2)
+            limiter = _limiter
+    limiter.consume(count)
@@ -0,0 +1,102 @@
+"""
+Per-phase timing traces.
+
+Deployment phases and every executed command are wrapped in spans recording duration, host, bytes moved
+and exit status. Spans are collected only after enable_tracing() is called and can be written as plain JSON
+or in Chrome trace-event format (chrome://tracing, https://ui.perfetto.dev).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_enabled = False
+_spans = []
+_lock = threading.Lock()
+_context = threading.local()
+# Trace start, all span timestamps are relative to it
+_origin = time.time() - time.perf_counter()
+
+
+def enable_tracing():
+    """Starts collecting spans"""
+    global _enabled
+    _enabled = True
+
+
+def get_spans():
+    """Returns copy of collected spans"""
+    with _lock:
+        return list(_spans)
+
+
+@contextmanager
+def host_context(host):
+    """Spans created in this context (and thread) are attributed to host unless they set it themselves"""
+    previous = getattr(_context, "host", None)
+    _context.host = host
+    try:
+        yield
+    finally:
+        _context.host = previous
+
+
+def current_host():
+    return getattr(_context, "host", None) or "local"
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Records duration of the wrapped block. Yields dict of attributes which can be updated
+    inside the block, e.g. with bytes moved or exit status.
+    :param name: Span name, e.g. phase name
+    :param attrs: Initial attributes
+    """
+    attrs.setdefault("host", current_host())
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as err:
+        attrs.setdefault("status", "failed")
+        attrs.setdefault("error", str(err).splitlines()[0] if str(err) else type(err).__name__)
+        raise
+    finally:
+        end = time.perf_counter()
+        attrs.setdefault("status", "ok")
+        if _enabled:
+            with _lock:
+                _spans.append({"name": name, "start": _origin + start, "duration": end - start,
+                               "thread": threading.get_ident(), **attrs})
+
+
+def write_trace(path, trace_format="chrome"):
+    """
+    Writes collected spans to file
+    :param path: Path of the trace file
+    :param trace_format: json (list of spans) or chrome (trace-event format)
+    """
+    spans = sorted(get_spans(), key=lambda item: item["start"])
+    if trace_format == "json":
+        content = {"spans": spans}
+    else:
+        content = {"traceEvents": _chrome_events(spans), "displayTimeUnit": "ms"}
+    with open(path, "w") as f:
+        json.dump(content, f, indent=1)
+    logging.info(f"Trace with {len(spans)} spans written to {os.path.abspath(path)}")
+
+
+def _chrome_events(spans):
+    """Converts spans to complete ("X") trace events, one process lane per host"""
+    pids, tids, events = {}, {}, []
+    for item in spans:
+        pid = pids.setdefault(item["host"], len(pids) + 1)
+        tid = tids.setdefault(item["thread"], len(tids) + 1)
+        args = {key: value for key, value in item.items() if key not in ("name", "start", "duration", "thread")}
+        events.append({"name": item["name"], "cat": item["host"], "ph": "X", "pid": pid, "tid": tid,
+                       "ts": int(item["start"] * 1e6), "dur": int(item["duration"] * 1e6), "args": args})
+    for host, pid in pids.items():
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": host}})
+    return events
@@ -0,0 +1,201 @@
+"""
+SFTP transfer engine for uploads to remote hosts.
+
+Files are split into parts written concurrently, every part over its own SFTP channel with pipelined writes
+and a large channel window, so a WAN link isn't limited by the window of a single channel. Parts are staged
+in ~/.mta-transfer under the SHA-256 of the file and the byte range of the part, then joined, verified against the local hash and moved
+into place by one remote script. When the connection drops, the session is re-established and every part
+resumes from the size already written to the remote host, the same applies to parts left by an interrupted
+earlier run. Every transfer records bytes sent and throughput in its "transfer" span.
+"""
+import logging
+import math
+import os
+import shlex
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from utils.cache import hash_file
+from utils.remote import run_script
+from utils.throttle import throttle
+from utils.trace import span
+
+STAGING_DIR = ".mta-transfer"
+# Files are split into parts of at least this size, smaller files are sent over one channel
+MIN_PART_SIZE = 4 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+# Receive window of the SFTP channels (paramiko default is 2 MB) and maximum packet size
+WINDOW_SIZE = 64 * 1024 * 1024
+MAX_PACKET_SIZE = 256 * 1024
+TRANSFER_RETRIES = 3
+
+
+def get_connection_errors():
+    """Errors of a dropped SSH connection, paramiko is imported once a transfer runs"""
+    import paramiko
+    return paramiko.SSHException, EOFError, OSError
+
+
+def split_parts(size, streams):
+    """
+    :param size: File size in bytes
+    :param streams: Maximum number of parts
+    :return: List of (offset, length) tuples, at least one
+    """
+    count = max(1, min(streams, math.ceil(size / MIN_PART_SIZE)))
+    length = math.ceil(size / count)
+    parts = [(offset, min(length, size - offset)) for offset in range(0, size, length or 1)]
+    return parts or [(0, 0)]
+
+
+def get_part_path(staged, offset, length):
+    """Staged part is named by its byte range, parts left by a run with another split are never resumed"""
+    return f"{staged}.{offset}-{length}"
+
+
+def _upload_part(local_path, remote_part, offset, length, client, progress, index):
+    """
+    Writes one part over its own SFTP channel, continuing after bytes the remote part already has
+    :param progress: Dict of sent and resumed lists counting bytes of every part, updated as blocks are written,
+                     and checked list of parts whose resumed bytes are recorded already
+    """
+    sftp = client.open_sftp(window_size=WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE)
+    try:
+        try:
+            done = sftp.stat(remote_part).st_size
+        except IOError:
+            done = 0
+        if done > length:
+            done = 0
+        # Bytes found by a retry were counted as sent by the earlier attempt
+        if not progress["checked"][index]:
+            progress["resumed"][index] = done
+            progress["checked"][index] = True
+        if done == length and done:
+            return
+        try:
+            remote = sftp.open(remote_part, "r+b" if done else "wb", bufsize=0)
+        except FileNotFoundError:
+            try:
+                sftp.mkdir(os.path.dirname(remote_part))
+            except IOError:
+                # Created by another part meanwhile
+                pass
+            remote = sftp.open(remote_part, "wb", bufsize=0)
+        with open(local_path, "rb") as f, remote:
+            # Writes are sent without waiting for acknowledgements, errors surface when the file is closed
+            remote.set_pipelined(True)
+            remote.seek(done)
+            f.seek(offset + done)
+            remaining = length - done
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    raise SystemExit(f"{local_path} changed during upload")
+                throttle(len(block))
+                remote.write(block)
+                remaining -= len(block)
+                progress["sent"][index] += len(block)
+    finally:
+        sftp.close()
+
+
+def _upload_parts(local_path, staged, parts, client):
+    """
+    Uploads all parts concurrently, the connection is re-established and parts resumed if it drops
+    :return: Tuple of bytes sent (resent after a dropped connection included) and bytes already on remote host
+    """
+    progress = {"sent": [0] * len(parts), "resumed": [0] * len(parts), "checked": [False] * len(parts)}
+    connection_errors = get_connection_errors()
+    for attempt in range(1, TRANSFER_RETRIES + 1):
+
+        def upload(index):
+            offset, length = parts[index]
+            try:
+                _upload_part(local_path, get_part_path(staged, offset, length), offset, length, client, progress, index)
+            except connection_errors as err:
+                return err
+            return None
+
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            errors = [err for err in executor.map(upload, range(len(parts))) if err]
+        if not errors:
+            return sum(progress["sent"]), sum(progress["resumed"])
+        err = errors[0]
+        # SFTP errors on a working connection (permissions, full disk) aren't worth retrying
+        if attempt == TRANSFER_RETRIES or (client.is_active() and isinstance(err, OSError)):
+            raise SystemExit(f"Upload of {local_path} to {client.host} failed: {err}")
+        logging.warning(f"Upload of {local_path} to {client.host} interrupted ({err}), resuming "
+                        f"(attempt {attempt + 1}/{TRANSFER_RETRIES})")
+        if not client.is_active():
+            client.reconnect()
+
+
+def get_assemble_commands(staged, parts, remote_path, sha):
+    """
+    Commands joining staged parts into remote_path after their hash was verified
+    :param staged: Remote path prefix of the parts
+    :param parts: List of (offset, length) tuples
+    :param remote_path: Final remote path
+    :param sha: Expected SHA-256 of the file
+    :return: List of shell commands
+    """
+    part_files = [shlex.quote(get_part_path(staged, offset, length)) for offset, length in parts]
+    assembled = shlex.quote(f"{remote_path}.{sha[:16]}.tmp")
+    commands = [f"mkdir -p {shlex.quote(os.path.dirname(remote_path) or '.')}",
+                f"mv {part_files[0]} {assembled}"]
+    if len(part_files) > 1:
+        commands.append(f"cat {' '.join(part_files[1:])} >> {assembled}")
+        commands.append(f"rm -f {' '.join(part_files[1:])}")
+    commands += [f"sum=$( (sha256sum {assembled} 2>/dev/null || shasum -a 256 {assembled}) | cut -d' ' -f1)",
+                 f'if [ "$sum" != "{sha}" ]; then rm -f {assembled}; '
+                 f'echo "SHA-256 mismatch of {remote_path}: $sum, expected {sha}" >&2; exit 1; fi',
+                 f"mv -f {assembled} {shlex.quote(remote_path)}",
+                 # Parts of transfers abandoned long ago
+                 f"find {shlex.quote(os.path.dirname(staged))} -type f -mtime +1 -delete 2>/dev/null || true"]
+    return commands
+
+
+def upload_file(local_path, remote_path, client, streams=None, then=None):
+    """
+    Uploads file to remote host and verifies its SHA-256 there
+    :param local_path: Path of the local file
+    :param remote_path: Absolute path on remote host, missing directories are created
+    :param client: SSH client (RemoteSession)
+    :param streams: Number of concurrent channels, defaults to transfer_streams from config.json
+    :param then: Optional commands run in the same remote script after the file is in place
+    :return: Dict with bytes (file size), sent, resumed, parts, duration and rate (bytes per second) of the upload
+    """
+    size = os.path.getsize(local_path)
+    sha = hash_file(local_path)
+    parts = split_parts(size, max(1, int(streams or config.TRANSFER_STREAMS or 1)))
+    staged = f"{client.facts['home']}/{STAGING_DIR}/{sha[:16]}"
+    logging.info(f"Uploading {size} bytes from {local_path} to {client.host}:{remote_path} in {len(parts)} parts")
+    with span("transfer", file=local_path, host=client.host, bytes=size, parts=len(parts)) as attrs:
+        start = time.monotonic()
+        sent, resumed = _upload_parts(local_path, staged, parts, client)
+        duration = time.monotonic() - start
+        report = {"bytes": size, "sent": sent, "resumed": resumed, "parts": len(parts),
+                  "duration": duration, "rate": sent / duration if duration else 0.0}
+        attrs.update(bytes=sent, resumed=report["resumed"], rate=report["rate"])
+        run_script(get_assemble_commands(staged, parts, remote_path, sha) + list(then or []), client=client)
+    logging.info(f"Uploaded {local_path} to {client.host}: {sent / 1024 ** 2:.1f} MB in {duration:.1f}s "
+                 f"({report['rate'] / 1024 ** 2:.1f} MB/s, {len(parts)} parts"
+                 + (f", {report['resumed'] / 1024 ** 2:.1f} MB resumed)" if report["resumed"] else ")"))
+    return report
+
+
+def upload_bytes(content, remote_path, client, then=None):
+    """
+    Uploads content as a file to remote host, see upload_file
+    :param content: String or bytes
+    """
+    if isinstance(content, str):
+        content = content.encode()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_path = os.path.join(tmp_dir, os.path.basename(remote_path))
+        with open(local_path, "wb") as f:
+            f.write(content)
+        return upload_file(local_path, remote_path, client, streams=1, then=then)
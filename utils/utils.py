@@ -1,24 +1,32 @@
 import logging
 import os
 import random
-import re
 import shlex
 import shutil
 import string
-import json
 import sys
+import threading
 import time
 import urllib
 
-import paramiko
-import requests
 import platform
 
 import config
+from utils.cache import get_artifact_cache
 from utils.const import zip_urls
+from utils.podman import get_podman_api
+from utils.policy import current_deadline, get_step_timeout, retry
+from utils.remote import RemoteSession, get_connection_pool
+from utils.trace import span
+from utils.transfer import upload_bytes
 
 # from utils.const import zip_urls
 
+# Seconds podman service is polled for after it was started
+PODMAN_START_TIMEOUT = 60
+_download_locks = {}
+_download_locks_lock = threading.Lock()
+
 # Logging configuration
 logging.basicConfig(
     level=logging.INFO,
@@ -29,47 +37,43 @@ logging.basicConfig(
     ]
 )
 
-
-import subprocess
 import logging
 
-def run_command(command, fail_on_failure=True, client=None):
+def run_command(command, fail_on_failure=True, client=None, timeout=None, on_line=None, capture=True, cancel=None):
+    """
+    Runs shell command locally or on remote host, stdout and stderr are read concurrently
+    :param command: Shell command
+    :param fail_on_failure: Raise SystemExit if the command fails or times out
+    :param client: SSH client, optional parameter to run the command remotely
+    :param timeout: Seconds after which the command is killed, defaults to command_timeout from config.json,
+                    capped by the deadline of the deployment
+    :param on_line: Callback called with stream name (stdout/stderr) and each output line as it arrives
+    :param capture: Return whole output, otherwise only last lines are kept for error reports
+    :param cancel: Optional threading.Event killing the command when set, the command is also killed when
+                   the deployment is cancelled
+    :return: Tuple of stdout and stderr
+    """
     logging.info(f"Executing command: {command}")
+    with span("command", command=command, host=client.host if client else "local") as attrs:
+        return _run_command(command, fail_on_failure, client, attrs, timeout, on_line, capture, cancel)
+
+
+def _run_command(command, fail_on_failure, client, attrs, timeout, on_line, capture, cancel):
+    # asyncio is loaded by the first command, not by commands which exit before running any
+    from utils import engine
+    location = "Remote" if client else "Local"
+    deadline = current_deadline()
+    timeout = deadline.timeout(f"{location} command", timeout or config.COMMAND_TIMEOUT)
+    if client:
+        command = f"bash -lc {shlex.quote(command)}"
     try:
-        if client:
-            safe_cmd = shlex.quote(command)
-            command = f"bash -lc {safe_cmd}"
-            _stdin, stdout, _stderr = client.exec_command(command)
-
-            out = stdout.read().decode()
-            err = _stderr.read().decode()
-            exit_status = stdout.channel.recv_exit_status()
-
-            # logging.info(f"[REMOTE] exit_code={exit_status}")
-            if exit_status != 0 and fail_on_failure:
-                raise SystemExit(
-                    f"Remote command failed with exit code {exit_status}\nSTDOUT:\n{out}\nSTDERR:\n{err}"
-                )
-
-            return out, err
-        else:
-            result = subprocess.run(
-                command,
-                shell=True,
-                check=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                encoding="utf-8",
-            )
-            if result.returncode != 0 and fail_on_failure:
-                raise SystemExit(
-                    f"Local command failed with exit code {result.returncode}\n"
-                    f"STDOUT:\n{result.stdout}\nSTDERR:\n{result.stderr}"
-                )
-            return result.stdout, result.stderr
+        result = engine.run(command, client, timeout, on_line, capture, deadline.watch(cancel))
     except Exception as err:
         raise SystemExit(f"There was an issue running a command: {err}")
-
+    attrs["exit_status"] = result.exit_status
+    if (result.exit_status != 0 or result.timed_out or result.cancelled) and fail_on_failure:
+        raise SystemExit(f"{location} command {result.describe()}")
+    return result.stdout, result.stderr
 
 
 def read_file(output_file):
@@ -85,41 +89,38 @@ def read_file(output_file):
     except Exception as err:
         raise SystemExit(f"There was an error opening file: {err}")
 
-def convert_to_json(file):
-    """
-    Converts incoming string to JSON format
-    :param file: String to be converted
-    :return: JSON
-    """
-    # print(f"Json got: {file}")
-    try:
-        match = re.search(r'\{.*\}', file, re.DOTALL)
-        if not match:
-            raise ValueError("No JSON object found in input.")
-
-        json_str = match.group(0)
-        parsed = json.loads(json_str)
-        logging.info("String was converted to JSON successfully!")
-        return parsed
-
-    except Exception as err:
-        raise SystemExit(f"There was an error converting string to JSON format: {err}")
-
-
 def connect_ssh(ip_address):
     SSH_HOST = ip_address
+    SSH_PORT = 22
+    if ip_address.count(":") == 1:
+        # host:port, plain IPv6 addresses are left as they are
+        SSH_HOST, SSH_PORT = ip_address.split(":")
     SSH_USER = config.SSH_USER
     SSH_KEY = config.SSH_KEY
-    client = paramiko.SSHClient()
-    try:
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(SSH_HOST, username=SSH_USER, key_filename=SSH_KEY)
-        logging.info(f"Connected to host {ip_address}")
-        return client
-    except Exception as err:
-        client.close()
-        raise SystemExit("There was an issue connecting to host by ssh: {}".format(err))
+
+    def attempt():
+        # SSH backend is loaded only by remote deployments
+        import paramiko
+        client = paramiko.SSHClient()
+        try:
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            timeout = get_step_timeout("ssh_connect", f"SSH connection to {ip_address}")
+            with span("ssh_connect", host=ip_address):
+                client.connect(SSH_HOST, port=int(SSH_PORT), username=SSH_USER, key_filename=SSH_KEY,
+                               timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+            logging.info(f"Connected to host {ip_address}")
+            return client
+        except Exception as err:
+            client.close()
+            raise SystemExit("There was an issue connecting to host by ssh: {}".format(err))
+
+    def connect():
+        return retry(attempt, f"SSH connection to {ip_address}")
+
+    pool = get_connection_pool()
+    session = pool.acquire(ip_address) if pool else None
+    return session or RemoteSession(connect(), ip_address, connect=connect)
 
 
 def get_target_dependency_path(client=None):
@@ -129,15 +130,9 @@ def get_target_dependency_path(client=None):
     :return: String contains folder name
     """
     if client:
-        try:
-            stdin, stdout, stderr = client.exec_command('echo $HOME')
-            home_dir = stdout.read().decode().strip()
-            if not home_dir:
-                # В качестве запасного варианта используем 'pwd'
-                stdin, stdout, stderr = client.exec_command('pwd')
-                home_dir = stdout.read().decode().strip()
-        except Exception as err:
-            raise SystemExit("There was an issue getting home dir of remote host: {}".format(err))
+        home_dir = client.facts.get("home")
+        if not home_dir:
+            raise SystemExit("There was an issue getting home dir of remote host {}".format(client.host))
     else:
         home_dir = os.path.expanduser("~")
 
@@ -192,41 +187,87 @@ def get_latest_upstream_dependency(user, repo, asset_name):
     :param asset_name:
     :return:
     """
-    url = f'https://api.github.com/repos/{user}/{repo}/releases'
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        releases = response.json()
-        for release in releases:
-            # Check if the release is a pre-release (beta/alpha)
-            if release['prerelease']:
-                for asset in release['assets']:
-                    if asset['name'] == asset_name:
-                        return asset['browser_download_url']
-    else:
-        logging.error(f"Error fetching releases: {response.status_code}")
-        return None
+    return get_latest_upstream_assets(user, repo).get(asset_name)
 
 
-def pull_stage_ga_dependency_file(mta_version, repo, os_name=None, machine=None):
+def get_latest_upstream_assets(user, repo):
+    """
+    Resolves download URLs of all assets of the latest pre-releases with one GitHub API call
+    :param user: Owner of the repo
+    :param repo: Repo where files are located
+    :return: Dict mapping asset name to URL of the latest pre-release which has it, empty if releases can't be fetched
+    """
+    import requests
+    url = f'{config.GITHUB_API_URL}/repos/{user}/{repo}/releases'
+
+    def fetch():
+        try:
+            response = requests.get(url, timeout=get_step_timeout("http", f"request to {url}"))
+        except requests.exceptions.RequestException as err:
+            raise SystemExit(f"Error fetching releases: {err}")
+        if response.status_code != 200:
+            raise SystemExit(f"Error fetching releases: HTTP {response.status_code}")
+        return response.json()
+
+    assets = {}
+    try:
+        releases = retry(fetch, f"Request to {url}")
+    except SystemExit as err:
+        if current_deadline().is_set():
+            raise
+        logging.error(str(err))
+        return assets
+    for release in releases:
+        # Check if the release is a pre-release (beta/alpha)
+        if release['prerelease']:
+            for asset in release['assets']:
+                assets.setdefault(asset['name'], asset['browser_download_url'])
+    return assets
+
+
+def get_stage_ga_dependency_url(mta_version, repo, os_name=None, machine=None):
+    """
+    :return: Tuple of URL and file name of Stage / GA dependency zip
+    """
     if not os_name and not machine:
         os_name, machine = get_os_platform()
     dependency_file_name = f'mta-{mta_version}-cli-{os_name}-{machine}.zip'
-    dependency_file_url=zip_urls.get(repo).format(ver=mta_version) + dependency_file_name
+    return zip_urls.get(repo).format(ver=mta_version) + dependency_file_name, dependency_file_name
+
+
+def pull_stage_ga_dependency_file(mta_version, repo, os_name=None, machine=None):
+    dependency_file_url, dependency_file_name = get_stage_ga_dependency_url(mta_version, repo, os_name, machine)
     logging.info(f"Downloading dependency file from URL: {dependency_file_url}")
     download_file(dependency_file_url, dependency_file_name)
     return dependency_file_name
 
 
-def download_file(url, local_filename):
-    response = requests.get(url, stream=True,verify=False)
-    if response.status_code == 200:
-        with open(local_filename, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        logging.info(f"File saved as {local_filename}")
-    else:
-        logging.error(f"Error downloading file: {response.status_code}")
+def download_file(url, local_filename, expected_sha256=None):
+    """
+    Downloads file, using artifact cache when it is enabled
+    :param url: URL of the file
+    :param local_filename: Path where the file should be saved
+    :param expected_sha256: Optional SHA-256 the file is verified against
+    """
+    if not url:
+        raise SystemExit(f"There is no URL to download {local_filename} from")
+    # HTTP backend is loaded only when something is downloaded
+    from utils.download import download, get_validators
+    # Concurrent deployments of one process (deploy_service.py jobs) may need the same file
+    with _download_locks_lock:
+        lock = _download_locks.setdefault(os.path.abspath(local_filename), threading.Lock())
+    with lock, span("download", url=url, host="local") as attrs:
+        cache = get_artifact_cache()
+        # Cached artifact is used only if the server still serves the same version of the file
+        validators = get_validators(url, cache.get_validators(url)) if cache else None
+        if cache and cache.fetch(url, local_filename, validators):
+            attrs["cache"] = "hit"
+            return
+        result = download(url, local_filename, segments=int(config.DOWNLOAD_SEGMENTS or 1),
+                          expected_sha256=expected_sha256)
+        attrs["bytes"] = result["size"]
+        if cache:
+            cache.store(url, local_filename, result["sha256"], validators)
 
 
 def get_os_platform ():
@@ -259,6 +300,8 @@ def get_repo_folder_name(repo_url: str) -> str:
 
 
 def get_home_dir(client=None):
+    if client:
+        return client.facts["home"]
     return run_command("echo $HOME", client=client)[0].strip()
 
 
@@ -268,7 +311,7 @@ def write_env_file(env_path, env_dict, client=None):
 
     :param env_path: Path to the .env file
     :param env_dict: Dictionary of environment variables {KEY: VALUE}
-    :param client: Optional paramiko.SSHClient for remote host
+    :param client: Optional SSH client (RemoteSession) for remote host
     """
     logging.info(f"Writing .env file at {env_path}")
 
@@ -277,22 +320,9 @@ def write_env_file(env_path, env_dict, client=None):
     content = "\n".join(lines) + "\n"
 
     if client:
-        # Remote write
-        sftp = client.open_sftp()
-        try:
-            # Ensure directory exists (optional)
-            dir_path = "/".join(env_path.split("/")[:-1])
-            try:
-                sftp.stat(dir_path)
-            except FileNotFoundError:
-                client.exec_command(f"mkdir -p {dir_path}")
-
-            # Write file
-            with sftp.file(env_path, "w") as f:
-                f.write(content)
-            logging.info(f"✅ Remote .env file written to {env_path}")
-        finally:
-            sftp.close()
+        # Remote write, missing directory is created by the transfer
+        upload_bytes(content, env_path, client)
+        logging.info(f"✅ Remote .env file written to {env_path}")
     else:
         # Local write
         with open(env_path, "w", encoding="utf-8") as f:
@@ -304,25 +334,51 @@ def ensure_podman_running(client=None):
     Ensures that Podman is running (either locally or remotely).
     Tries to start the default machine if not active.
     """
-    print("Checking Podman status...")
+    with span("podman_check", host=client.host if client else "local"):
+        _ensure_podman_running(client)
 
-    # Step 1: check if podman responds
-    out, err = run_command("podman images", fail_on_failure=False, client=client)
-    if err or "Error:" in out or "Cannot connect" in out:
-        print("Podman machine is not running. Attempting to start it...")
 
-        # Step 2: try to start machine
-        run_command("podman machine start >/dev/null 2>&1 || true", fail_on_failure=False, client=client)
+def _ensure_podman_running(client):
+    print("Checking Podman status...")
+    api = get_podman_api(client)
+    if api:
+        _ensure_podman_api_ready(api, client)
+        return
 
-        # Step 3: wait for startup
-        time.sleep(3)
+    # Step 1: check if podman responds, remote state is already known from host facts
+    if client:
+        running = client.facts.get("podman") == "running"
+    else:
+        out, err = run_command("podman images", fail_on_failure=False, client=client)
+        running = not (err or "Error:" in out or "Cannot connect" in out)
+    if not running:
+        print("Podman machine is not running. Attempting to start it...")
 
-        # Step 4: recheck status
-        out2, err2 = run_command("podman images", fail_on_failure=False, client=client)
+        # Step 2: try to start machine, wait for startup and recheck status in one go
+        out2, err2 = run_command("podman machine start >/dev/null 2>&1 || true; sleep 3; podman images",
+                                 fail_on_failure=False, client=client)
         if err2 or "Error:" in out2 or "Cannot connect" in out2:
             print("❌ Failed to start Podman machine.")
             raise SystemExit(1)
         else:
             print("Podman machine started successfully.")
+            if client:
+                client.invalidate_facts()
     else:
-        print("Podman is already running.")
\ No newline at end of file
+        print("Podman is already running.")
+
+
+def _ensure_podman_api_ready(api, client):
+    """Checks podman service responds, starts it if not and polls it with backoff instead of a fixed sleep"""
+    if api.ping():
+        print("Podman is already running.")
+        return
+    print("Podman service is not responding. Attempting to start it...")
+    run_command("podman machine start >/dev/null 2>&1 || systemctl --user start podman.socket >/dev/null 2>&1 || true",
+                fail_on_failure=False, client=client)
+    if not api.wait_ready(PODMAN_START_TIMEOUT):
+        print("❌ Failed to start Podman machine.")
+        raise SystemExit(1)
+    print("Podman machine started successfully.")
+    if client:
+        client.invalidate_facts()
\ No newline at end of file
@@ -1,26 +1,35 @@
+import errno
+import json
 import logging
 import os
+import shutil
+import sys
+import tempfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import config
-from utils.utils import convert_to_json, clear_folder, run_command, get_os_platform
+from utils.build_index import get_build_index, get_build_key, get_build_lock
+from utils.manifest import ImageManifest
+from utils.trace import span
+from utils.transfer import upload_file
+from utils.utils import clear_folder, run_command, get_os_platform
+
+# Manifest of the deployed ZIP members, kept in the target directory for incremental deployments
+MANIFEST_FILE = ".deploy-manifest.json"
+# renameat2() arguments: current directory as base of relative paths, swap both paths
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
 
 
 def get_zip_folder_name(image_list):
     """
     Gets folder name where dependency zip should be located. Name depends on version.
-    :param image_list: List of images to be parsed
+    :param image_list: ImageManifest, parsed or unparsed list of images
     :return: String containing folder name
     """
-    if isinstance(image_list, str):
-        image_list = convert_to_json(image_list)
-
-    for item in image_list["related_images"]:
-        for key, value in item.items():
-            if "mta-cli-rhel9" in key:
-                _, major, minor = value["nvr"].rsplit("-", 2)
-                return f"MTA-{major}-{minor}"
-    return None
+    return ImageManifest.load(image_list).get_zip_folder_name()
 
 
 def get_zip_name(version="upstream", os_name=None, machine=None):
@@ -44,14 +53,25 @@ def get_zip_name(version="upstream", os_name=None, machine=None):
     return zip_name
 
 
-def unpack_zip(zip_file, target_path, client=None):
+def unpack_zip(zip_file, target_path, client=None, incremental=False, workers=1):
     """
     Unpacks a ZIP file into the specified target directory.
     :param zip_file: Path to the ZIP file to be unpacked.
     :param target_path: Directory where the contents of the ZIP file will be extracted.
     :param client: Paramiko SSH client (optional)
+    :param incremental: Transfer and unpack only members which changed since the previous deployment
+    :param workers: Number of members extracted concurrently by local incremental unpack
     """
-    if not client:
+    with span("unpack", zip=zip_file, host=client.host if client else "local", incremental=incremental):
+        _unpack_zip(zip_file, target_path, client, incremental, workers)
+
+
+def _unpack_zip(zip_file, target_path, client, incremental, workers):
+    if client and incremental:
+        sync_zip_remote(zip_file, target_path, client)
+    elif incremental:
+        unpack_zip_incremental(zip_file, target_path, workers)
+    elif not client:
         clear_folder(target_path)
 
         with zipfile.ZipFile(zip_file, "r") as zip_ref:
@@ -62,33 +82,298 @@ def unpack_zip(zip_file, target_path, client=None):
                 raise SystemExit("There was an issue with unpacking zip file: {}".format(err))
     else:
         try:
-            remote_home_dir = run_command("pwd", client=client)[0].strip()
+            remote_home_dir = client.facts["home"]
             remote_zip = os.path.join(remote_home_dir, os.path.basename(zip_file))
             logging.info(f"Local zip path: {zip_file}")
             logging.info(f"Remote zip path: {remote_zip}")
-            sftp = client.open_sftp()
-            sftp.put(zip_file, remote_zip)
-
-            # Cleanup folder on remote host
-            logging.info(f"Clearing target path: {target_path}")
-            # run_command_ssh(client, f"rm -rf {target_path}/*")
-            run_command( f"rm -rf {target_path}/*", client=client)[0]
-
-            # Unpacking zip on remote host
-            logging.info(f"Unpacking {remote_zip} to {target_path} on remote host")
-            run_command(f"unzip -o {remote_zip} -d {target_path}", client=client)
+            # Upload, then cleanup folder, unpack zip and remove archive on remote host in one go
+            logging.info(f"Clearing target path {target_path} and unpacking {remote_zip} to it on remote host")
+            upload_file(zip_file, remote_zip, client,
+                        then=[f"rm -rf {target_path}/* {target_path}/{MANIFEST_FILE}",
+                              f"unzip -o {remote_zip} -d {target_path}",
+                              f"rm -f {remote_zip}"])
 
             logging.info(f"Zip {zip_file} unpacked successfully to {target_path} on remote host")
 
-            # Cleaning up archive
-            run_command(f"rm -f {remote_zip}", client)
-
         except Exception as err:
             logging.error("Remote unpack failed:")
             raise SystemExit("{}".format(err))
 
 
-def generate_zip(version, build):
-    """Generates zip with dependencies for local run"""
+def build_zip_manifest(zip_file):
+    """
+    Reads central directory of the ZIP file
+    :param zip_file: Path to the ZIP file
+    :return: Dict mapping member name to its size, CRC and mode
+    """
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        return {info.filename: {"size": info.file_size, "crc": info.CRC, "mode": info.external_attr >> 16}
+                for info in zip_ref.infolist() if not info.is_dir()}
+
+
+def diff_manifests(old_manifest, new_manifest):
+    """
+    Compares manifests of previously and currently deployed ZIP files
+    :return: Tuple of (members which changed or are missing, files which are not in the new ZIP anymore)
+    """
+    changed = [name for name, entry in new_manifest.items() if old_manifest.get(name) != entry]
+    stale = [name for name in old_manifest if name not in new_manifest]
+    return changed, stale
+
+
+def write_delta_zip(zip_file, members, delta_file):
+    """
+    Writes ZIP file containing only the selected members of the source ZIP
+    :param zip_file: Source ZIP file
+    :param members: Names of members to be copied
+    :param delta_file: Path of the ZIP file to be created
+    """
+    with zipfile.ZipFile(zip_file, "r") as zip_in, zipfile.ZipFile(delta_file, "w", allowZip64=True) as zip_out:
+        for name in members:
+            info = zip_in.getinfo(name)
+            with zip_in.open(info) as src, zip_out.open(info, "w", force_zip64=info.file_size > 0x7FFFFFFF) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def unpack_zip_incremental(zip_file, target_path, workers=1):
+    """
+    Unpacks only members which changed since the previous deployment and removes files which are gone.
+    Changes are prepared in a staging copy of the target directory (unchanged files are hard linked)
+    which then replaces the target, so an interrupted extraction never leaves half-written directory.
+    The switch-over is atomic on Linux (see switch_directories), elsewhere a deployment interrupted between
+    its two renames is repaired by the next one, which restores <target>.old.
+    :param zip_file: Path to the ZIP file
+    :param target_path: Directory to be updated
+    :param workers: Number of members extracted concurrently
+    """
+    target_path = os.path.normpath(target_path)
+    staging_path = f"{target_path}.staging"
+    old_path = f"{target_path}.old"
+    if not os.path.exists(target_path) and os.path.exists(old_path):
+        logging.info(f"Restoring {target_path} after interrupted deployment")
+        os.rename(old_path, target_path)
+    for path in (staging_path, old_path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    manifest = build_zip_manifest(zip_file)
+    old_manifest = None
+    try:
+        with open(os.path.join(target_path, MANIFEST_FILE), "r") as f:
+            old_manifest = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    if old_manifest is None:
+        logging.info(f"No deployment manifest found in {target_path}, unpacking whole zip")
+        changed, stale = list(manifest), []
+        os.makedirs(staging_path)
+    else:
+        changed, stale = diff_manifests(old_manifest, manifest)
+        if not changed and not stale:
+            logging.info(f"Dependencies in {target_path} are up to date")
+            return
+        link_tree(target_path, staging_path)
+    logging.info(f"Updating {target_path}: {len(changed)} changed, {len(stale)} stale, "
+                 f"{len(manifest) - len(changed)} unchanged files")
+
+    try:
+        for name in stale + changed:
+            # Staging files are hard links to the live ones, unlink instead of overwriting in place
+            path = os.path.normpath(os.path.join(staging_path, name))
+            if path.startswith(staging_path + os.sep) and os.path.lexists(path):
+                os.remove(path)
+
+        # Every worker thread reads through its own handle, all of them are closed once extraction is done
+        local = threading.local()
+        zip_refs = []
+
+        def extract(name):
+            if not hasattr(local, "zip_ref"):
+                local.zip_ref = zipfile.ZipFile(zip_file, "r")
+                zip_refs.append(local.zip_ref)
+            path = local.zip_ref.extract(name, staging_path)
+            if manifest[name]["mode"]:
+                os.chmod(path, manifest[name]["mode"] & 0o7777)
+
+        try:
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(extract, changed))
+            else:
+                for name in changed:
+                    extract(name)
+        finally:
+            for zip_ref in zip_refs:
+                zip_ref.close()
+
+        # Staged manifest is a hard link to the live one, writing it in place would mark the target up to date
+        staged_manifest = os.path.join(staging_path, MANIFEST_FILE)
+        if os.path.lexists(staged_manifest):
+            os.remove(staged_manifest)
+        with open(staged_manifest, "w") as f:
+            json.dump(manifest, f)
+    except Exception as err:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise SystemExit("There was an issue with unpacking zip file: {}".format(err))
+
+    switch_directories(staging_path, target_path, old_path)
+    logging.info(f"Zip {zip_file} unpacked incrementally to {target_path}")
+
+
+def switch_directories(staging_path, target_path, old_path):
+    """
+    Replaces target directory with the staging one. Both are swapped in one step where the platform supports
+    it, readers of the target never find it missing. Otherwise the target is moved to old_path first.
+    """
+    if os.path.exists(target_path) and exchange_paths(staging_path, target_path):
+        # Staging path holds the previous content now
+        shutil.rmtree(staging_path, ignore_errors=True)
+        return
+    if os.path.exists(target_path):
+        os.rename(target_path, old_path)
+    os.rename(staging_path, target_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def exchange_paths(first, second):
+    """
+    Swaps two paths atomically with renameat2(RENAME_EXCHANGE)
+    :return: True if the paths were swapped, False if the platform or file system can't do it
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    # Loaded only for the switch-over, ctypes isn't needed anywhere else
+    import ctypes
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        # glibc older than 2.28 or another libc
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    if renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(err, os.strerror(err), second)
+
+
+def link_tree(src, dest):
+    """
+    Recreates directory tree of src in dest with files hard linked instead of copied
+    """
+    for root, dirs, files in os.walk(src):
+        dest_root = os.path.join(dest, os.path.relpath(root, src))
+        os.makedirs(dest_root, exist_ok=True)
+        for name in files:
+            src_file = os.path.join(root, name)
+            if os.path.islink(src_file):
+                os.symlink(os.readlink(src_file), os.path.join(dest_root, name))
+            else:
+                os.link(src_file, os.path.join(dest_root, name))
+        for name in dirs:
+            if os.path.islink(os.path.join(root, name)):
+                os.symlink(os.readlink(os.path.join(root, name)), os.path.join(dest_root, name))
+
+
+def sync_zip_remote(zip_file, target_path, client):
+    """
+    Synchronizes remote target directory with ZIP content. Member sizes and CRCs are compared with
+    the manifest stored on remote host by previous deployment, only changed or missing members are
+    transferred and only stale files are deleted. Without remote manifest whole ZIP is unpacked.
+    :param zip_file: Path to the local ZIP file
+    :param target_path: Remote directory to be synchronized
+    :param client: Paramiko SSH client
+    """
+    manifest = build_zip_manifest(zip_file)
+    manifest_path = f"{target_path}/{MANIFEST_FILE}"
+    sftp = client.open_sftp()
+    try:
+        try:
+            with sftp.open(manifest_path, "r") as f:
+                remote_manifest = json.loads(f.read())
+        except (IOError, ValueError):
+            remote_manifest = None
+
+        # Invalidate manifest first, interrupted sync must end up in full unpack next time
+        try:
+            sftp.remove(manifest_path)
+        except IOError:
+            try:
+                sftp.mkdir(target_path)
+            except IOError:
+                pass
+        if remote_manifest is None:
+            logging.info(f"No deployment manifest found in {target_path}, unpacking whole zip")
+            changed, stale, cleanup = list(manifest), [], f"rm -rf {target_path}/*"
+        else:
+            changed, stale = diff_manifests(remote_manifest, manifest)
+            cleanup = None
+        logging.info(f"Syncing {target_path}: {len(changed)} changed, {len(stale)} stale, "
+                     f"{len(manifest) - len(changed)} unchanged files")
+
+        commands = [cleanup] if cleanup else []
+        if stale:
+            stale_list = f"{target_path}/.deploy-stale"
+            with sftp.open(stale_list, "w") as f:
+                f.write("\n".join(stale) + "\n")
+            commands.append(f"cd {target_path} && tr '\\n' '\\0' < .deploy-stale | xargs -0 rm -f -- && rm -f .deploy-stale")
+
+        if changed:
+            remote_zip = f"{target_path}/.deploy-delta.zip"
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                if len(changed) == len(manifest):
+                    delta_file = zip_file
+                else:
+                    delta_file = os.path.join(tmp_dir, "delta.zip")
+                    write_delta_zip(zip_file, changed, delta_file)
+                # Stale files are removed and the delta unpacked by the script verifying the upload
+                commands.append(f"unzip -o -q {remote_zip} -d {target_path} && rm -f {remote_zip}")
+                upload_file(delta_file, remote_zip, client, then=[" && ".join(commands)])
+            commands = []
+            # Upload may have re-established the connection, the SFTP session opened before it is dead then
+            sftp.close()
+            sftp = client.open_sftp()
+
+        if commands:
+            run_command(" && ".join(commands), client=client)
+
+        with sftp.open(manifest_path, "w") as f:
+            f.write(json.dumps(manifest))
+        logging.info(f"Zip {zip_file} synced successfully to {target_path} on remote host")
+    except SystemExit:
+        raise
+    except Exception as err:
+        logging.error("Remote sync failed:")
+        raise SystemExit("{}".format(err))
+    finally:
+        sftp.close()
+
+
+def generate_zip(version, build, image_list=None):
+    """
+    Generates zip with dependencies for local run. Extraction is skipped when the build index
+    holds unchanged zips of the same build.
+    :param version: MTA version
+    :param build: Build number
+    :param image_list: Images list of the build, locates the extracted zips for the build index
+    """
+    key = get_build_key(version, build)
+    # Concurrent jobs of the same build would run the extract binary into the same folder
+    with get_build_lock(key):
+        _generate_zip(version, build, key, image_list)
+
+
+def _generate_zip(version, build, key, image_list):
+    index = get_build_index()
+    folder_name = get_zip_folder_name(image_list) if image_list else None
+    folder = os.path.join(config.MISC_DOWNSTREAM_PATH, folder_name) if folder_name else None
+    if index and folder and index.get_zips(key, folder):
+        logging.info(f"Using dependency zips of {key} from build index: {folder}")
+        return
     extract_binary_command = f"{config.MISC_DOWNSTREAM_PATH}{config.EXTRACT_BINARY} {config.BUNDLE}{version}-{build} {config.NO_BREW}"
-    run_command(extract_binary_command)
+    with span("zip_generation", version=version, build=build):
+        run_command(extract_binary_command)
+    if index and folder:
+        index.store_zips(key, folder)